@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""HTTP load test of the backend running under a local Gunicorn.
+
+The server is started with the same command line and configuration module as
+in the Dockerfile (the worker class and number of workers can be overridden),
+then a realistic mix of requests is sent at a fixed rate, and the throughput,
+latency percentiles and error rates are reported. Usage::
+
+    python3 benchmarks/loadtest.py --rate 50 --duration 30 --workers 2
+    python3 benchmarks/loadtest.py --url http://localhost:8080 --rate 100
+
+The load is open-loop: requests are issued on a fixed schedule whatever the
+response times, and latencies are measured from the scheduled time, so that
+queueing delays are not hidden when the server cannot keep up. Run the tool
+with several --workers / --worker-class settings at increasing --rate to find
+the sustainable throughput of a pod, which is what replicaCount and the HPA
+settings of the Helm chart should be sized from.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import http.client
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+
+# Same as the CMD of the Dockerfile, minus the options set by the tool
+GUNICORN_COMMAND = ('gunicorn --config python:linear_voluba.gunicorn_conf '
+                    'linear_voluba.wsgi:application')
+
+# (weight, category, transformation type, number of landmark pairs)
+DEFAULT_MIX = [
+    (20, 'least-squares', 'rigid', 4),
+    (10, 'least-squares', 'rigid+reflection', 10),
+    (20, 'least-squares', 'similarity', 10),
+    (5, 'least-squares', 'similarity+reflection', 10),
+    (20, 'least-squares', 'affine', 10),
+    (10, 'least-squares', 'affine', 100),
+    (3, 'least-squares', 'similarity', 1000),
+    (2, 'least-squares', 'affine', 1000),
+    (5, 'degenerate', 'affine', 3),
+    (5, 'health', None, None),
+]
+
+
+class Request:
+    __slots__ = ('category', 'method', 'path', 'body')
+
+    def __init__(self, category, method, path, body=None):
+        self.category = category
+        self.method = method
+        self.path = path
+        self.body = body
+
+
+def make_landmark_pairs(count, rng, inactive_fraction=0.1):
+    src = rng.uniform(-50, 50, size=(count, 3))
+    dst = src @ rng.uniform(0.5, 1.5, size=(3, 3)).T + rng.uniform(-10, 10, 3)
+    dst += rng.normal(scale=0.5, size=dst.shape)
+    return [
+        {
+            'name': 'landmark {0}'.format(i),
+            'colour': '#8dd3c7',
+            'active': bool(i < 4 or rng.uniform() >= inactive_fraction),
+            'source_point': src[i].tolist(),
+            'target_point': dst[i].tolist(),
+        }
+        for i in range(count)
+    ]
+
+
+def make_request(category, transformation_type, count, rng):
+    if category == 'health':
+        return Request(category, 'GET', '/health')
+    landmark_pairs = make_landmark_pairs(count, rng)
+    if category == 'degenerate':
+        # Collinear source points
+        for pair in landmark_pairs:
+            pair['source_point'][1:] = [0.0, 0.0]
+    body = json.dumps({
+        'transformation_type': transformation_type,
+        'landmark_pairs': landmark_pairs,
+    }).encode('utf-8')
+    return Request(category, 'POST', '/api/least-squares', body)
+
+
+def make_request_pool(mix=DEFAULT_MIX, size=200, seed=0):
+    """Pre-build a pool of requests, drawn according to the weights of mix."""
+    rng = np.random.RandomState(seed)
+    weights = np.array([entry[0] for entry in mix], dtype=float)
+    draws = rng.choice(len(mix), size=size, p=weights / weights.sum())
+    return [make_request(*mix[i][1:], rng=rng) for i in draws]
+
+
+class Client:
+    """HTTP client keeping one persistent connection per thread."""
+
+    def __init__(self, base_url, timeout=60):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def send(self, request):
+        """Send the request, return the HTTP status (0 on network error)."""
+        headers = {}
+        if request.body is not None:
+            headers['Content-Type'] = 'application/json'
+        connection = self._connection()
+        try:
+            connection.request(request.method, self.prefix + request.path,
+                               body=request.body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self._local.connection = None
+            return 0
+
+
+def run_schedule(client, schedule, concurrency):
+    """Send requests according to a schedule of (offset, request) pairs.
+
+    offset is the time in seconds, relative to the start, at which the request
+    is due. Return a list of (request, status, latency) tuples, where the
+    latency is measured from the scheduled time.
+    """
+    results = []
+    results_lock = threading.Lock()
+
+    def send(request, scheduled_time):
+        status = client.send(request)
+        latency = time.perf_counter() - scheduled_time
+        with results_lock:
+            results.append((request, status, latency))
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        start = time.perf_counter()
+        for offset, request in schedule:
+            scheduled_time = start + offset
+            delay = scheduled_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, request, scheduled_time)
+    return results
+
+
+def constant_rate_schedule(pool, rate, duration, seed=0):
+    rng = random.Random(seed)
+    for i in range(int(rate * duration)):
+        yield i / rate, rng.choice(pool)
+
+
+def summarize(results, elapsed):
+    """Compute throughput, latency percentiles and error rates."""
+    def stats(entries):
+        latencies = np.array([latency for _, _, latency in entries])
+        statuses = [status for _, status, _ in entries]
+        return {
+            'count': len(entries),
+            'throughput': len(entries) / elapsed,
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+            'client_errors': sum(400 <= s < 500 for s in statuses),
+            'server_errors': sum(s >= 500 for s in statuses),
+            'network_errors': sum(s == 0 for s in statuses),
+        }
+
+    summary = {'all': stats(results)} if results else {}
+    categories = sorted({request.category for request, _, _ in results})
+    for category in categories:
+        summary[category] = stats([
+            entry for entry in results if entry[0].category == category])
+    return summary
+
+
+def print_summary(summary):
+    width = max([15] + [len(category) for category in summary])
+    print('{0:<{9}} {1:>7} {2:>9} {3:>9} {4:>9} {5:>9} {6:>6} {7:>6} {8:>6}'
+          .format('category', 'count', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                  '4xx', '5xx', 'net', width))
+    for category, stats in summary.items():
+        print('{0:<{5}} {1[count]:>7} {1[throughput]:>9.1f} '
+              '{2:>9.2f} {3:>9.2f} {4:>9.2f} {1[client_errors]:>6} '
+              '{1[server_errors]:>6} {1[network_errors]:>6}'
+              .format(category, stats, stats['p50'] * 1e3,
+                      stats['p95'] * 1e3, stats['p99'] * 1e3, width))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(client, timeout=60, path='/health/ready'):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if client.send(Request('health', 'GET', path)) == 200:
+            return
+        time.sleep(0.1)
+    raise RuntimeError('the server did not become ready in time')
+
+
+@contextlib.contextmanager
+def gunicorn_server(worker_class=None, workers=None, extra_args='',
+                    log_file=None):
+    """Start the backend under Gunicorn, yield its base URL.
+
+    worker_class and workers default to the values derived by
+    linear_voluba.gunicorn_conf from the resources of the machine.
+    """
+    port = free_port()
+    command = shlex.split(GUNICORN_COMMAND) + [
+        '--bind=127.0.0.1:{0}'.format(port),
+    ]
+    if worker_class:
+        command.append('--worker-class={0}'.format(worker_class))
+    if workers:
+        command.append('--workers={0}'.format(workers))
+    command += shlex.split(extra_args)
+    with tempfile.TemporaryDirectory() as instance_path:
+        env = dict(os.environ, INSTANCE_PATH=instance_path)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir),
+            env.get('PYTHONPATH'),
+        ]))
+        with contextlib.ExitStack() as stack:
+            if log_file:
+                output = stack.enter_context(open(log_file, 'w'))
+            else:
+                output = subprocess.DEVNULL
+            server = subprocess.Popen(command, env=env, stdout=output,
+                                      stderr=subprocess.STDOUT)
+            try:
+                yield 'http://127.0.0.1:{0}'.format(port)
+            finally:
+                # Quick shutdown: do not wait for idle keep-alive connections
+                server.send_signal(signal.SIGINT)
+                server.wait(timeout=30)
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--url',
+                        help='test an already running server instead of '
+                        'starting Gunicorn')
+    parser.add_argument('--worker-class',
+                        help='Gunicorn worker class (default: derived by '
+                        'linear_voluba.gunicorn_conf)')
+    parser.add_argument('--workers', type=int,
+                        help='number of Gunicorn workers (default: derived '
+                        'by linear_voluba.gunicorn_conf)')
+    parser.add_argument('--gunicorn-args', default='',
+                        help='additional arguments passed to Gunicorn')
+    parser.add_argument('--server-log',
+                        help='file where the output of Gunicorn is written')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='maximum number of requests in flight '
+                        '(default: %(default)s)')
+
+
+@contextlib.contextmanager
+def server_from_arguments(args):
+    if args.url:
+        yield args.url
+    else:
+        with gunicorn_server(args.worker_class, args.workers,
+                             args.gunicorn_args, args.server_log) as url:
+            yield url
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_server_arguments(parser)
+    parser.add_argument('--rate', type=float, default=20,
+                        help='requests per second (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='duration of the measurement in seconds '
+                        '(default: %(default)s)')
+    parser.add_argument('--warmup', type=float, default=5,
+                        help='duration of the warm-up phase, whose requests '
+                        'are not reported (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o',
+                        help='write the summary to this JSON file')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_command_line(argv)
+    pool = make_request_pool(seed=args.seed)
+    with server_from_arguments(args) as url:
+        client = Client(url)
+        wait_until_ready(client)
+        if args.warmup > 0:
+            run_schedule(client,
+                         constant_rate_schedule(pool, args.rate, args.warmup,
+                                                seed=args.seed + 1),
+                         args.concurrency)
+        start = time.perf_counter()
+        results = run_schedule(
+            client,
+            constant_rate_schedule(pool, args.rate, args.duration,
+                                   seed=args.seed),
+            args.concurrency)
+        elapsed = time.perf_counter() - start
+    summary = summarize(results, elapsed)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'settings': {
+                    'url': args.url,
+                    'worker_class': args.worker_class,
+                    'workers': args.workers,
+                    'rate': args.rate,
+                    'duration': args.duration,
+                },
+                'summary': summary,
+            }, f, indent=2)
+    return 1 if summary.get('all', {}).get('server_errors') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Replay of captured production traffic against a local server.
+
+The traffic is captured by the backend when CAPTURE_SAMPLE_RATE is set (see
+linear_voluba.capture). Usage::
+
+    # Replay the capture at 10 times its original pace, store the latencies
+    python3 benchmarks/replay.py run --speed 10 -o baseline.json \\
+        instance/capture/*.jsonl.gz
+    # ... change the code, then replay the same capture and compare
+    python3 benchmarks/replay.py run --speed 10 -o new.json \\
+        instance/capture/*.jsonl.gz
+    python3 benchmarks/replay.py compare baseline.json new.json
+
+The files that the server is still writing (``*.jsonl.gz.open``) can also
+be given, they are read up to their last complete record.
+
+The requests are sent on the schedule of the capture (open loop, as in
+loadtest.py, whose server options are accepted), so that two replays of the
+same capture send exactly the same requests at the same times. The compare
+command pairs the latencies of each request in the two replays, and exits
+with status 1 if the median latency ratio of any category (endpoint and
+transformation type) exceeds the threshold (20% by default). Replay the
+baseline twice to gauge the noise of the measurements on the machine, which
+is large if the pace of the replay is close to what the server can sustain.
+"""
+
+import argparse
+import json
+import os.path
+import sys
+import time
+
+import numpy as np
+
+import loadtest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from linear_voluba import capture  # noqa: E402
+
+
+DEFAULT_THRESHOLD = 0.2
+
+
+def record_category(record):
+    category = record['path']
+    if category.startswith('/api/'):
+        category = category[len('/api/'):]
+    body = record.get('body')
+    if isinstance(body, dict) and 'transformation_type' in body:
+        category += '/' + str(body['transformation_type'])
+    return category
+
+
+def load_requests(paths, limit=None):
+    """Read the capture files, return a list of (offset, request, record).
+
+    offset is the time at which the request was received, in seconds
+    relative to the first request.
+    """
+    records = sorted(capture.read_capture(paths),
+                     key=lambda record: record['time'])
+    if limit is not None:
+        records = records[:limit]
+    if not records:
+        return []
+    start = records[0]['time']
+    requests = []
+    for record in records:
+        path = record['path']
+        if record.get('query'):
+            path += '?' + record['query']
+        request = loadtest.Request(
+            record_category(record), record['method'], path,
+            json.dumps(record['body']).encode('utf-8'))
+        requests.append((record['time'] - start, request, record))
+    return requests
+
+
+def make_schedule(requests, speed=1.0, max_gap=None):
+    """Compute the (offset, request) schedule of the replay.
+
+    The offsets are divided by speed, and the idle periods are shortened to
+    max_gap seconds (after the speed-up).
+    """
+    schedule = []
+    offset = previous = 0.0
+    for original_offset, request, _ in requests:
+        gap = (original_offset - previous) / speed
+        if max_gap is not None:
+            gap = min(gap, max_gap)
+        offset += gap
+        previous = original_offset
+        schedule.append((offset, request))
+    return schedule
+
+
+def run(args):
+    requests = load_requests(args.capture, args.limit)
+    if not requests:
+        print('no request found in the capture files', file=sys.stderr)
+        return 2
+    schedule = make_schedule(requests, args.speed, args.max_gap)
+    index = {id(request): i for i, (_, request, _) in enumerate(requests)}
+    with loadtest.server_from_arguments(args) as url:
+        client = loadtest.Client(url)
+        loadtest.wait_until_ready(client)
+        for _, request, _ in requests[:args.warmup]:
+            client.send(request)
+        start = time.perf_counter()
+        results = loadtest.run_schedule(client, schedule, args.concurrency)
+        elapsed = time.perf_counter() - start
+    summary = loadtest.summarize(results, elapsed)
+    loadtest.print_summary(summary)
+
+    latencies = [None] * len(requests)
+    statuses = [None] * len(requests)
+    for request, status, latency in results:
+        latencies[index[id(request)]] = latency
+        statuses[index[id(request)]] = status
+    changed = sum(status != record['status']
+                  for status, (_, _, record) in zip(statuses, requests))
+    print('{0} of {1} requests got a different status than in the capture'
+          .format(changed, len(requests)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'settings': {
+                    'url': args.url,
+                    'worker_class': args.worker_class,
+                    'workers': args.workers,
+                    'capture': args.capture,
+                    'speed': args.speed,
+                    'max_gap': args.max_gap,
+                },
+                'summary': summary,
+                'categories': [request.category for _, request, _ in requests],
+                'latencies': latencies,
+                'statuses': statuses,
+            }, f, indent=2)
+    return 0
+
+
+def compare_replays(baseline, new, threshold=DEFAULT_THRESHOLD):
+    """Compare the latencies of two replays of the same capture.
+
+    Return a list of (category, count, baseline_p50, new_p50, median_ratio,
+    is_regression), where median_ratio is the median over the requests of
+    the category of the ratio of their new and baseline latencies.
+    """
+    if baseline['categories'] != new['categories']:
+        raise ValueError('the two replays are not from the same capture')
+    by_category = {}
+    for category, old_latency, new_latency in zip(
+            baseline['categories'], baseline['latencies'], new['latencies']):
+        if old_latency and new_latency:
+            by_category.setdefault(category, []).append(
+                (old_latency, new_latency))
+    comparison = []
+    for category, pairs in sorted(by_category.items()):
+        old_latencies, new_latencies = np.array(pairs).T
+        ratio = float(np.median(new_latencies / old_latencies))
+        comparison.append((category, len(pairs),
+                           float(np.median(old_latencies)),
+                           float(np.median(new_latencies)),
+                           ratio, ratio > 1 + threshold))
+    return comparison
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    try:
+        comparison = compare_replays(baseline, new, args.threshold)
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 2
+    width = max([8] + [len(category) for category, *_ in comparison])
+    print('{0:<{1}} {2:>7} {3:>11} {4:>11} {5:>8}'.format(
+        'category', width, 'count', 'old p50 ms', 'new p50 ms', 'ratio'))
+    regressions = 0
+    for category, count, old_p50, new_p50, ratio, is_regression in comparison:
+        regressions += is_regression
+        print('{0:<{1}} {2:>7} {3:>11.2f} {4:>11.2f} {5:>7.2f}x{6}'.format(
+            category, width, count, old_p50 * 1e3, new_p50 * 1e3, ratio,
+            '  REGRESSION' if is_regression else ''))
+    changed = sum(old != new_status for old, new_status
+                  in zip(baseline['statuses'], new['statuses']))
+    if changed:
+        print('{0} request(s) got a different status'.format(changed))
+    print('{0} regression(s) beyond {1:.0%} out of {2} categories'
+          .format(regressions, args.threshold, len(comparison)))
+    return 1 if regressions else 0
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='replay a capture')
+    loadtest.add_server_arguments(run_parser)
+    run_parser.add_argument('capture', nargs='+',
+                            help='capture files (capture-*.jsonl.gz)')
+    run_parser.add_argument('--speed', type=float, default=1.0,
+                            help='acceleration of the original pace '
+                            '(default: %(default)s)')
+    run_parser.add_argument('--max-gap', type=float,
+                            help='shorten the idle periods to this number of '
+                            'seconds')
+    run_parser.add_argument('--limit', type=int,
+                            help='only replay the first requests')
+    run_parser.add_argument('--warmup', type=int, default=20,
+                            help='number of requests sent one by one before '
+                            'the replay, which are not reported (default: '
+                            '%(default)s)')
+    run_parser.add_argument('--output', '-o',
+                            help='write the latencies to this JSON file')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare two replays of the same capture')
+    compare_parser.add_argument('baseline', help='baseline JSON results')
+    compare_parser.add_argument('new', help='new JSON results')
+    compare_parser.add_argument('--threshold', type=float,
+                                default=DEFAULT_THRESHOLD,
+                                help='relative slow-down that is reported as '
+                                'a regression (default: %(default)s)')
+    compare_parser.set_defaults(func=compare)
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_command_line(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
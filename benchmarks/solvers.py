@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Micro-benchmarks of the solvers of linear_voluba.leastsquares.
+
+Usage::
+
+    # Measure, and store the results as a JSON baseline
+    python3 benchmarks/solvers.py run --output baseline.json
+    # ... change the code, then measure again and compare
+    python3 benchmarks/solvers.py run --output new.json
+    python3 benchmarks/solvers.py compare baseline.json new.json
+
+The compare command exits with status 1 if any benchmark is slower than the
+baseline by more than the threshold (20% by default). Timings are the best
+of several repetitions, which is the most reproducible statistic on a
+machine that runs other processes.
+"""
+
+import argparse
+import datetime
+import json
+import os.path
+import platform
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from linear_voluba import leastsquares  # noqa: E402
+from linear_voluba import streaming  # noqa: E402
+
+
+LANDMARK_COUNTS = [3, 4, 10, 100, 1000, 10000, 100000, 1000000]
+BATCH_SIZES = [1, 10, 100]
+TARGET_COUNTS = [1, 10, 100]
+PARSE_LANDMARK_COUNTS = [10, 1000, 100000]
+DEFAULT_THRESHOLD = 0.2
+
+# An arbitrary affine matrix used to generate the target points
+AFFINE_MATRIX = np.array([
+    [1.2, 0.8, 0.9, 2.0],
+    [0.7, 1.1, 1.2, 33.0],
+    [1.1, 0.9, 0.8, 100.0],
+    [0.0, 0.0, 0.0, 1.0],
+])
+
+MINIMUM_LANDMARKS = {
+    'rigid': 3,
+    'rigid+reflection': 4,
+    'similarity': 3,
+    'similarity+reflection': 4,
+    'affine': 4,
+}
+
+
+def make_points(count, seed=0, noise=0.1):
+    """Generate corresponding points related by AFFINE_MATRIX plus noise."""
+    rng = np.random.RandomState(seed)
+    src = rng.uniform(-50, 50, size=(count, 3))
+    dst = src @ AFFINE_MATRIX[:3, :3].T + AFFINE_MATRIX[:3, 3]
+    dst += rng.normal(scale=noise, size=dst.shape)
+    return src, dst
+
+
+def make_near_degenerate_points(count, seed=0):
+    """Generate nearly coplanar source points (z coordinate close to 0)."""
+    src, dst = make_points(count, seed)
+    src[:, 2] *= 1e-9
+    return src, dst
+
+
+def make_degenerate_points(count, seed=0):
+    """Generate collinear source points (the problem is underdetermined)."""
+    src, dst = make_points(count, seed)
+    src[:, 1:] = 0
+    return src, dst
+
+
+def solve_or_fail(transformation_type, src, dst):
+    try:
+        leastsquares.estimate(transformation_type, src, dst)
+    except leastsquares.UnderdeterminedProblem:
+        pass
+
+
+def make_request_body(count, seed=0):
+    """Generate the JSON body of a /api/least-squares request."""
+    src, dst = make_points(count, seed)
+    return json.dumps({
+        'transformation_type': 'affine',
+        'landmark_pairs': [
+            {
+                'name': 'landmark {0}'.format(i),
+                'active': True,
+                'source_point': src[i].tolist(),
+                'target_point': dst[i].tolist(),
+            }
+            for i in range(count)
+        ],
+    })
+
+
+def parse_request(schema, body):
+    return schema.load(json.loads(body))
+
+
+def estimate_uncached(transformation_type, src, dst):
+    leastsquares.source_cache.clear()
+    return leastsquares.estimate(transformation_type, src, dst)
+
+
+def benchmark_cases(max_landmarks):
+    """Generate (name, function) pairs for all benchmarks."""
+    for transformation_type in leastsquares.TRANSFORMATION_TYPES:
+        counts = [n for n in LANDMARK_COUNTS
+                  if MINIMUM_LANDMARKS[transformation_type] <= n
+                  <= max_landmarks]
+        for count in counts:
+            src, dst = make_points(count)
+            yield ('estimate/{0}/N={1}'.format(transformation_type, count),
+                   lambda t=transformation_type, s=src, d=dst:
+                   estimate_uncached(t, s, d))
+            yield ('estimate-cached/{0}/N={1}'
+                   .format(transformation_type, count),
+                   lambda t=transformation_type, s=src, d=dst:
+                   leastsquares.estimate(t, s, d))
+        for target_count in TARGET_COUNTS:
+            src, _ = make_points(1000)
+            dsts = np.stack([make_points(1000, seed)[1]
+                             for seed in range(target_count)])
+            yield ('many-targets/{0}/N=1000/K={1}'
+                   .format(transformation_type, target_count),
+                   lambda t=transformation_type, s=src, d=dsts:
+                   (leastsquares.source_cache.clear(),
+                    leastsquares.estimate_many(t, s, d)))
+        for count in [n for n in counts if n <= 10000]:
+            src, dst = make_near_degenerate_points(count)
+            yield ('near-degenerate/{0}/N={1}'
+                   .format(transformation_type, count),
+                   lambda t=transformation_type, s=src, d=dst:
+                   solve_or_fail(t, s, d))
+            src, dst = make_degenerate_points(count)
+            yield ('degenerate/{0}/N={1}'.format(transformation_type, count),
+                   lambda t=transformation_type, s=src, d=dst:
+                   solve_or_fail(t, s, d))
+        for count in [n for n in counts if n >= 10000]:
+            src, dst = make_points(count)
+            yield ('streaming/{0}/N={1}'.format(transformation_type, count),
+                   lambda t=transformation_type, s=src, d=dst:
+                   streaming.estimate(
+                       t, streaming.ChunkedCorrespondences(s, d)))
+        for batch_size in BATCH_SIZES:
+            batch = [make_points(10, seed) for seed in range(batch_size)]
+            yield ('batch/{0}/N=10/batch={1}'
+                   .format(transformation_type, batch_size),
+                   lambda t=transformation_type, b=batch:
+                   [estimate_uncached(t, s, d) for s, d in b])
+            # The same batch, solved in one pass (e.g. a stack of slices)
+            src = np.concatenate([s for s, _ in batch])
+            dst = np.concatenate([d for _, d in batch])
+            groups = np.repeat(np.arange(batch_size), 10)
+            yield ('grouped/{0}/N=10/batch={1}'
+                   .format(transformation_type, batch_size),
+                   lambda t=transformation_type, s=src, d=dst, g=groups:
+                   leastsquares.estimate_grouped(t, s, d, g))
+    for count in [n for n in LANDMARK_COUNTS if n <= max_landmarks]:
+        src, dst = make_points(count)
+        yield ('per_landmark_mismatch/N={0}'.format(count),
+               lambda s=src, d=dst:
+               leastsquares.per_landmark_mismatch(s, d, AFFINE_MATRIX))
+    # Parsing and validation of the request body (used by
+    # linear_voluba.costmodel, which needs the size of the body)
+    from linear_voluba.api import LeastSquaresRequestSchema
+    schema = LeastSquaresRequestSchema()
+    for count in [n for n in PARSE_LANDMARK_COUNTS if n <= max_landmarks]:
+        body = make_request_body(count)
+        yield ('parse/N={0}/bytes={1}'.format(count, len(body)),
+               lambda b=body: parse_request(schema, b))
+
+
+def time_function(func, repeat, min_time=0.05):
+    """Return timing statistics (seconds per call) for func.
+
+    The number of calls per repetition is calibrated so that each repetition
+    lasts at least min_time.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2,
+                     int(number * 1.2 * min_time / max(elapsed, 1e-9)))
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def metadata():
+    return {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def run(args):
+    results = {}
+    for name, func in benchmark_cases(args.max_landmarks):
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = time_function(func, args.repeat, args.min_time)
+        print('{0:<50} {1:12.3e} s'.format(name, results[name]['min']),
+              flush=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'metadata': metadata(), 'results': results}, f,
+                      indent=2, sort_keys=True)
+    return 0
+
+
+def compare_results(baseline, new, threshold=DEFAULT_THRESHOLD):
+    """Compare two sets of results.
+
+    Return a list of (name, baseline_time, new_time, ratio, is_regression)
+    for the benchmarks present in both sets.
+    """
+    comparison = []
+    for name in sorted(set(baseline) & set(new)):
+        old_time = baseline[name]['min']
+        new_time = new[name]['min']
+        ratio = new_time / old_time if old_time > 0 else float('inf')
+        comparison.append((name, old_time, new_time, ratio,
+                           ratio > 1 + threshold))
+    return comparison
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    with open(args.new) as f:
+        new = json.load(f)['results']
+    comparison = compare_results(baseline, new, args.threshold)
+    regressions = 0
+    for name, old_time, new_time, ratio, is_regression in comparison:
+        if is_regression:
+            regressions += 1
+        if is_regression or not args.only_regressions:
+            print('{0:<50} {1:10.3e} {2:10.3e} {3:7.2f}x{4}'.format(
+                name, old_time, new_time, ratio,
+                '  REGRESSION' if is_regression else ''))
+    for name in sorted(set(baseline) - set(new)):
+        print('{0:<50} missing from the new results'.format(name))
+    print('{0} regression(s) beyond {1:.0%} out of {2} benchmarks'
+          .format(regressions, args.threshold, len(comparison)))
+    return 1 if regressions else 0
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--output', '-o',
+                            help='write the results to this JSON file')
+    run_parser.add_argument('--repeat', type=int, default=5,
+                            help='number of repetitions of each timing')
+    run_parser.add_argument('--min-time', type=float, default=0.05,
+                            help='minimum duration of each repetition, in '
+                            'seconds (default: %(default)s)')
+    run_parser.add_argument('--max-landmarks', type=int,
+                            default=LANDMARK_COUNTS[-1],
+                            help='largest number of landmarks to benchmark')
+    run_parser.add_argument('--filter', '-k',
+                            help='only run the benchmarks whose name '
+                            'contains this string')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare results with a baseline')
+    compare_parser.add_argument('baseline', help='baseline JSON results')
+    compare_parser.add_argument('new', help='new JSON results')
+    compare_parser.add_argument('--threshold', type=float,
+                                default=DEFAULT_THRESHOLD,
+                                help='relative slow-down that is reported as '
+                                'a regression (default: %(default)s)')
+    compare_parser.add_argument('--only-regressions', action='store_true',
+                                help='only list the regressions')
+    compare_parser.set_defaults(func=compare)
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_command_line(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,12 +15,14 @@
 # See the Licence for the specific language governing permissions and
 # limitations under the Licence.
 
+import io
+import json
 import logging
 import math
+import os
 
 import flask
 import flask.views
-from flask import json, request
 import flask_smorest
 from flask_smorest import abort
 import marshmallow
@@ -29,7 +31,17 @@ from marshmallow.validate import Length, OneOf, Range
 import numpy
 import numpy as np
 
+from . import costmodel
+from . import icp
 from . import leastsquares
+from . import logconfig
+from . import resample
+from . import resample_jobs
+from . import sessions
+from . import singleflight
+from . import timing
+from . import transforms
+from . import uncertainty
 
 
 logger = logging.getLogger(__name__)
@@ -74,13 +86,7 @@ class LeastSquaresRequestSchema(Schema):
         ordered = True
         unknown = marshmallow.EXCLUDE
     transformation_type = fields.String(
-        validate=OneOf([
-            'rigid',
-            'rigid+reflection',
-            'similarity',
-            'similarity+reflection',
-            'affine',
-        ]),
+        validate=OneOf(leastsquares.TRANSFORMATION_TYPES),
         required=True,
         description='Method to use for estimating the transformation matrix '
                     '(see the documentation of `/api/least-squares`).',
@@ -177,6 +183,53 @@ class ErrorResponseSchema(Schema):
     errors = fields.Dict(keys=fields.String(), required=False)
 
 
+class LeastSquaresQuerySchema(Schema):
+    compact = fields.Boolean(
+        missing=False,
+        description='Send a compact response (see below).',
+    )
+    significant_digits = fields.Integer(
+        validate=Range(min=1, max=17),
+        description='Round the numbers of a compact response to this number '
+                    'of significant digits (by default, they are sent with '
+                    'full precision).',
+    )
+
+
+def _json_array(array, significant_digits=None):
+    """Serialize an array of finite floats as (nested) JSON arrays."""
+    array = np.asarray(array, dtype=float)
+    if significant_digits is None:
+        return json.dumps(array.tolist())
+    number_format = '%.{0}g'.format(significant_digits)
+    if array.ndim == 0:
+        return number_format % array
+    if array.ndim == 1:
+        return '[{0}]'.format(','.join([number_format % value
+                                        for value in array.tolist()]))
+    return '[{0}]'.format(','.join(_json_array(row, significant_digits)
+                                   for row in array))
+
+
+def _solve(transformation_type, source_points, target_points, active):
+    """Compute the matrix, its inverse, and the mismatches of the points.
+
+    The matrix is estimated from the active pairs, the mismatches are
+    computed for all pairs.
+    """
+    mat = leastsquares.estimate(transformation_type,
+                                source_points[active], target_points[active])
+    timing.lap('solve')
+
+    inv_mat = np.linalg.inv(mat)
+    timing.lap('invert')
+
+    mismatches = leastsquares.per_landmark_mismatch(
+        source_points, target_points, mat)
+    timing.lap('mismatch')
+    return mat, inv_mat, mismatches
+
+
 @bp.route('/least-squares')
 class LeastSquaresAPI(flask.views.MethodView):
     @bp.arguments(LeastSquaresRequestSchema, location='json',
@@ -207,9 +260,16 @@ class LeastSquaresAPI(flask.views.MethodView):
                  code=400,
                  example={'message': 'cannot compute least-squares solution '
                                      '(singular matrix?)'})
+    @bp.response(ErrorResponseSchema, code=413,
+                 description='The processing of the request would exceed '
+                             'the budget of the server')
     # Code 422 is raised by webargs for request validation errors
     @bp.response(ErrorResponseSchema,
                  code=422, description='Semantically invalid request')
+    @bp.arguments(LeastSquaresQuerySchema, location='query')
+    @bp.response(ErrorResponseSchema, code=504,
+                 description='The request cannot be processed within the '
+                             'time sent in the X-Request-Timeout header')
     # The successful response must be the last response decorator, its schema
     # is used for serializing the response.
     @bp.response(LeastSquaresResponseSchema,
@@ -254,7 +314,7 @@ class LeastSquaresAPI(flask.views.MethodView):
                          },
                      ],
                  })
-    def post(self, args):
+    def post(self, args, query_args):
         """Calculate an affine transformation matrix from a set of landmarks.
 
         This endpoint calculates an affine transformation matrix that maps a 3D
@@ -295,57 +355,1234 @@ class LeastSquaresAPI(flask.views.MethodView):
         - 4 points are needed for `rigid+reflection`, `similarity+reflection`,
           and `affine`.
 
+        ### Compact response
+
+        With the `compact` query parameter, the landmark pairs are not sent
+        back: the response only contains `transformation_matrix`,
+        `inverse_matrix`, `RMSE`, and `mismatches`, the list of the `mismatch`
+        values of all landmark pairs, in the order of the request. The numbers
+        of a compact response can be rounded to `significant_digits`, which
+        makes the response smaller and faster to serialize and parse.
+
+        ### Time limits
+
+        Requests whose processing is predicted to exceed the budget of the
+        server are rejected with a 413 code, before the estimation or even
+        before the request body is read. Clients can also send the maximum
+        time they are willing to wait, in seconds, in the `X-Request-Timeout`
+        header: requests that cannot be processed within that time are
+        rejected early with a 504 code.
+
         """
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug('Received request on /api/least-squares: %s',
-                         json.dumps(request.json))
+        logconfig.log_request_payload(
+            logger, 'Received request on /api/least-squares: %s')
         transformation_type = args['transformation_type']
         landmark_pairs = args['landmark_pairs']
+        compact = query_args['compact']
+        significant_digits = query_args.get('significant_digits')
+        if significant_digits is not None and not compact:
+            abort(422, message='significant_digits can only be used for a '
+                               'compact response')
         source_points = np.array([pair['source_point']
-                                  for pair in landmark_pairs
-                                  if pair['active']])
+                                  for pair in landmark_pairs]).reshape(-1, 3)
         target_points = np.array([pair['target_point']
-                                  for pair in landmark_pairs
-                                  if pair['active']])
+                                  for pair in landmark_pairs]).reshape(-1, 3)
+        active = np.array([pair['active'] for pair in landmark_pairs],
+                          dtype=bool)
+        timing.annotate(transformation_type=transformation_type,
+                        landmark_count=len(landmark_pairs))
+        timing.lap('validate')
+        costmodel.check_request(transformation_type, len(landmark_pairs))
 
+        def solve():
+            return _solve(transformation_type, source_points, target_points,
+                          active)
+        flight = singleflight.get_single_flight(flask.current_app)
         try:
-            if transformation_type == 'rigid':
-                mat = leastsquares.extended_umeyama(
-                    source_points, target_points,
-                    estimate_scale=False, allow_reflection=False
-                )
-            elif transformation_type == 'rigid+reflection':
-                mat = leastsquares.extended_umeyama(
-                    source_points, target_points,
-                    estimate_scale=False, allow_reflection=True
-                )
-            elif transformation_type == 'similarity':
-                mat = leastsquares.extended_umeyama(
-                    source_points, target_points,
-                    estimate_scale=True, allow_reflection=False
-                )
-            elif transformation_type == 'similarity+reflection':
-                mat = leastsquares.extended_umeyama(
-                    source_points, target_points,
-                    estimate_scale=True, allow_reflection=True
-                )
-            elif transformation_type == 'affine':
-                mat = leastsquares.affine(source_points, target_points)
+            if flight is None:
+                mat, inv_mat, mismatches = solve()
+            else:
+                # Identical concurrent requests wait for the first one
+                key = leastsquares.hash_key(transformation_type,
+                                            source_points, target_points,
+                                            active)
+                (mat, inv_mat, mismatches), shared = flight.do(key, solve)
+                if shared:
+                    timing.lap('wait')
         except leastsquares.UnderdeterminedProblem as exc:
             abort(400, message=str(exc))
 
-        inv_mat = np.linalg.inv(mat)
+        rmse = math.sqrt(np.mean(mismatches ** 2))
+        assert np.all(np.isfinite(mat)) and np.all(np.isfinite(inv_mat))
+
+        if compact:
+            # Serialized directly, bypassing the response schema
+            body = ('{{"transformation_matrix":{0},"inverse_matrix":{1},'
+                    '"RMSE":{2},"mismatches":{3}}}').format(
+                        _json_array(mat, significant_digits),
+                        _json_array(inv_mat, significant_digits),
+                        _json_array(rmse, significant_digits),
+                        _json_array(mismatches, significant_digits))
+            return flask.current_app.response_class(
+                body, mimetype='application/json')
 
-        mismatches = leastsquares.per_landmark_mismatch(
-            source_points, target_points, mat)
         for pair, mismatch in zip(landmark_pairs, mismatches):
             pair['mismatch'] = mismatch
-        rmse = math.sqrt(np.mean(mismatches ** 2))
-
-        assert np.all(np.isfinite(mat)) and np.all(np.isfinite(inv_mat))
         return {
             'transformation_matrix': mat,
             'inverse_matrix': inv_mat,
             'landmark_pairs': landmark_pairs,
             'RMSE': rmse,
         }
+
+
+class SessionLandmarkPairSchema(Schema):
+    class Meta:
+        ordered = True
+        unknown = marshmallow.EXCLUDE
+    index = fields.Integer(
+        validate=Range(min=0), required=True,
+        description='Position of the landmark pair in the session. Use the '
+                    'positions that follow the last pair to add new pairs.',
+    )
+    source_point = fields.List(
+        fields.Float, validate=Length(equal=3),
+        description='Coordinates of the point in source space (required for '
+                    'a new pair).',
+    )
+    target_point = fields.List(
+        fields.Float, validate=Length(equal=3),
+        description='Coordinates of the point in target space (required for '
+                    'a new pair).',
+    )
+    active = fields.Boolean(
+        description='Landmark pairs for which active is false are not used '
+                    'for the estimation of the transformation matrix (true '
+                    'by default for a new pair).',
+    )
+
+
+class SessionUpdateRequestSchema(Schema):
+    class Meta:
+        ordered = True
+        unknown = marshmallow.EXCLUDE
+    transformation_type = fields.String(
+        validate=OneOf(leastsquares.TRANSFORMATION_TYPES),
+        description='New method to use for estimating the transformation '
+                    'matrix.',
+    )
+    removed = fields.List(
+        fields.Integer(validate=Range(min=0)), missing=list,
+        description='Positions of the landmark pairs to remove (before the '
+                    'update). The following pairs are shifted to fill the '
+                    'gaps.',
+    )
+    landmark_pairs = fields.Nested(
+        SessionLandmarkPairSchema,
+        many=True, unknown=marshmallow.EXCLUDE, missing=list,
+        description='Landmark pairs to change or add (the positions refer to '
+                    'the pairs after the removals). Fields that are omitted '
+                    'keep their previous value.',
+    )
+
+
+class SessionUpdateQuerySchema(Schema):
+    defer = fields.Boolean(
+        missing=False,
+        description='Only record the update, and push the new solution on '
+                    'the event stream of the session.',
+    )
+
+
+class SessionUpdateAcceptedSchema(Schema):
+    class Meta:
+        ordered = True
+    session_id = fields.String(required=True)
+    version = fields.Integer(required=True)
+    landmark_count = fields.Integer(required=True)
+
+
+class MismatchSchema(Schema):
+    class Meta:
+        ordered = True
+    index = fields.Integer(required=True)
+    mismatch = fields.Float(
+        validate=Range(min_inclusive=0.0), required=True,
+        description='Euclidean distance, in the target space, between the '
+                    'target point and the transformed source point.',
+    )
+
+
+class SessionResponseSchema(Schema):
+    class Meta:
+        ordered = True
+    session_id = fields.String(required=True)
+    version = fields.Integer(
+        required=True,
+        description='Number of updates that the session has received. It is '
+                    'also the `id` of the corresponding Server-Sent Event.',
+    )
+    transformation_type = fields.String(required=True)
+    landmark_count = fields.Integer(
+        required=True,
+        description='Number of landmark pairs in the session (including '
+                    'pairs for which `active` is false).',
+    )
+    transformation_matrix = TransformationMatrixField(
+        required=True, allow_none=True,
+        description='Transformation matrix from source space to target '
+                    'space, or null if the problem is underdetermined.',
+    )
+    inverse_matrix = TransformationMatrixField(
+        required=True, allow_none=True,
+        description='Transformation matrix from target space to source '
+                    'space, or null if the problem is underdetermined.',
+    )
+    RMSE = fields.Float(
+        validate=Range(min_inclusive=0.0), required=True, allow_none=True,
+        description='Root mean square of the mismatches of all landmark '
+                    'pairs (including those for which `active` is false).',
+    )
+    mismatches = fields.Nested(
+        MismatchSchema, many=True, required=True,
+        description='Mismatches of the landmark pairs: all pairs when the '
+                    'session is created, only those that have changed after '
+                    'an update.',
+    )
+    message = fields.String(
+        description='Reason why the transformation matrix cannot be '
+                    'estimated.',
+    )
+
+
+def _session_response(session, indices):
+    response = {
+        'session_id': session.id,
+        'version': session.version,
+        'transformation_type': session.transformation_type,
+        'landmark_count': session.landmark_count,
+        'transformation_matrix': session.transformation_matrix,
+        'inverse_matrix': session.inverse_matrix,
+        'RMSE': session.rmse,
+        'mismatches': [
+            {'index': int(index), 'mismatch': mismatch}
+            for index, mismatch in zip(indices,
+                                       session.mismatches[indices].tolist())
+        ],
+    }
+    if session.message is not None:
+        response['message'] = session.message
+    return response
+
+
+def _update_session(session, defer=False, **kwargs):
+    config = flask.current_app.config
+    try:
+        session.apply(max_landmarks=config['SESSION_MAX_LANDMARKS'],
+                      **kwargs)
+    except sessions.TooManyLandmarks as exc:
+        abort(413, message=str(exc))
+    except sessions.InvalidUpdate as exc:
+        abort(422, message=str(exc))
+    if defer:
+        return None
+    indices = session.refresh(config['SESSION_MISMATCH_TOLERANCE'])
+    timing.lap('solve')
+    return indices
+
+
+def _serialize_session(session, indices):
+    return SessionResponseSchema().dumps(_session_response(session, indices))
+
+
+def _abort_unknown_session():
+    abort(404, message='unknown or expired session, create a new one')
+
+
+@bp.route('/sessions')
+class SessionsAPI(flask.views.MethodView):
+    @bp.arguments(LeastSquaresRequestSchema, location='json')
+    @bp.response(ErrorResponseSchema,
+                 code=413, description='Too many landmark pairs')
+    @bp.response(ErrorResponseSchema,
+                 code=422, description='Semantically invalid request')
+    @bp.response(SessionResponseSchema, code=201)
+    def post(self, args):
+        """Create a registration session.
+
+        A session keeps the landmark pairs on the server, so that later
+        changes can be sent with `PATCH /api/sessions/{session_id}/landmarks`
+        without sending the whole list of landmark pairs. The request is the
+        same as for `/api/least-squares`, but an underdetermined problem is
+        not an error: the matrices are null and `message` explains why.
+
+        Sessions are kept for a limited time after their last use (30
+        minutes by default). Clients must be prepared to receive a 404
+        response, and then create a new session.
+        """
+        landmark_pairs = args['landmark_pairs']
+        timing.annotate(transformation_type=args['transformation_type'],
+                        landmark_count=len(landmark_pairs))
+        timing.lap('validate')
+        costmodel.check_request(args['transformation_type'],
+                                len(landmark_pairs))
+        store = sessions.get_store()
+        session = store.create(args['transformation_type'])
+        indices = _update_session(session, landmark_pairs=[
+            dict(pair, index=index)
+            for index, pair in enumerate(landmark_pairs)
+        ])
+        store.save(session)
+        store.enforce_limits()
+        return _session_response(session, indices)
+
+
+@bp.route('/sessions/<session_id>')
+class SessionAPI(flask.views.MethodView):
+    @bp.response(ErrorResponseSchema, code=404)
+    @bp.response(code=204)
+    def delete(self, session_id):
+        """Delete a registration session."""
+        if not sessions.get_store().delete(session_id):
+            abort(404, message='unknown or expired session')
+
+
+@bp.route('/sessions/<session_id>/landmarks')
+class SessionLandmarksAPI(flask.views.MethodView):
+    @bp.arguments(SessionUpdateRequestSchema, location='json',
+                  example={
+                      'removed': [2],
+                      'landmark_pairs': [
+                          {'index': 0, 'target_point': [10, 10, 11]},
+                          {'index': 1, 'active': False},
+                          {
+                              'index': 3,
+                              'source_point': [0, 0, 1],
+                              'target_point': [10, 10, 8],
+                          },
+                      ],
+                  })
+    @bp.arguments(SessionUpdateQuerySchema, location='query')
+    @bp.response(SessionUpdateAcceptedSchema, code=202,
+                 description='The update is accepted and its result will be '
+                             'pushed on the event stream (`defer=true`)')
+    @bp.response(ErrorResponseSchema, code=404)
+    @bp.response(ErrorResponseSchema,
+                 code=413, description='Too many landmark pairs')
+    @bp.response(ErrorResponseSchema,
+                 code=422, description='Semantically invalid request')
+    @bp.response(SessionResponseSchema)
+    def patch(self, args, query_args, session_id):
+        """Change the landmark pairs of a registration session.
+
+        Only the pairs that change need to be sent: removals are applied
+        first, then the pairs of `landmark_pairs` are changed (or added at
+        the end of the list). The response contains the new matrices, and
+        the mismatches of the pairs that were changed or whose mismatch has
+        changed.
+
+        With `defer=true`, the update is only recorded and the response is
+        sent immediately (code 202): the new solution is pushed on the
+        event stream of the session (`/api/sessions/{session_id}/events`),
+        or sent as the first event of the next stream if none is open.
+        """
+        store = sessions.get_store()
+        # The session is stored before the response is sent, where the
+        # streams of all processes can see the update
+        with store.checkout(session_id) as session:
+            if session is None:
+                _abort_unknown_session()
+            timing.annotate(
+                transformation_type=(args.get('transformation_type')
+                                     or session.transformation_type),
+                landmark_count=session.landmark_count)
+            timing.lap('validate')
+            indices = _update_session(
+                session,
+                defer=query_args['defer'],
+                landmark_pairs=args['landmark_pairs'],
+                removed=args['removed'],
+                transformation_type=args.get('transformation_type'))
+            if indices is None:
+                response = SessionUpdateAcceptedSchema().dump({
+                    'session_id': session.id,
+                    'version': session.version,
+                    'landmark_count': session.landmark_count,
+                })
+            else:
+                response = _session_response(session, indices)
+        store.enforce_limits()
+        if indices is None:
+            return flask.jsonify(response), 202
+        return response
+
+
+@bp.route('/sessions/<session_id>/events')
+class SessionEventsAPI(flask.views.MethodView):
+    @bp.doc(responses={
+        '200': {
+            'description': 'Stream of Server-Sent Events of type `result`, '
+                           'whose data has the same format as the response '
+                           'of `PATCH /api/sessions/{session_id}/landmarks`.',
+            'content': {'text/event-stream': {}},
+        },
+    })
+    @bp.response(ErrorResponseSchema, code=404)
+    def get(self, session_id):
+        """Follow the solutions of a registration session.
+
+        This endpoint streams [Server-Sent
+        Events](https://html.spec.whatwg.org/multipage/server-sent-events.html)
+        (use an `EventSource` in a web browser). The first event contains the
+        current solution with all mismatches, then an event is pushed after
+        the session is updated, with the mismatches that have changed.
+
+        Updates sent with `defer=true` to `PATCH
+        /api/sessions/{session_id}/landmarks` are coalesced: if several
+        updates arrive while a solution is being computed, only the solution
+        of the latest update is computed and pushed. Only one stream can
+        follow a session at a time, opening a new stream closes the previous
+        one.
+        """
+        store = sessions.get_store()
+        if store.read_header(session_id) is None:
+            _abort_unknown_session()
+        config = flask.current_app.config
+        stream = sessions.event_stream(
+            store, session_id, _serialize_session,
+            mismatch_tolerance=config['SESSION_MISMATCH_TOLERANCE'],
+            keepalive=config['SESSION_EVENTS_KEEPALIVE'],
+            max_duration=config['SESSION_EVENTS_MAX_DURATION'],
+            poll_interval=config['SESSION_EVENTS_POLL_INTERVAL'],
+        )
+        response = flask.current_app.response_class(
+            stream, mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # Disable the response buffering of nginx
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class ResampleRequestSchema(Schema):
+    class Meta:
+        ordered = True
+        unknown = marshmallow.EXCLUDE
+    source_image = fields.String(
+        required=True,
+        description='Path of the source volume, relative to the data '
+                    'directory (.nii, or .npy).',
+    )
+    target_image = fields.String(
+        required=True,
+        description='Path of the volume that defines the target grid, '
+                    'relative to the data directory.',
+    )
+    output_image = fields.String(
+        required=True,
+        description='Path of the output volume, relative to the data '
+                    'directory (.nii or .npy). It must not exist.',
+    )
+    transformation_matrix = TransformationMatrixField(
+        required=True,
+        description='Transformation matrix from source space to target '
+                    'space (as returned by `/api/least-squares`).',
+    )
+    interpolation = fields.String(
+        validate=OneOf(resample.INTERPOLATIONS), missing='linear',
+    )
+
+
+class ResampleJobSchema(Schema):
+    class Meta:
+        ordered = True
+    job_id = fields.String(required=True)
+    status = fields.String(
+        required=True,
+        validate=OneOf([resample_jobs.RUNNING, resample_jobs.DONE,
+                        resample_jobs.FAILED]),
+    )
+    output_image = fields.String(required=True)
+    message = fields.String(description='Reason of the failure of the job.')
+    shape = fields.List(fields.Integer)
+    dtype = fields.String()
+    affine = TransformationMatrixField(
+        description='Matrix from the voxel indices of the output volume to '
+                    'the physical coordinates of the target space.',
+    )
+
+
+def _resample_job_response(job):
+    response = dict(job, output_image=job['request']['output_image'])
+    del response['request']
+    response.pop('finished', None)
+    return response
+
+
+@bp.route('/resample')
+class ResampleAPI(flask.views.MethodView):
+    @bp.arguments(ResampleRequestSchema, location='json')
+    @bp.response(ErrorResponseSchema, code=404,
+                 description='Resampling is not enabled on this server')
+    @bp.response(ErrorResponseSchema,
+                 code=413, description='The output volume is too large')
+    @bp.response(ErrorResponseSchema,
+                 code=422, description='Semantically invalid request')
+    @bp.response(ErrorResponseSchema, code=503,
+                 description='Too many resampling jobs are running')
+    @bp.response(ResampleJobSchema, code=202)
+    def post(self, args):
+        """Resample a volume of the data directory into a target grid.
+
+        This endpoint is only available on servers that are configured with
+        a data directory (`RESAMPLE_DATA_DIRECTORY`), and all paths are
+        relative to that directory. The resampling runs in the background:
+        the response describes the job, whose status is then polled at
+        `/api/resample/{job_id}` (the `Location` of the response) until it
+        is `done` or `failed`. The output volume only appears under its
+        name once it is complete.
+        """
+        config = flask.current_app.config
+        data_directory = config.get('RESAMPLE_DATA_DIRECTORY')
+        if not data_directory:
+            abort(404, message='resampling is not enabled on this server')
+        try:
+            source_path, target_path, output_path = [
+                resample.resolve_data_path(data_directory, args[key])
+                for key in ('source_image', 'target_image', 'output_image')
+            ]
+            # Checked again by the job, which never replaces an existing file
+            if os.path.lexists(output_path):
+                raise ValueError('{0} already exists'
+                                 .format(args['output_image']))
+            resample.open_volume(source_path)
+            target = resample.open_volume(target_path)
+        except (OSError, ValueError) as exc:
+            abort(422, message=str(exc))
+        voxel_count = int(np.prod(target.shape, dtype=np.int64))
+        if voxel_count > config['RESAMPLE_MAX_VOXELS']:
+            abort(413, message='the target grid has too many voxels '
+                  '(maximum {0})'.format(config['RESAMPLE_MAX_VOXELS']))
+        timing.lap('validate')
+        store = resample_jobs.get_store()
+        try:
+            job = store.submit({
+                'source_path': source_path,
+                'target_path': target_path,
+                'output_path': output_path,
+                'output_image': args['output_image'],
+                'transformation_matrix':
+                    np.asarray(args['transformation_matrix']).tolist(),
+                'interpolation': args['interpolation'],
+                'workers': config['RESAMPLE_WORKERS'],
+            }, max_running=config['RESAMPLE_MAX_RUNNING_JOBS'])
+        except resample_jobs.TooManyJobs:
+            abort(503, message='too many resampling jobs are running, '
+                  'please retry later')
+        timing.lap('submit')
+        return _resample_job_response(job), {
+            'Location': flask.url_for('api.ResampleJobAPI',
+                                      job_id=job['job_id']),
+        }
+
+
+@bp.route('/resample/<job_id>')
+class ResampleJobAPI(flask.views.MethodView):
+    @bp.response(ErrorResponseSchema, code=404,
+                 description='Unknown or expired job')
+    @bp.response(ResampleJobSchema)
+    def get(self, job_id):
+        """Get the status of a resampling job.
+
+        Once the job is `done`, the response describes the output volume.
+        """
+        if not flask.current_app.config.get('RESAMPLE_DATA_DIRECTORY'):
+            abort(404, message='resampling is not enabled on this server')
+        job = resample_jobs.get_store().get(job_id)
+        if job is None:
+            abort(404, message='unknown or expired job')
+        return _resample_job_response(job)
+
+
+class CompositionStepSchema(Schema):
+    class Meta:
+        ordered = True
+        unknown = marshmallow.EXCLUDE
+    matrix = TransformationMatrixField(
+        required=True,
+        description='Matrix of the transformation applied at this step.',
+    )
+    invert = fields.Boolean(
+        missing=False,
+        description='Apply the inverse of `matrix` at this step.',
+    )
+
+
+class ComposeRequestSchema(Schema):
+    class Meta:
+        ordered = True
+        unknown = marshmallow.EXCLUDE
+    steps = fields.Nested(
+        CompositionStepSchema,
+        many=True, unknown=marshmallow.EXCLUDE, required=True,
+        validate=Length(min=1),
+        description='Transformations in the order in which they are applied '
+                    '(e.g. section to block, then block to reference).',
+    )
+    points = fields.List(
+        fields.List(fields.Float, validate=Length(equal=3)),
+        description='Optional list of points to transform by the composed '
+                    'transformation.',
+    )
+
+
+class ComposeResponseSchema(Schema):
+    class Meta:
+        ordered = True
+    transformation_matrix = TransformationMatrixField(
+        required=True,
+        description='Composed transformation matrix.',
+    )
+    inverse_matrix = TransformationMatrixField(
+        required=True,
+        description='Inverse of the composed transformation matrix.',
+    )
+    points = fields.List(
+        fields.List(fields.Float),
+        description='The transformed points (if points were sent).',
+    )
+
+
+@bp.route('/compose')
+class ComposeAPI(flask.views.MethodView):
+    @bp.arguments(ComposeRequestSchema, location='json',
+                  example={
+                      'steps': [
+                          {'matrix': [[2, 0, 0, 0],
+                                      [0, 2, 0, 0],
+                                      [0, 0, 2, 0],
+                                      [0, 0, 0, 1]]},
+                          {'matrix': [[1, 0, 0, 10],
+                                      [0, 1, 0, 0],
+                                      [0, 0, 1, 0],
+                                      [0, 0, 0, 1]],
+                           'invert': True},
+                      ],
+                      'points': [[1, 2, 3]],
+                  })
+    @bp.response(ErrorResponseSchema,
+                 code=400, example={'message': 'the matrix is not invertible'})
+    @bp.response(ErrorResponseSchema,
+                 code=422, description='Semantically invalid request')
+    @bp.response(ComposeResponseSchema,
+                 example={
+                     'transformation_matrix': [[2, 0, 0, -10],
+                                               [0, 2, 0, 0],
+                                               [0, 0, 2, 0],
+                                               [0, 0, 0, 1]],
+                     'inverse_matrix': [[0.5, 0, 0, 5],
+                                        [0, 0.5, 0, 0],
+                                        [0, 0, 0.5, 0],
+                                        [0, 0, 0, 1]],
+                     'points': [[-8, 4, 6]],
+                 })
+    def post(self, args):
+        """Compose a chain of transformations, and apply it to points.
+
+        The transformations of `steps` are composed into a single matrix
+        (the first step is applied first), and its inverse. If `points` are
+        sent, they are transformed by the composed matrix.
+        """
+        steps = args['steps']
+        timing.annotate(landmark_count=len(args.get('points', [])))
+        timing.lap('validate')
+        try:
+            mat, inv_mat = transforms.compose(
+                [step['matrix'] for step in steps],
+                [step['invert'] for step in steps])
+        except transforms.SingularMatrix as exc:
+            abort(400, message=str(exc))
+        timing.lap('solve')
+        response = {
+            'transformation_matrix': mat,
+            'inverse_matrix': inv_mat,
+        }
+        if 'points' in args:
+            response['points'] = transforms.apply_transform(
+                mat, args['points']).tolist()
+            timing.lap('transform')
+        return response
+
+
+class TREGridSchema(Schema):
+    class Meta:
+        ordered = True
+        unknown = marshmallow.EXCLUDE
+    shape = fields.List(
+        fields.Integer(validate=Range(min=1)), validate=Length(equal=3),
+        required=True,
+        description='Number of grid points along each axis.',
+    )
+    affine = TransformationMatrixField(
+        description='Matrix from the indices of the grid points to the '
+                    'coordinates of source space.',
+    )
+    bounding_box = fields.List(
+        fields.List(fields.Float, validate=Length(equal=3)),
+        validate=Length(equal=2),
+        description='Opposite corners of the grid, in source space (an '
+                    'alternative to `affine`).',
+    )
+
+
+class TREMapRequestSchema(LeastSquaresRequestSchema):
+    class Meta:
+        ordered = True
+        unknown = marshmallow.EXCLUDE
+    fiducial_localization_error = fields.Float(
+        validate=Range(min=0),
+        description='RMS error on the position of the landmarks (the '
+                    'combined error of a source and target point). By '
+                    'default, it is estimated from the residuals of the '
+                    'fit.',
+    )
+    grid = fields.Nested(
+        TREGridSchema, required=True,
+        description='Grid of source space on which the TRE is predicted.',
+    )
+
+
+def _grid_affine(grid):
+    """Return the voxel-to-space matrix of a grid (see TREGridSchema)."""
+    if ('affine' in grid) == ('bounding_box' in grid):
+        abort(422, message='exactly one of grid.affine and '
+                           'grid.bounding_box must be given')
+    if 'affine' in grid:
+        return grid['affine']
+    return uncertainty.grid_affine_from_bounding_box(grid['bounding_box'],
+                                                     grid['shape'])
+
+
+@bp.route('/tre-map')
+class TREMapAPI(flask.views.MethodView):
+    @bp.arguments(TREMapRequestSchema, location='json')
+    @bp.doc(responses={
+        '200': {
+            'description': 'The TRE map, as a float32 array in the NumPy '
+                           '`.npy` format.',
+            'content': {'application/octet-stream': {}},
+        },
+    })
+    @bp.response(ErrorResponseSchema, code=400,
+                 description='Underdetermined problem')
+    @bp.response(ErrorResponseSchema, code=413,
+                 description='The grid has too many points')
+    @bp.response(ErrorResponseSchema,
+                 code=422, description='Semantically invalid request')
+    def post(self, args):
+        """Predict the target registration error (TRE) on a grid.
+
+        The TRE is the expected distance between the position predicted by
+        the estimated transformation and the true position, due to the
+        errors in the localization of the landmarks. It is predicted from the
+        configuration of the active landmark pairs, with the formula of
+        Fitzpatrick et al. for `rigid` and `similarity` transformations, and
+        from the covariance of the estimated parameters for `affine`.
+
+        The grid is defined in source space by its `shape`, and either its
+        `affine` matrix or its `bounding_box`. The map is returned as a
+        float32 array in the NumPy `.npy` format, and the fiducial
+        localization error that was used is sent in the
+        `X-Fiducial-Localization-Error` header.
+        """
+        config = flask.current_app.config
+        grid = args['grid']
+        shape = tuple(grid['shape'])
+        voxel_count = int(np.prod(shape, dtype=np.int64))
+        if voxel_count > config['TRE_MAX_GRID_VOXELS']:
+            abort(413, message='the grid has too many points (maximum {0})'
+                  .format(config['TRE_MAX_GRID_VOXELS']))
+        grid_affine = _grid_affine(grid)
+        transformation_type = args['transformation_type']
+        active_pairs = [pair for pair in args['landmark_pairs']
+                        if pair['active']]
+        source_points = np.array([pair['source_point']
+                                  for pair in active_pairs]).reshape(-1, 3)
+        target_points = np.array([pair['target_point']
+                                  for pair in active_pairs]).reshape(-1, 3)
+        timing.annotate(transformation_type=transformation_type,
+                        landmark_count=len(active_pairs))
+        timing.lap('validate')
+        try:
+            fle = args.get('fiducial_localization_error')
+            if fle is None:
+                fle = uncertainty.estimate_fle(
+                    transformation_type, source_points, target_points)
+            model = uncertainty.tre_model(transformation_type,
+                                          source_points, fle)
+        except leastsquares.UnderdeterminedProblem as exc:
+            abort(400, message=str(exc))
+        timing.lap('solve')
+        tre = uncertainty.tre_map(model, shape, grid_affine)
+        timing.lap('tre')
+        buffer = io.BytesIO()
+        np.save(buffer, tre)
+        response = flask.current_app.response_class(
+            buffer.getvalue(), mimetype='application/octet-stream')
+        response.headers['X-Fiducial-Localization-Error'] = repr(model.fle)
+        return response
+
+
+class SuggestLandmarksRequestSchema(LeastSquaresRequestSchema):
+    class Meta:
+        ordered = True
+        unknown = marshmallow.EXCLUDE
+    criterion = fields.String(
+        validate=OneOf(uncertainty.SUGGESTION_CRITERIA), missing='d-optimal',
+        description='`d-optimal` ranks the candidates by the information '
+                    'that they add on the parameters of the transformation, '
+                    '`max-tre` by the maximum TRE on the bounding box of the '
+                    'candidates after adding them.',
+    )
+    candidates = fields.List(
+        fields.List(fields.Float, validate=Length(equal=3)),
+        validate=Length(min=1),
+        description='Candidate positions, in source space.',
+    )
+    grid = fields.Nested(
+        TREGridSchema,
+        description='Grid of candidate positions (an alternative to '
+                    '`candidates`).',
+    )
+    count = fields.Integer(
+        validate=Range(min=1, max=1000), missing=10,
+        description='Number of suggestions to return.',
+    )
+    fiducial_localization_error = fields.Float(
+        validate=Range(min=0),
+        description='RMS error on the position of the landmarks, used for '
+                    'the `max-tre` criterion (estimated from the residuals '
+                    'of the fit by default).',
+    )
+
+
+class SuggestionSchema(Schema):
+    class Meta:
+        ordered = True
+    source_point = fields.List(fields.Float, required=True)
+    score = fields.Float(required=True)
+
+
+class SuggestLandmarksResponseSchema(Schema):
+    class Meta:
+        ordered = True
+    criterion = fields.String(required=True)
+    current_score = fields.Float(
+        required=True,
+        description='Score of the current landmarks (0 for `d-optimal`, '
+                    'the current maximum TRE for `max-tre`).',
+    )
+    fiducial_localization_error = fields.Float(allow_none=True)
+    suggestions = fields.Nested(
+        SuggestionSchema, many=True, required=True,
+        description='Best candidates first. The score is the information '
+                    'gain in nats (`d-optimal`, larger is better) or the '
+                    'maximum TRE after adding the landmark (`max-tre`, '
+                    'lower is better).',
+    )
+
+
+@bp.route('/suggest-landmarks')
+class SuggestLandmarksAPI(flask.views.MethodView):
+    @bp.arguments(SuggestLandmarksRequestSchema, location='json')
+    @bp.response(ErrorResponseSchema, code=400,
+                 description='Underdetermined problem')
+    @bp.response(ErrorResponseSchema, code=413,
+                 description='Too many candidates')
+    @bp.response(ErrorResponseSchema,
+                 code=422, description='Semantically invalid request')
+    @bp.response(SuggestLandmarksResponseSchema)
+    def post(self, args):
+        """Suggest where to place the next landmark.
+
+        The candidate positions of source space (sent as a list of
+        `candidates`, or as a `grid`) are ranked by how much a landmark
+        placed there would improve the estimation of a transformation of
+        type `transformation_type`, given the active landmark pairs. The
+        `d-optimal` criterion works with any number of landmark pairs, the
+        `max-tre` criterion needs enough pairs to estimate the
+        transformation.
+        """
+        config = flask.current_app.config
+        if ('candidates' in args) == ('grid' in args):
+            abort(422, message='exactly one of candidates and grid must be '
+                               'given')
+        if 'grid' in args:
+            grid = args['grid']
+            shape = tuple(grid['shape'])
+            candidate_count = int(np.prod(shape, dtype=np.int64))
+        else:
+            candidate_count = len(args['candidates'])
+        if candidate_count > config['SUGGEST_MAX_CANDIDATES']:
+            abort(413, message='too many candidates (maximum {0})'
+                  .format(config['SUGGEST_MAX_CANDIDATES']))
+        if 'grid' in args:
+            grid_affine = _grid_affine(grid)
+            indices = np.indices(shape).reshape(3, -1).T
+            candidates = indices @ grid_affine[:3, :3].T + grid_affine[:3, 3]
+        else:
+            candidates = np.array(args['candidates'],
+                                  dtype=float).reshape(-1, 3)
+        transformation_type = args['transformation_type']
+        criterion = args['criterion']
+        active_pairs = [pair for pair in args['landmark_pairs']
+                        if pair['active']]
+        source_points = np.array([pair['source_point']
+                                  for pair in active_pairs]).reshape(-1, 3)
+        target_points = np.array([pair['target_point']
+                                  for pair in active_pairs]).reshape(-1, 3)
+        timing.annotate(transformation_type=transformation_type,
+                        landmark_count=len(active_pairs))
+        timing.lap('validate')
+        fle = args.get('fiducial_localization_error')
+        try:
+            if criterion == 'max-tre' and fle is None:
+                fle = uncertainty.estimate_fle(
+                    transformation_type, source_points, target_points)
+            best, scores, current = uncertainty.suggest_landmarks(
+                transformation_type, source_points, candidates,
+                count=args['count'], criterion=criterion,
+                fle=1.0 if fle is None else fle)
+        except leastsquares.UnderdeterminedProblem as exc:
+            abort(400, message=str(exc))
+        timing.lap('solve')
+        return {
+            'criterion': criterion,
+            'current_score': current,
+            'fiducial_localization_error': fle,
+            'suggestions': [
+                {'source_point': candidates[index].tolist(), 'score': score}
+                for index, score in zip(best, scores.tolist())
+            ],
+        }
+
+
+class ICPRequestSchema(Schema):
+    class Meta:
+        ordered = True
+        unknown = marshmallow.EXCLUDE
+    transformation_type = fields.String(
+        validate=OneOf(leastsquares.TRANSFORMATION_TYPES),
+        required=True,
+        description='Method to use for estimating the transformation matrix '
+                    '(see the documentation of `/api/least-squares`).',
+    )
+    source_points = fields.List(
+        fields.List(fields.Float, validate=Length(equal=3)), required=True,
+        description='Cloud of points in source space.',
+    )
+    target_points = fields.List(
+        fields.List(fields.Float, validate=Length(equal=3)), required=True,
+        description='Cloud of points in target space (there is no '
+                    'correspondence with the source points).',
+    )
+    initial_matrix = TransformationMatrixField(
+        description='Initial transformation matrix from source space to '
+                    'target space, e.g. estimated by `/api/least-squares` '
+                    'from a few landmarks (identity by default).',
+    )
+    trim_fraction = fields.Float(
+        validate=Range(min=0, max=0.9), missing=0.1,
+        description='Fraction of the worst matches rejected at each '
+                    'iteration.',
+    )
+    max_distance = fields.Float(
+        validate=Range(min=0, min_inclusive=False),
+        description='Matches farther than this distance (in target space) '
+                    'are rejected.',
+    )
+    max_iterations = fields.Integer(
+        validate=Range(min=1, max=1000), missing=50,
+        description='Maximum number of iterations per resolution level.',
+    )
+
+
+class ICPResponseSchema(Schema):
+    class Meta:
+        ordered = True
+    transformation_matrix = TransformationMatrixField(
+        required=True,
+        description='Transformation matrix from source space to target space.',
+    )
+    inverse_matrix = TransformationMatrixField(
+        required=True,
+        description='Transformation matrix from target space to source space.',
+    )
+    RMSE = fields.Float(
+        required=True,
+        description='Root mean square distance of the source points to '
+                    'their matched target points (after rejection).',
+    )
+    inlier_count = fields.Integer(
+        required=True,
+        description='Number of source points that were matched.',
+    )
+    iterations = fields.Integer(required=True)
+    converged = fields.Boolean(required=True)
+
+
+@bp.route('/icp')
+class ICPAPI(flask.views.MethodView):
+    @bp.arguments(ICPRequestSchema, location='json')
+    @bp.response(ErrorResponseSchema, code=400,
+                 description='Underdetermined problem')
+    @bp.response(ErrorResponseSchema, code=413,
+                 description='Too many points')
+    @bp.response(ErrorResponseSchema,
+                 code=422, description='Semantically invalid request')
+    @bp.response(ICPResponseSchema)
+    def post(self, args):
+        """Register two point clouds without correspondences (ICP).
+
+        The Iterative Closest Point algorithm alternates between matching
+        each source point to its nearest target point, and estimating the
+        transformation of type `transformation_type` from these matches.
+        The algorithm only finds the nearest local optimum: the clouds must
+        be roughly aligned, possibly by an `initial_matrix`.
+        """
+        config = flask.current_app.config
+        point_count = max(len(args['source_points']),
+                          len(args['target_points']))
+        if point_count > config['ICP_MAX_POINTS']:
+            abort(413, message='too many points (maximum {0} per cloud)'
+                  .format(config['ICP_MAX_POINTS']))
+        source_points = np.array(args['source_points'],
+                                 dtype=float).reshape(-1, 3)
+        target_points = np.array(args['target_points'],
+                                 dtype=float).reshape(-1, 3)
+        timing.annotate(transformation_type=args['transformation_type'],
+                        landmark_count=point_count)
+        timing.lap('validate')
+        try:
+            result = icp.icp(
+                source_points, target_points, args['transformation_type'],
+                initial_matrix=args.get('initial_matrix'),
+                max_iterations=args['max_iterations'],
+                trim_fraction=args['trim_fraction'],
+                max_distance=args.get('max_distance'),
+                workers=config['ICP_WORKERS'],
+            )
+        except leastsquares.UnderdeterminedProblem as exc:
+            abort(400, message=str(exc))
+        timing.lap('solve')
+        return {
+            'transformation_matrix': result.transformation_matrix,
+            'inverse_matrix': result.inverse_matrix,
+            'RMSE': result.rmse,
+            'inlier_count': result.inlier_count,
+            'iterations': result.iterations,
+            'converged': result.converged,
+        }
+
+
+class SliceLandmarkPairSchema(Schema):
+    class Meta:
+        ordered = True
+    source_point = fields.List(
+        fields.Float, validate=Length(equal=2), required=True,
+        description='Coordinates of the point in the plane of the slice.',
+    )
+    target_point = fields.List(
+        fields.Float, validate=Length(equal=2), required=True,
+        description='Coordinates of the point in the plane of the slice, in '
+                    'target space.',
+    )
+    active = fields.Boolean(
+        default=True, missing=True,
+        description='Landmark pairs for which active is false are not used '
+                    'for the estimation of the transformation matrix.',
+    )
+
+
+class SliceSchema(Schema):
+    class Meta:
+        ordered = True
+    z = fields.Float(
+        required=True,
+        description='Position of the slice along the third axis of the '
+                    'source space.',
+    )
+    target_z = fields.Float(
+        description='Position of the slice along the third axis of the '
+                    'target space (same as `z` by default).',
+    )
+    landmark_pairs = fields.Nested(
+        SliceLandmarkPairSchema,
+        many=True, unknown=marshmallow.EXCLUDE, required=True,
+        description='List of 2D landmark pairs placed on this slice.',
+    )
+
+
+class SliceStackRequestSchema(Schema):
+    class Meta:
+        ordered = True
+        unknown = marshmallow.EXCLUDE
+    transformation_type = fields.String(
+        validate=OneOf(leastsquares.TRANSFORMATION_TYPES),
+        required=True,
+        description='Method to use for estimating the 2D transformation of '
+                    'each slice (see the documentation of '
+                    '`/api/least-squares`).',
+    )
+    slices = fields.Nested(
+        SliceSchema,
+        many=True, unknown=marshmallow.EXCLUDE, required=True,
+        validate=Length(min=1),
+        description='The slices of the stack.',
+    )
+
+
+class SliceTransformationSchema(Schema):
+    class Meta:
+        ordered = True
+    z = fields.Float(required=True)
+    transformation_matrix = TransformationMatrixField(
+        required=True,
+        description='Transformation matrix of the slice, from source space '
+                    'to target space.',
+    )
+    inverse_matrix = TransformationMatrixField(
+        required=True,
+        description='Transformation matrix of the slice, from target space '
+                    'to source space.',
+    )
+    RMSE = fields.Float(
+        validate=Range(min_inclusive=0.0), required=True,
+        description='Root mean square of the 2D mismatches of the landmark '
+                    'pairs of the slice (including those for which `active` '
+                    'is false).',
+    )
+
+
+class SliceStackResponseSchema(Schema):
+    class Meta:
+        ordered = True
+    slices = fields.Nested(
+        SliceTransformationSchema,
+        many=True, required=True,
+        description='The transformation of each slice, in the order of the '
+                    'request.',
+    )
+
+
+@bp.route('/slice-stack')
+class SliceStackAPI(flask.views.MethodView):
+    @bp.arguments(SliceStackRequestSchema, location='json',
+                  example={
+                      'transformation_type': 'rigid',
+                      'slices': [
+                          {
+                              'z': 0,
+                              'landmark_pairs': [
+                                  {'source_point': [0, 0],
+                                   'target_point': [10, 0]},
+                                  {'source_point': [1, 0],
+                                   'target_point': [11, 0]},
+                              ],
+                          },
+                          {
+                              'z': 2,
+                              'landmark_pairs': [
+                                  {'source_point': [0, 0],
+                                   'target_point': [0, 0]},
+                                  {'source_point': [1, 0],
+                                   'target_point': [0, 1]},
+                              ],
+                          },
+                      ],
+                  })
+    @bp.response(ErrorResponseSchema, code=400,
+                 description='Underdetermined problem')
+    @bp.response(ErrorResponseSchema, code=413,
+                 description='Too many landmark pairs')
+    @bp.response(ErrorResponseSchema,
+                 code=422, description='Semantically invalid request')
+    @bp.response(SliceStackResponseSchema)
+    def post(self, args):
+        """Estimate the 2D transformation of each slice of a stack.
+
+        Each slice of `slices` (e.g. a histological section) has its own
+        landmark pairs, in 2D coordinates in the plane of the slice. A 2D
+        transformation of type `transformation_type` is estimated for each
+        slice, all slices being solved together in one batched computation.
+
+        The 2D transformations are returned as 4×4 matrices, which apply to
+        the 3D coordinates of the points of the slice (x, y, `z`), and move
+        the slice to `target_z` (by default, the slice is not moved along the
+        third axis).
+
+        If the problem of any slice is underdetermined (e.g. 2 points are
+        needed for `rigid`, 3 for `affine`), a 400 code is returned, and the
+        message starts with the index of the first such slice (e.g. `problem
+        3: underdetermined problem...`).
+        """
+        config = flask.current_app.config
+        slices = args['slices']
+        pair_counts = [len(slice_['landmark_pairs']) for slice_ in slices]
+        landmark_count = sum(pair_counts)
+        if landmark_count > config['SLICE_STACK_MAX_LANDMARKS']:
+            abort(413, message='too many landmark pairs (maximum {0})'
+                  .format(config['SLICE_STACK_MAX_LANDMARKS']))
+        transformation_type = args['transformation_type']
+        pairs = [pair for slice_ in slices
+                 for pair in slice_['landmark_pairs']]
+        source_points = np.array([pair['source_point'] for pair in pairs],
+                                 dtype=float).reshape(-1, 2)
+        target_points = np.array([pair['target_point'] for pair in pairs],
+                                 dtype=float).reshape(-1, 2)
+        active = np.array([pair['active'] for pair in pairs], dtype=bool)
+        groups = np.repeat(np.arange(len(slices)), pair_counts)
+        z = np.array([slice_['z'] for slice_ in slices])
+        target_z = np.array([slice_.get('target_z', slice_['z'])
+                             for slice_ in slices])
+        timing.annotate(transformation_type=transformation_type,
+                        landmark_count=landmark_count)
+        timing.lap('validate')
+
+        try:
+            matrices = leastsquares.estimate_grouped(
+                transformation_type, source_points[active],
+                target_points[active], groups[active],
+                group_count=len(slices))
+        except leastsquares.UnderdeterminedProblem as exc:
+            abort(400, message=str(exc))
+        timing.lap('solve')
+
+        mat = transforms.embed_slice_transforms(matrices, z, target_z)
+        inv_mat = np.linalg.inv(mat)
+        timing.lap('invert')
+
+        pair_matrices = matrices[groups]
+        transformed = (np.einsum('kij,kj->ki', pair_matrices[:, :2, :2],
+                                 source_points)
+                       + pair_matrices[:, :2, 2])
+        squared_mismatches = np.sum((target_points - transformed) ** 2,
+                                    axis=1)
+        rmse = np.sqrt(
+            np.bincount(groups, weights=squared_mismatches,
+                        minlength=len(slices))
+            / np.maximum(pair_counts, 1))
+        timing.lap('mismatch')
+
+        assert np.all(np.isfinite(mat)) and np.all(np.isfinite(inv_mat))
+        return {
+            'slices': [
+                {
+                    'z': slice_['z'],
+                    'transformation_matrix': mat_k,
+                    'inverse_matrix': inv_mat_k,
+                    'RMSE': rmse_k,
+                }
+                for slice_, mat_k, inv_mat_k, rmse_k
+                in zip(slices, mat, inv_mat, rmse.tolist())
+            ],
+        }
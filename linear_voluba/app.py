@@ -0,0 +1,347 @@
+# Copyright 2017–2019 Forschungszentrum Jülich GmbH
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Flask application factory of the voluba-linear-backend.
+
+This module is imported by :func:`linear_voluba.create_app`, so that the web
+dependencies are not loaded by users of the solver library alone.
+"""
+
+import datetime
+import os
+
+import flask
+
+from . import SOURCE_URL, __version__
+from . import logconfig
+
+
+class DefaultConfig:
+    # Passed as the 'origins' parameter to flask_cors.CORS, see
+    # https://flask-cors.readthedocs.io/en/latest/api.html#flask_cors.CORS
+    CORS_ORIGINS = '*'
+    # Duration that the browser is allowed to cache the results of a CORS
+    # preflight request.
+    CORS_MAX_AGE = datetime.timedelta(minutes=10)
+    # Set to True to enable the /echo endpoint (for debugging)
+    ENABLE_ECHO = False
+    # Set up werkzeug.middleware.proxy_fix.ProxyFix with the provided keyword
+    # arguments, see
+    # https://werkzeug.palletsprojects.com/en/0.15.x/middleware/proxy_fix/
+    PROXY_FIX = None
+    # Set to True to expose Prometheus metrics on /metrics (requires the
+    # prometheus_client package, see linear_voluba.metrics for running under
+    # Gunicorn with several workers)
+    ENABLE_METRICS = False
+    # Set to True to send a Server-Timing header with the duration of each
+    # processing stage (visible in the developer tools of web browsers)
+    SERVER_TIMING = False
+    # Profiling of live requests, see linear_voluba.profiling. Fraction of the
+    # requests that are profiled at random:
+    PROFILING_SAMPLE_RATE = 0.0
+    # Secret key for signing the X-Voluba-Profile request header, which
+    # triggers the profiling of a single request:
+    PROFILING_SECRET = None
+    # Client addresses that can trigger profiling without a signed header:
+    PROFILING_ALLOWED_ADDRESSES = []
+    # Number of profiles kept in the instance folder (the oldest are
+    # removed):
+    PROFILING_MAX_FILES = 100
+    # Logging configuration, see linear_voluba.logconfig. Level of the root
+    # logger (None means the level of Gunicorn's error log, or INFO when not
+    # running under Gunicorn):
+    LOG_LEVEL = None
+    # Levels of specific loggers, e.g. {'linear_voluba.api': 'DEBUG'}:
+    LOG_LEVELS = {}
+    # 'text' or 'json' (one JSON object per line):
+    LOG_FORMAT = 'text'
+    # Fraction of the request payloads that are logged at the DEBUG level,
+    # and maximum number of bytes logged for each payload:
+    DEBUG_PAYLOAD_SAMPLE_RATE = 1.0
+    DEBUG_PAYLOAD_MAX_BYTES = 4096
+    # Run every solver once in create_app, so that numpy and LAPACK are loaded
+    # and warm before /health/ready reports the process as ready
+    WARMUP = True
+    # Size of the BLAS and OpenMP thread pools of each server process: a
+    # number of threads, 'auto' to share the CPU quota of the container
+    # between the WEB_CONCURRENCY workers, or None to leave the library
+    # defaults. This is applied by linear_voluba.wsgi, not by create_app, so
+    # that the tests and scripts keep the settings of their process.
+    BLAS_THREADS = 'auto'
+    # Let identical concurrent requests to /api/least-squares wait for the
+    # result of the first one, see linear_voluba.singleflight:
+    SINGLE_FLIGHT = True
+    # Directory shared by the worker processes, to also deduplicate requests
+    # between processes (e.g. '/dev/shm/voluba-single-flight'):
+    SINGLE_FLIGHT_DIRECTORY = None
+    # Maximum duration (in seconds) for which a request waits for another
+    # process before computing the result itself:
+    SINGLE_FLIGHT_TIMEOUT = 30
+    # Registration sessions (/api/sessions), see linear_voluba.sessions.
+    # Directory where the sessions are stored, shared by the worker processes
+    # (None for the sessions sub-directory of the instance folder). A tmpfs
+    # is faster, e.g. '/dev/shm/voluba-sessions':
+    SESSION_DIRECTORY = None
+    # Duration (in seconds) after which an unused session expires:
+    SESSION_TTL = 30 * 60
+    # Limits on the sessions kept by all processes together, beyond which the
+    # least recently used sessions are evicted:
+    SESSION_MAX_COUNT = 1000
+    SESSION_MAX_TOTAL_LANDMARKS = 1000000
+    # Maximum number of landmark pairs in one session:
+    SESSION_MAX_LANDMARKS = 100000
+    # Mismatches that change by less than this distance (in target space
+    # units) are not sent back to the client after an update. The cached
+    # mismatches of the unchanged pairs are not recomputed while they are
+    # known to be within this distance of their exact values, so a larger
+    # tolerance saves work on large sessions:
+    SESSION_MISMATCH_TOLERANCE = 1e-3
+    # Event streams of the sessions (/api/sessions/<id>/events): interval (in
+    # seconds) between keep-alive comments on an idle stream, and duration
+    # after which a stream is closed (EventSource clients reconnect):
+    SESSION_EVENTS_KEEPALIVE = 15
+    SESSION_EVENTS_MAX_DURATION = 10 * 60
+    # Interval (in seconds) at which a stream checks for the updates of its
+    # session, which may be received by another worker process:
+    SESSION_EVENTS_POLL_INTERVAL = 0.05
+    # Directory containing the volumes that can be resampled by
+    # /api/resample (None disables the endpoint), and number of processes
+    # used for each resampling, see linear_voluba.resample:
+    RESAMPLE_DATA_DIRECTORY = None
+    RESAMPLE_WORKERS = 1
+    # Maximum number of voxels of a volume computed by /api/resample:
+    RESAMPLE_MAX_VOXELS = 1024 ** 3
+    # Each resampling runs as a background job in a separate process, see
+    # linear_voluba.resample_jobs: directory where the records of the jobs
+    # are kept, shared by the worker processes (None for the resample-jobs
+    # sub-directory of the instance folder), maximum number of jobs running
+    # at the same time (in all worker processes together), and duration (in
+    # seconds) for which the result of a finished job is kept:
+    RESAMPLE_JOB_DIRECTORY = None
+    RESAMPLE_MAX_RUNNING_JOBS = 2
+    RESAMPLE_JOB_TTL = 24 * 60 * 60
+    # Maximum number of grid points of a map computed by /api/tre-map (a
+    # 256³ map is sent as 64 MiB of float32):
+    TRE_MAX_GRID_VOXELS = 256 ** 3
+    # Maximum number of candidate positions ranked by
+    # /api/suggest-landmarks:
+    SUGGEST_MAX_CANDIDATES = 10 ** 6
+    # Maximum number of points of each cloud registered by /api/icp, and
+    # number of threads used for its nearest-neighbour queries (-1 for all
+    # CPUs), see linear_voluba.icp. Under the gevent workers of
+    # gunicorn_conf.py, only the KD-tree (SciPy) queries run in parallel:
+    # the threads of the numpy fallback are greenlets:
+    ICP_MAX_POINTS = 10 ** 5
+    ICP_WORKERS = 1
+    # Maximum total number of landmark pairs (over all slices) sent to
+    # /api/slice-stack:
+    SLICE_STACK_MAX_LANDMARKS = 10 ** 6
+    # Maximum predicted processing time (in seconds) of the requests to
+    # /api/least-squares, /api/sessions and /api/icp, beyond which they are
+    # rejected early (None for no limit, clients can still send a shorter
+    # X-Request-Timeout), see linear_voluba.costmodel:
+    REQUEST_COST_BUDGET = None
+    # JSON results of `benchmarks/solvers.py run` measured on the hardware of
+    # the server, from which the cost model is fitted (None to use the
+    # built-in model):
+    COST_MODEL_BENCHMARK = None
+    # Set to True to enable the distributed tracing of the API requests (W3C
+    # Trace Context), see linear_voluba.tracing. Fraction of the requests
+    # that are traced, when the caller has not decided with the sampled flag
+    # of its traceparent header:
+    TRACING = False
+    TRACING_SAMPLE_RATE = 0.01
+    # Maximum number of traces recorded per second by each process, whatever
+    # the sampling decisions (None for no limit):
+    TRACING_MAX_TRACES_PER_SECOND = 10
+    # Where the spans are exported: 'file' (JSON lines appended to
+    # TRACING_FILE, by default traces.jsonl in the instance folder), 'memory'
+    # (see linear_voluba.tracing.InMemoryExporter), or any object with an
+    # export(spans) method:
+    TRACING_EXPORTER = 'file'
+    TRACING_FILE = None
+    # Fraction of the requests to the computational endpoints that are
+    # recorded, anonymised, in the capture sub-directory of the instance
+    # folder for replay by benchmarks/replay.py (0 to disable), see
+    # linear_voluba.capture:
+    CAPTURE_SAMPLE_RATE = 0.0
+    # Standard deviation of the Gaussian noise added to the coordinates of
+    # the captured points (0 to keep them exact):
+    CAPTURE_JITTER = 0.0
+    # Size (in uncompressed bytes) after which a capture file is rotated, and
+    # number of capture files that are kept (by all processes together):
+    CAPTURE_MAX_BYTES = 64 * 2 ** 20
+    CAPTURE_MAX_FILES = 10
+    # Version of the linear_voluba api (used in the OpenAPI spec)
+    API_VERSION = __version__
+    OPENAPI_VERSION = '3.0.2'  # OpenAPI version to generate
+    OPENAPI_URL_PREFIX = '/'
+    OPENAPI_REDOC_PATH = 'redoc'
+    OPENAPI_REDOC_VERSION = '2.0.0-rc.20'
+    OPENAPI_SWAGGER_UI_PATH = 'swagger-ui'
+    OPENAPI_SWAGGER_UI_VERSION = '3.24.2'
+    # Duration (in seconds) for which clients may cache the OpenAPI document
+    # before revalidating it with its ETag
+    OPENAPI_CACHE_MAX_AGE = 24 * 3600
+
+
+def create_app(test_config=None):
+    """Instantiate the voluba-linear-backend Flask application."""
+    app = flask.Flask(__package__,
+                      instance_path=os.environ.get("INSTANCE_PATH"),
+                      instance_relative_config=True)
+    app.config.from_object(DefaultConfig)
+    if test_config is None:
+        # load the instance config, if it exists, when not testing
+        app.config.from_pyfile("config.py", silent=True)
+        app.config.from_envvar("VOLUBA_LINEAR_BACKEND_SETTINGS", silent=True)
+    else:
+        # load the test config if passed in
+        app.config.from_mapping(test_config)
+
+    # logging configuration inspired by
+    # http://flask.pocoo.org/docs/1.0/logging/#basic-configuration
+    if not app.testing:
+        logconfig.configure_logging(app.config)
+    # Hide Kubernetes health probes from the logs
+    logconfig.install_access_log_filter()
+
+    # ensure that the instance folder exists
+    try:
+        os.makedirs(app.instance_path)
+    except OSError:
+        pass
+
+    @app.route("/")
+    def root():
+        return flask.redirect('/redoc')
+
+    @app.route("/source")
+    def source():
+        return flask.redirect(SOURCE_URL)
+
+    # Return success if the process is alive (liveness probe). /health is
+    # kept for the deployments that predate /health/live.
+    @app.route("/health")
+    @app.route("/health/live")
+    def health():
+        return '', 200
+
+    # Readiness probe: fails until the application is warmed up, and when
+    # the worker is shutting down, see linear_voluba.readiness
+    @app.route("/health/ready")
+    def ready():
+        from . import readiness
+        if not readiness.is_ready():
+            return '', 503
+        return '', 200
+
+    if app.config.get('ENABLE_ECHO'):
+        @app.route('/echo')
+        def echo():
+            app.logger.info('ECHO:\n'
+                            'Headers\n'
+                            '=======\n'
+                            '%s', flask.request.headers)
+            return ''
+
+    if app.config.get('ENABLE_METRICS'):
+        from . import metrics
+        metrics.init_app(app)
+
+    if app.config.get('SERVER_TIMING'):
+        from . import timing
+        timing.init_server_timing(app)
+
+    from . import profiling
+    profiling.init_app(app)
+
+    from . import costmodel
+    costmodel.init_app(app)
+
+    # After costmodel, so that the body of a request that is rejected early
+    # is not read for tracing
+    from . import tracing
+    tracing.init_app(app)
+
+    from . import capture
+    capture.init_app(app)
+
+    if app.config.get('CORS_ORIGINS'):
+        import flask_cors
+        flask_cors.CORS(app, origins=app.config['CORS_ORIGINS'],
+                        max_age=app.config['CORS_MAX_AGE'])
+
+    if app.config['ENV'] == 'development':
+        local_server = [
+            {
+                'url': '/',
+            },
+        ]
+    else:
+        local_server = []
+
+    import flask_smorest
+    smorest_api = flask_smorest.Api(app, spec_kwargs={
+        'servers': local_server + [
+            {
+                'url': 'https://voluba-linear-backend.apps.hbp.eu/',
+                'description': 'Production instance running the *master* '
+                               'branch',
+            },
+            {
+                'url': 'https://voluba-linear-backend.apps-dev.hbp.eu/',
+                'description': 'Development instance running the *dev* '
+                               'branch',
+            },
+        ],
+        'info': {
+            'title': 'voluba-linear-backend',
+            'description': '''\
+An HTTP backend for estimating linear spatial transformations from a list of
+point landmarks.
+
+This backend is used by [Voluba](https://voluba.apps.hbp.eu/), a web-based tool
+for interactive registration of 3-dimensional images, dedicated to the
+alignment of sub-volumes into brain templates.
+
+For more information, see the **source code repository:** <{SOURCE_URL}>.
+'''.format(SOURCE_URL=SOURCE_URL),
+            'license': {
+                'name': 'Apache 2.0',
+                'url': 'https://www.apache.org/licenses/LICENSE-2.0.html',
+            },
+        },
+    })
+
+    from . import api
+    smorest_api.register_blueprint(api.bp)
+    from . import openapi
+    openapi.init_app(app, smorest_api)
+
+    if app.config.get('PROXY_FIX'):
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, **app.config['PROXY_FIX'])
+
+    if app.config.get('WARMUP'):
+        from . import leastsquares
+        leastsquares.warm_up()
+
+    from . import readiness
+    readiness.set_ready()
+
+    return app
@@ -0,0 +1,272 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Capture of anonymised production traffic, for replay in benchmarks.
+
+A fraction CAPTURE_SAMPLE_RATE of the requests to the computational
+endpoints (see :data:`CAPTURED_REQUESTS`) is recorded, with the time at
+which it was received, its query string, its JSON body, its status and its
+processing time. The captured traffic is replayed against a local server by
+``benchmarks/replay.py``.
+
+The bodies are anonymised before being written: the free-text strings (names
+and colours of the landmarks...) are dropped, only the enumerated values
+such as ``transformation_type`` are kept. The coordinates of the points can
+also be jittered with Gaussian noise of standard deviation CAPTURE_JITTER,
+at the expense of altering the near-degenerate configurations.
+
+The records are written as JSON lines into gzip-compressed files in the
+``capture`` sub-directory of the instance folder. Each process writes its
+own file, which is rotated after CAPTURE_MAX_BYTES bytes of (uncompressed)
+records; only the CAPTURE_MAX_FILES most recent files are kept. A file is
+named ``*.jsonl.gz.open`` while it is written, and renamed when it is closed:
+only the closed files are removed, so a process never removes the file of
+another. The files left open by a process that was killed are closed at the
+next rotation of another process. The request hook is not installed at all
+if the capture is disabled.
+"""
+
+import atexit
+import glob
+import gzip
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+
+import flask
+
+from . import timing
+
+
+logger = logging.getLogger(__name__)
+
+# (endpoint, method) of the requests that are captured. The other endpoints
+# either refer to server-side state (sessions, image files) that a replay
+# could not reproduce, or do not compute anything.
+CAPTURED_REQUESTS = {
+    ('api.LeastSquaresAPI', 'POST'),
+    ('api.SessionsAPI', 'POST'),
+    ('api.ComposeAPI', 'POST'),
+    ('api.TREMapAPI', 'POST'),
+    ('api.SuggestLandmarksAPI', 'POST'),
+    ('api.ICPAPI', 'POST'),
+    ('api.SliceStackAPI', 'POST'),
+}
+
+# String values that are kept in the captured bodies (all other strings are
+# dropped)
+KEPT_STRING_KEYS = frozenset({'transformation_type', 'criterion'})
+
+# Keys whose values (points or lists of points) are jittered
+COORDINATE_KEYS = frozenset({
+    'source_point', 'target_point', 'source_points', 'target_points',
+    'points', 'candidates',
+})
+
+FILE_PATTERN = 'capture-*.jsonl.gz'
+
+# Suffix of the files that are being written
+OPEN_SUFFIX = '.open'
+
+
+def anonymise(value, jitter=0.0, rng=random, _coordinates=False):
+    """Return a copy of a decoded JSON value, stripped of free text.
+
+    The strings are dropped from the objects (dictionaries), except for the
+    keys listed in KEPT_STRING_KEYS, and from the arrays. If jitter is
+    non-zero, Gaussian noise of this standard deviation is added to the
+    numbers found under the keys listed in COORDINATE_KEYS.
+    """
+    if isinstance(value, dict):
+        return {
+            key: anonymise(item, jitter, rng,
+                           _coordinates or key in COORDINATE_KEYS)
+            for key, item in value.items()
+            if not isinstance(item, str) or key in KEPT_STRING_KEYS
+        }
+    if isinstance(value, list):
+        return [anonymise(item, jitter, rng, _coordinates)
+                for item in value if not isinstance(item, str)]
+    if (_coordinates and jitter and isinstance(value, (int, float))
+            and not isinstance(value, bool)):
+        return value + rng.gauss(0.0, jitter)
+    return value
+
+
+class CaptureWriter:
+    """Append records to rotating gzip-compressed JSON-lines files.
+
+    The compressed stream is flushed after each record, so that the records
+    can be read while the file is still being written (see
+    :func:`read_capture`).
+    """
+
+    def __init__(self, directory, max_bytes, max_files):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._file = None
+        self._path = None
+        self._written = 0
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode(
+            'utf-8')
+        with self._lock:
+            if self._file is None or (
+                    self._written and self._written + len(line)
+                    > self.max_bytes):
+                self._rotate()
+            self._file.write(line)
+            # A sync flush keeps the compression history, unlike a full flush
+            self._file.flush(zlib.Z_SYNC_FLUSH)
+            self._written += len(line)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.replace(self._path + OPEN_SUFFIX, self._path)
+
+    def _rotate(self):
+        self._close()
+        os.makedirs(self.directory, exist_ok=True)
+        self._path = os.path.join(self.directory, FILE_PATTERN.replace(
+            '*', '{0}-{1}-{2}'.format(time.strftime('%Y%m%dT%H%M%S'),
+                                      os.getpid(), next(self._counter))))
+        self._file = gzip.open(self._path + OPEN_SUFFIX, 'wb')
+        self._written = 0
+        self._prune()
+
+    def _prune(self):
+        # Close the files of the processes that were killed
+        for path in glob.glob(os.path.join(self.directory,
+                                           FILE_PATTERN + OPEN_SUFFIX)):
+            if not _process_exists(_writer_pid(path)):
+                try:
+                    os.replace(path, path[:-len(OPEN_SUFFIX)])
+                except OSError:
+                    pass
+        # The closed files are shared with the other processes, which may
+        # remove them concurrently
+        paths = []
+        for path in glob.glob(os.path.join(self.directory, FILE_PATTERN)):
+            try:
+                paths.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        paths.sort(reverse=True)
+        # The files being written count towards max_files
+        open_count = len(glob.glob(os.path.join(
+            self.directory, FILE_PATTERN + OPEN_SUFFIX)))
+        for _, path in paths[max(self.max_files - open_count, 0):]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _writer_pid(path):
+    """Return the PID of the process that wrote a capture file, or None."""
+    # capture-<time>-<pid>-<counter>.jsonl.gz[.open]
+    try:
+        return int(os.path.basename(path).split('-')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def _process_exists(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_capture(paths):
+    """Yield the records of capture files, in the order of the files.
+
+    A file that is truncated (e.g. still being written, see OPEN_SUFFIX) is
+    read up to its last complete record.
+    """
+    for path in paths:
+        with gzip.open(path, 'rb') as f:
+            try:
+                for line in f:
+                    if line.endswith(b'\n'):
+                        yield json.loads(line.decode('utf-8'))
+            except EOFError:
+                pass
+
+
+class RequestCapture:
+    def __init__(self, app):
+        self.sample_rate = app.config.get('CAPTURE_SAMPLE_RATE') or 0.0
+        self.jitter = app.config.get('CAPTURE_JITTER') or 0.0
+        self.writer = CaptureWriter(
+            os.path.join(app.instance_path, 'capture'),
+            app.config.get('CAPTURE_MAX_BYTES') or 64 * 2 ** 20,
+            app.config.get('CAPTURE_MAX_FILES') or 10)
+
+    def finish(self, response, timings):
+        request = flask.request
+        if ((request.endpoint, request.method) not in CAPTURED_REQUESTS
+                # The body of a request rejected as too large was not read
+                or response.status_code == 413
+                or random.random() >= self.sample_rate):
+            return
+        try:
+            body = json.loads(request.get_data(cache=True).decode('utf-8'))
+        except ValueError:
+            return
+        duration = timings.total_ns * 1e-9
+        record = {
+            'time': time.time() - duration,
+            'method': request.method,
+            'path': request.path,
+            'query': request.query_string.decode('latin-1'),
+            'status': response.status_code,
+            'duration': duration,
+            'body': anonymise(body, self.jitter),
+        }
+        try:
+            self.writer.write(record)
+        except OSError:
+            logger.exception('cannot write the captured request')
+
+
+def init_app(app):
+    """Install the request hook, if the capture is enabled in the config."""
+    if not app.config.get('CAPTURE_SAMPLE_RATE'):
+        return
+    capture = RequestCapture(app)
+    timing.add_listener(app, capture.finish)
+    atexit.register(capture.writer.close)
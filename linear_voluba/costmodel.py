@@ -0,0 +1,251 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Early rejection of the requests that cannot be processed in time.
+
+The processing time of a request to /api/least-squares (or to the creation
+of a session) is predicted by a linear cost model: the parsing of the body is
+proportional to its size in bytes, and the estimation of the transformation
+is proportional to the number N of landmark pairs, with coefficients for each
+transformation type. The model is fitted from the results of
+``benchmarks/solvers.py run``, which should be measured on the hardware of
+the server (COST_MODEL_BENCHMARK), or else a built-in model is used.
+
+A request is rejected as soon as its predicted processing time exceeds the
+budget of the server (REQUEST_COST_BUDGET, status 413) or the time that the
+client is willing to wait, sent in seconds in the ``X-Request-Timeout``
+header (status 504). This is checked twice: from the Content-Length before
+the body is read, then from the transformation type and the number of
+landmark pairs before the estimation (see :func:`check_request`). Only the
+first check applies to /api/icp, whose iterations are not modelled.
+"""
+
+import json
+import logging
+import re
+import time
+
+import flask
+from flask_smorest import abort
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_HEADER = 'X-Request-Timeout'
+
+# (endpoint, method) of the requests whose cost is checked
+CHECKED_REQUESTS = {
+    ('api.LeastSquaresAPI', 'POST'),
+    ('api.SessionsAPI', 'POST'),
+    ('api.ICPAPI', 'POST'),
+}
+
+_BENCHMARK_NAME_RE = re.compile(
+    r'^(?:estimate/(?P<type>[^/]+)'
+    r'|(?P<mismatch>per_landmark_mismatch)'
+    r'|(?P<parse>parse))'
+    r'/N=(?P<count>\d+)(?:/bytes=(?P<bytes>\d+))?$')
+
+
+def _fit_linear(sizes, times):
+    """Fit times ≈ fixed + slope × sizes, minimizing the relative errors.
+
+    Return (fixed, slope), which are constrained to be non-negative. The slope
+    is then increased if needed so that the time of the largest size is not
+    under-estimated: the large sizes (which matter for rejecting requests)
+    have small relative weights in the fit.
+    """
+    sizes = np.asarray(sizes, dtype=float)
+    times = np.asarray(times, dtype=float)
+    design = np.c_[np.ones_like(sizes), sizes] / times[:, np.newaxis]
+    (fixed, slope), _, _, _ = np.linalg.lstsq(design, np.ones_like(times),
+                                              rcond=None)
+    if slope < 0:
+        fixed, slope = np.sum(1 / times) / np.sum(1 / times ** 2), 0.0
+    elif fixed < 0:
+        fixed, slope = 0.0, (np.sum(sizes / times)
+                             / np.sum((sizes / times) ** 2))
+    largest = np.argmax(sizes)
+    if sizes[largest] > 0:
+        slope = max(slope, (times[largest] - fixed) / sizes[largest])
+    return float(fixed), float(slope)
+
+
+class CostModel:
+    """Linear model of the processing time (in seconds) of a request.
+
+    solve maps each transformation type to the (fixed, per-landmark) costs
+    of the estimation, mismatch holds the (fixed, per-landmark) costs of the
+    computation of the mismatches, and parse the (fixed, per-byte) costs of
+    the parsing and validation of the request body.
+    """
+
+    def __init__(self, solve, mismatch=(0.0, 0.0), parse=(0.0, 0.0)):
+        self.solve = dict(solve)
+        self.mismatch = tuple(mismatch)
+        self.parse = tuple(parse)
+
+    @classmethod
+    def fit(cls, results, default=None):
+        """Fit the model to the results of ``benchmarks/solvers.py run``.
+
+        results maps the names of the benchmarks to their statistics, the
+        minimum time is used. The coefficients that cannot be fitted (missing
+        benchmarks) are taken from default (the built-in model by default).
+        """
+        if default is None:
+            default = DEFAULT_MODEL
+        samples = {}
+        for name, statistics in results.items():
+            match = _BENCHMARK_NAME_RE.match(name)
+            if not match or statistics['min'] <= 0:
+                continue
+            if match.group('parse'):
+                if match.group('bytes') is None:
+                    continue
+                key, size = 'parse', int(match.group('bytes'))
+            elif match.group('mismatch'):
+                key, size = 'mismatch', int(match.group('count'))
+            else:
+                key, size = match.group('type'), int(match.group('count'))
+            samples.setdefault(key, []).append((size, statistics['min']))
+        fitted = {key: _fit_linear(*zip(*points))
+                  for key, points in samples.items()}
+        solve = dict(default.solve)
+        solve.update((key, coefficients)
+                     for key, coefficients in fitted.items()
+                     if key not in ('parse', 'mismatch'))
+        return cls(solve,
+                   mismatch=fitted.get('mismatch', default.mismatch),
+                   parse=fitted.get('parse', default.parse))
+
+    @classmethod
+    def from_benchmark_file(cls, path):
+        """Fit the model to a JSON file written by ``benchmarks/solvers.py``.
+        """
+        with open(path) as f:
+            return cls.fit(json.load(f)['results'])
+
+    def parse_cost(self, content_length):
+        """Predict the time needed to parse a body of content_length bytes."""
+        fixed, per_byte = self.parse
+        return fixed + per_byte * content_length
+
+    def solve_cost(self, transformation_type, landmark_count):
+        """Predict the time needed to estimate the transformation and the
+        mismatches of landmark_count pairs."""
+        try:
+            fixed, per_landmark = self.solve[transformation_type]
+        except KeyError:
+            # Be pessimistic about an unknown type
+            fixed = max(fixed for fixed, _ in self.solve.values())
+            per_landmark = max(per_landmark
+                               for _, per_landmark in self.solve.values())
+        return (fixed + per_landmark * landmark_count
+                + self.mismatch[0] + self.mismatch[1] * landmark_count)
+
+    def cost(self, transformation_type, landmark_count, content_length=0):
+        """Predict the total processing time of a request."""
+        return (self.parse_cost(content_length)
+                + self.solve_cost(transformation_type, landmark_count))
+
+
+# Built-in model, fitted from a run of benchmarks/solvers.py on one core of an
+# x86-64 server (numpy with OpenBLAS)
+DEFAULT_MODEL = CostModel(
+    solve={
+        'rigid': (1.5e-4, 1.9e-7),
+        'rigid+reflection': (1.4e-4, 1.6e-7),
+        'similarity': (1.4e-4, 1.6e-7),
+        'similarity+reflection': (1.1e-4, 1.6e-7),
+        'affine': (5.7e-5, 1.7e-7),
+    },
+    mismatch=(2.4e-5, 7.8e-8),
+    parse=(1.4e-6, 2.4e-7),
+)
+
+
+def get_cost_model(app):
+    """Return the CostModel of the application."""
+    model = app.extensions.get('voluba_cost_model')
+    if model is None:
+        path = app.config.get('COST_MODEL_BENCHMARK')
+        model = DEFAULT_MODEL
+        if path:
+            try:
+                model = CostModel.from_benchmark_file(path)
+            except (OSError, ValueError, KeyError):
+                logger.exception('cannot fit the cost model to %s, using the '
+                                 'built-in model', path)
+        model = app.extensions.setdefault('voluba_cost_model', model)
+    return model
+
+
+def _client_timeout():
+    value = flask.request.headers.get(TIMEOUT_HEADER)
+    if value is None:
+        return None
+    try:
+        timeout = float(value)
+    except ValueError:
+        timeout = float('nan')
+    if not timeout > 0:
+        abort(400, message='invalid {0} header (must be a positive number of '
+                           'seconds)'.format(TIMEOUT_HEADER))
+    return timeout
+
+
+def _check_time_limits(predicted):
+    budget = flask.current_app.config.get('REQUEST_COST_BUDGET')
+    if budget is not None and predicted > budget:
+        abort(413, message='the request is too large: its processing is '
+                           'estimated to take {0:.3g} s, the limit is '
+                           '{1:.3g} s'.format(predicted, budget))
+    timeout = _client_timeout()
+    if timeout is not None and predicted > timeout:
+        abort(504, message='the request cannot be processed within the '
+                           '{0} of {1:.3g} s (estimated to take {2:.3g} s)'
+                           .format(TIMEOUT_HEADER, timeout, predicted))
+
+
+def _check_content_length():
+    if (flask.request.endpoint, flask.request.method) not in CHECKED_REQUESTS:
+        return
+    flask.g.cost_check_start = time.perf_counter()
+    content_length = flask.request.content_length
+    if content_length:
+        model = get_cost_model(flask.current_app)
+        _check_time_limits(model.parse_cost(content_length))
+
+
+def check_request(transformation_type, landmark_count):
+    """Abort the current request if it cannot be processed in time.
+
+    This is called by the views once the request has been validated: the
+    time already spent is added to the predicted cost of the estimation.
+    """
+    start = flask.g.get('cost_check_start')
+    if start is None:
+        return
+    model = get_cost_model(flask.current_app)
+    _check_time_limits(time.perf_counter() - start
+                       + model.solve_cost(transformation_type, landmark_count))
+
+
+def init_app(app):
+    """Install the request hook that checks the Content-Length."""
+    app.before_request(_check_content_length)
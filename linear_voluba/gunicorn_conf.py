@@ -0,0 +1,186 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Gunicorn configuration sized from the resources of the container.
+
+Use with ``gunicorn --config python:linear_voluba.gunicorn_conf
+linear_voluba.wsgi:application`` (this is what the Dockerfile does).
+
+The number of workers is derived from the CPU quota and memory limit of the
+container (see :mod:`linear_voluba.resources`). Every derived setting can be
+overridden by an environment variable:
+
+- WEB_CONCURRENCY: number of workers;
+- GUNICORN_WORKER_CLASS: worker class (gevent by default if installed);
+- GUNICORN_TIMEOUT, GUNICORN_KEEPALIVE, GUNICORN_MAX_REQUESTS: see the
+  corresponding Gunicorn settings;
+- VOLUBA_WORKER_MEMORY: memory budget of one worker in bytes, used to cap the
+  number of workers under the memory limit;
+- PORT: port to listen on.
+
+Command-line options given to Gunicorn take precedence over this file.
+"""
+
+import os
+
+from linear_voluba import readiness
+from linear_voluba import resources
+
+
+# Typical peak memory of a worker serving large requests (numpy, Flask and
+# a few hundred thousand landmarks in flight)
+DEFAULT_WORKER_MEMORY = 256 * 2 ** 20
+
+
+def _int_from_env(environ, name, default):
+    try:
+        return int(environ[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def _default_worker_class():
+    try:
+        import gevent  # noqa: F401
+    except ImportError:
+        return 'sync'
+    return 'gevent'
+
+
+def derive_settings(cpus, memory_limit, environ=os.environ):
+    """Compute the Gunicorn settings for the given resources.
+
+    cpus is the number of usable CPUs, memory_limit is the memory limit in
+    bytes (or None). Return a dictionary of Gunicorn settings.
+    """
+    worker_class = environ.get('GUNICORN_WORKER_CLASS',
+                               _default_worker_class())
+    # The requests are CPU-bound (numpy), so there is no point in having more
+    # workers than CPUs: asynchronous workers handle the slow clients.
+    workers = cpus
+    if worker_class == 'sync':
+        # Synchronous workers are blocked by slow clients, over-provision.
+        workers = 2 * cpus + 1
+    if memory_limit is not None:
+        worker_memory = _int_from_env(environ, 'VOLUBA_WORKER_MEMORY',
+                                      DEFAULT_WORKER_MEMORY)
+        workers = min(workers, memory_limit // worker_memory)
+    workers = max(1, _int_from_env(environ, 'WEB_CONCURRENCY', workers))
+    max_requests = _int_from_env(environ, 'GUNICORN_MAX_REQUESTS', 10000)
+    return {
+        'workers': workers,
+        'worker_class': worker_class,
+        # Large requests take a few seconds, anything much longer is stuck
+        'timeout': _int_from_env(environ, 'GUNICORN_TIMEOUT', 60),
+        'graceful_timeout': 30,
+        # Longer than the idle timeout of the ingress (60 s for nginx), so
+        # that the proxy always closes idle connections first
+        'keepalive': _int_from_env(environ, 'GUNICORN_KEEPALIVE', 75),
+        # Recycle the workers periodically to bound memory fragmentation; the
+        # jitter avoids restarting all workers at the same time
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests // 10,
+    }
+
+
+_cpus = resources.available_cpus()
+_memory_limit = resources.memory_limit()
+_settings = derive_settings(_cpus, _memory_limit)
+
+bind = ':{0}'.format(os.environ.get('PORT', '8080'))
+preload_app = True
+accesslog = '-'
+# Heartbeat files on a tmpfs, as the container filesystem may be slow
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+workers = _settings['workers']
+worker_class = _settings['worker_class']
+timeout = _settings['timeout']
+graceful_timeout = _settings['graceful_timeout']
+keepalive = _settings['keepalive']
+max_requests = _settings['max_requests']
+max_requests_jitter = _settings['max_requests_jitter']
+
+# Make the number of workers known to the application (BLAS_THREADS = 'auto'
+# shares the CPUs between the workers), and size the thread pools before
+# numpy is imported by the preloaded application. Gunicorn may still use
+# another number of workers (--workers on its command line), which is only
+# known in the server hooks: see _share_cpus.
+os.environ['WEB_CONCURRENCY'] = str(workers)
+# The thread variables set by the user are left alone
+_derived_thread_variables = [
+    _variable for _variable in resources.THREAD_ENVIRONMENT_VARIABLES
+    if _variable not in os.environ]
+for _variable in _derived_thread_variables:
+    os.environ[_variable] = str(resources.threads_per_worker(workers))
+
+
+def _share_cpus(server, workers):
+    """Size the thread pools of the workers for their final number."""
+    if os.environ.get('WEB_CONCURRENCY') == str(workers):
+        return
+    os.environ['WEB_CONCURRENCY'] = str(workers)
+    for variable in _derived_thread_variables:
+        os.environ[variable] = str(resources.threads_per_worker(workers))
+    if server.cfg.preload_app:
+        # The application was loaded (and its BLAS limits applied) before
+        # the hooks run: apply them again, the workers inherit them
+        application = server.app.wsgi()
+        resources.configure_blas_threads(
+            application.config.get('BLAS_THREADS'))
+
+
+def on_starting(server):
+    _share_cpus(server, server.cfg.workers)
+    server.log.info(
+        'Resources: %d CPU(s), memory limit %s; settings: workers=%d '
+        'worker_class=%s timeout=%d keepalive=%d max_requests=%d (jitter %d)',
+        _cpus,
+        'none' if _memory_limit is None
+        else '{0} MiB'.format(_memory_limit // 2 ** 20),
+        server.cfg.workers, server.cfg.worker_class_str, server.cfg.timeout,
+        server.cfg.keepalive, server.cfg.max_requests,
+        server.cfg.max_requests_jitter,
+    )
+    # Start from a clean directory for the multiprocess Prometheus metrics
+    metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir and os.path.isdir(metrics_dir):
+        for filename in os.listdir(metrics_dir):
+            if filename.endswith('.db'):
+                os.remove(os.path.join(metrics_dir, filename))
+
+
+def nworkers_changed(server, new_value, old_value):
+    # Only the workers started from now on are affected
+    _share_cpus(server, new_value)
+
+
+def worker_int(worker):
+    # Fail the readiness probe while the worker shuts down
+    readiness.set_not_ready()
+
+
+def worker_exit(server, worker):
+    readiness.set_not_ready()
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        try:
+            from prometheus_client import multiprocess
+        except ImportError:
+            return
+        multiprocess.mark_process_dead(worker.pid)
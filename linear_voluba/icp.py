@@ -0,0 +1,405 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Registration of point clouds without correspondences (ICP).
+
+The Iterative Closest Point algorithm alternates between matching each
+source point to the nearest target point, and estimating the
+transformation from these correspondences with the least-squares solvers
+of :mod:`linear_voluba.leastsquares`. The matching uses a spatial index of
+the target cloud: a KD-tree if SciPy is installed, otherwise a voxel hash
+(a fixed-radius search in numpy).
+
+The worst matches are rejected at each iteration (trimmed ICP), and large
+clouds are registered coarse-to-fine on nested random subsets of both
+clouds, so that most iterations are done on few points (and the voxel hash
+of the coarse levels has large cells, which match distant points).
+
+Command-line usage::
+
+    python3 -m linear_voluba.icp source.npy target.npy rigid
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import sys
+
+import numpy as np
+
+from . import leastsquares
+from . import resample
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_METHODS = ['auto', 'kdtree', 'voxel-hash']
+
+# Numbers of source points used at each resolution level (None means all
+# the points, the target cloud is subsampled in the same proportion); the
+# levels with more points than the source cloud are skipped
+DEFAULT_LEVELS = (1000, 10000, 100000, None)
+
+# Number of points matched at once by each worker
+QUERY_BATCH_SIZE = 2 ** 16
+
+# Minimum number of matches needed by each transformation type
+MINIMUM_MATCHES = {
+    'rigid': 3,
+    'rigid+reflection': 4,
+    'similarity': 3,
+    'similarity+reflection': 4,
+    'affine': 4,
+}
+
+
+ICPResult = collections.namedtuple('ICPResult', [
+    'transformation_matrix',
+    'inverse_matrix',
+    'rmse',
+    'inlier_count',
+    'iterations',
+    'converged',
+])
+
+
+class KDTreeIndex:
+    """Exact nearest-neighbour search with scipy.spatial.cKDTree."""
+
+    def __init__(self, points):
+        from scipy.spatial import cKDTree
+        self.points = points
+        self.tree = cKDTree(points)
+
+    def query(self, points, max_distance=np.inf, workers=1):
+        """Return the distances and indices of the nearest neighbours.
+
+        Points that have no neighbour within max_distance get an infinite
+        distance and the index len(self.points).
+        """
+        try:
+            return self.tree.query(points, distance_upper_bound=max_distance,
+                                   workers=workers)
+        except TypeError:
+            # SciPy < 1.6
+            return self.tree.query(points, distance_upper_bound=max_distance,
+                                   n_jobs=workers)
+
+
+class VoxelHashIndex:
+    """Fixed-radius nearest-neighbour search, by hashing points in cells.
+
+    The points are sorted by the cubic cell of side cell_size that contains
+    them, and a query searches the 27 cells around the query point. The
+    nearest neighbour is exact if it is within cell_size, points farther
+    than that are not matched.
+    """
+
+    # Bits per axis in the keys of the cells
+    KEY_BITS = 21
+
+    def __init__(self, points, cell_size):
+        self.points = points
+        span = np.ptp(points, axis=0).max() if len(points) else 0
+        # Enough cells to cover the points, within the bits of the keys
+        self.cell_size = max(float(cell_size),
+                             span / (2 ** self.KEY_BITS - 4), 1e-12)
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        # One cell of margin, so that the neighbouring cells are in range
+        self.base = (cells.min(axis=0) if len(points)
+                     else np.zeros(3, dtype=np.int64)) - 1
+        keys = self._keys(cells - self.base)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys, self.starts, self.counts = np.unique(
+            keys[self.order], return_index=True, return_counts=True)
+
+    @classmethod
+    def _keys(cls, cells):
+        return ((cells[:, 0] << (2 * cls.KEY_BITS))
+                | (cells[:, 1] << cls.KEY_BITS) | cells[:, 2])
+
+    def query(self, points, max_distance=np.inf, workers=1):
+        """Same as :meth:`KDTreeIndex.query`."""
+        batches = [points[start:start + QUERY_BATCH_SIZE]
+                   for start in range(0, len(points), QUERY_BATCH_SIZE)]
+        if workers == 1 or len(batches) <= 1:
+            results = [self._query_batch(batch) for batch in batches]
+        else:
+            # The numpy operations release the GIL on large arrays. This
+            # gives no parallelism in a gevent worker, where the threads
+            # are greenlets: only the queries of the KD-tree run in parallel
+            with concurrent.futures.ThreadPoolExecutor(
+                    None if workers == -1 else workers) as executor:
+                results = list(executor.map(self._query_batch, batches))
+        if not results:
+            return np.zeros(0), np.zeros(0, dtype=np.intp)
+        distances = np.concatenate([result[0] for result in results])
+        indices = np.concatenate([result[1] for result in results])
+        missing = distances > min(max_distance, self.cell_size)
+        distances[missing] = np.inf
+        indices[missing] = len(self.points)
+        return distances, indices
+
+    def _query_batch(self, points):
+        cells = np.floor(points / self.cell_size).astype(np.int64) - self.base
+        best_squared = np.full(len(points), np.inf)
+        best_indices = np.full(len(points), len(self.points), dtype=np.intp)
+        limit = 2 ** self.KEY_BITS
+        for offset in np.ndindex(3, 3, 3):
+            neighbours = cells + np.subtract(offset, 1)
+            in_range = np.all((neighbours >= 0) & (neighbours < limit),
+                              axis=1)
+            keys = self._keys(np.where(in_range[:, np.newaxis],
+                                       neighbours, 0))
+            positions = np.minimum(np.searchsorted(self.keys, keys),
+                                   len(self.keys) - 1)
+            found = np.flatnonzero(in_range
+                                   & (self.keys[positions] == keys))
+            counts = self.counts[positions[found]]
+            if not counts.sum():
+                continue
+            # Flatten the (query, point of the cell) candidate pairs
+            queries = np.repeat(found, counts)
+            ends = np.cumsum(counts)
+            ranks = np.arange(ends[-1]) - np.repeat(ends - counts, counts)
+            candidates = self.order[
+                np.repeat(self.starts[positions[found]], counts) + ranks]
+            squared = np.sum((points[queries] - self.points[candidates]) ** 2,
+                             axis=1)
+            # Nearest candidate of each query in these cells
+            nearest = np.full(len(points), np.inf)
+            np.minimum.at(nearest, queries, squared)
+            is_nearest = squared == nearest[queries]
+            nearest_indices = np.empty(len(points), dtype=np.intp)
+            nearest_indices[queries[is_nearest]] = candidates[is_nearest]
+            better = nearest < best_squared
+            best_squared[better] = nearest[better]
+            best_indices[better] = nearest_indices[better]
+        return np.sqrt(best_squared), best_indices
+
+
+def _default_cell_size(points, occupancy=8):
+    """Cell size giving about occupancy points per non-empty cell."""
+    if len(points) == 0:
+        return 1.0
+    extent = np.ptp(points, axis=0)
+    extent = np.maximum(extent, max(extent.max(), 1e-6) * 1e-3)
+    # Start from a uniform distribution in the bounding box, then refine
+    # for clouds that are concentrated on surfaces or clusters
+    cell_size = np.cbrt(occupancy * np.prod(extent) / len(points))
+    for _ in range(2):
+        cells = np.floor(points / cell_size).astype(np.int64)
+        cell_count = len(np.unique(cells, axis=0))
+        cell_size *= np.sqrt(occupancy * cell_count / len(points))
+    return cell_size
+
+
+def make_index(points, method='auto', max_distance=None):
+    """Build the spatial index of the target points.
+
+    With method 'auto', a KDTreeIndex is used if SciPy is installed, and a
+    VoxelHashIndex otherwise. The cells of the voxel hash contain a few
+    points on average (they are not larger than max_distance).
+    """
+    if method not in INDEX_METHODS:
+        raise ValueError('unknown index method {0!r}'.format(method))
+    if method in ('auto', 'kdtree'):
+        try:
+            return KDTreeIndex(points)
+        except ImportError:
+            if method == 'kdtree':
+                raise
+            logger.info('SciPy is not installed, falling back to a voxel '
+                        'hash for the nearest-neighbour search')
+    cell_size = _default_cell_size(points)
+    if max_distance is not None:
+        cell_size = min(cell_size, max_distance)
+    return VoxelHashIndex(points, cell_size)
+
+
+def _transform(matrix, points):
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def _match(index, matrix, points, trim_fraction, max_distance, workers):
+    """Match the transformed points, return (kept, indices, distances)."""
+    distances, indices = index.query(
+        _transform(matrix, points),
+        max_distance=np.inf if max_distance is None else max_distance,
+        workers=workers)
+    kept = np.isfinite(distances)
+    if trim_fraction > 0 and kept.any():
+        threshold = np.quantile(distances[kept], 1 - trim_fraction)
+        kept &= distances <= threshold
+    return kept, indices, distances
+
+
+def icp(source, target, transformation_type='rigid', initial_matrix=None,
+        max_iterations=50, tolerance=1e-4, trim_fraction=0.1,
+        max_distance=None, levels=DEFAULT_LEVELS, index='auto', workers=1,
+        seed=0):
+    """Register the source cloud (N, 3) to the target cloud (M, 3).
+
+    initial_matrix is the starting transformation (e.g. estimated by
+    least-squares from a few landmarks), the identity by default. At each
+    iteration, the matches farther than max_distance are rejected, then
+    the trim_fraction worst matches. A level stops after max_iterations, or
+    when an iteration moves the corners of the bounding box of the source
+    points by less than tolerance times the RMS radius of the source cloud
+    (scaled by the cube root of the subsampling factor). workers is the
+    number of threads used for the nearest-neighbour queries (-1 for all
+    CPUs).
+
+    The RMSE and inlier count of the result are those of the last matching
+    of all the source points. UnderdeterminedProblem is raised if too few
+    points are matched.
+    """
+    if transformation_type not in MINIMUM_MATCHES:
+        raise ValueError('unknown transformation type {0!r}'
+                         .format(transformation_type))
+    if max_iterations < 1:
+        raise ValueError('max_iterations must be at least 1')
+    source = np.asarray(source, dtype=float).reshape(-1, 3)
+    target = np.asarray(target, dtype=float).reshape(-1, 3)
+    if min(len(source), len(target)) < MINIMUM_MATCHES[transformation_type]:
+        raise leastsquares.UnderdeterminedProblem(
+            'underdetermined problem: at least {0} points are needed in '
+            'each cloud'.format(MINIMUM_MATCHES[transformation_type]))
+    matrix = (np.eye(4) if initial_matrix is None
+              else np.array(initial_matrix, dtype=float))
+    # Nested random subsets of both clouds, so that each level refines the
+    # previous one
+    rng = np.random.RandomState(seed)
+    source_order = rng.permutation(len(source))
+    target_order = rng.permutation(len(target))
+    sizes = [size for size in levels
+             if size is not None and size < len(source)] + [len(source)]
+    # The convergence is measured by the motion of the corners of the
+    # bounding box of the source points, relative to the size of the cloud
+    corners = np.array(np.meshgrid(*zip(source.min(axis=0),
+                                        source.max(axis=0)))).reshape(3, -1).T
+    radius = np.sqrt(np.mean(np.sum((source - source.mean(axis=0)) ** 2,
+                                    axis=1)))
+    iterations = 0
+    converged = False
+    for size in sizes:
+        if size < len(source):
+            points = source[source_order[:size]]
+            target_size = max(size, len(target) * size // len(source))
+            level_target = target[np.sort(target_order[:target_size])]
+        else:
+            points, level_target = source, target
+        target_index = make_index(level_target, method=index,
+                                  max_distance=max_distance)
+        # The subsampled levels cannot be more precise than their spacing
+        level_tolerance = tolerance * radius * np.cbrt(len(source) / size)
+        converged = False
+        for _ in range(max_iterations):
+            kept, indices, distances = _match(
+                target_index, matrix, points, trim_fraction, max_distance,
+                workers)
+            if np.count_nonzero(kept) < MINIMUM_MATCHES[transformation_type]:
+                raise leastsquares.UnderdeterminedProblem(
+                    'underdetermined problem: only {0} source points were '
+                    'matched'.format(np.count_nonzero(kept)))
+            # The factorizations of the matched points are not reused, so
+            # they are not put in the cache
+            new_matrix = leastsquares.SourceFactorization(
+                points[kept]).estimate(transformation_type,
+                                       level_target[indices[kept]])
+            iterations += 1
+            motion = np.max(np.linalg.norm(
+                _transform(new_matrix, corners) - _transform(matrix, corners),
+                axis=1))
+            matrix = new_matrix
+            if motion <= level_tolerance:
+                converged = True
+                break
+        logger.debug('ICP level with %d points: %d iterations in total',
+                     len(points), iterations)
+    # The statistics of the last matching of all the points (the last
+    # update moved them by a negligible amount if the algorithm converged)
+    return ICPResult(
+        transformation_matrix=matrix,
+        inverse_matrix=np.linalg.inv(matrix),
+        rmse=float(np.sqrt(np.mean(distances[kept] ** 2))),
+        inlier_count=int(np.count_nonzero(kept)),
+        iterations=iterations,
+        converged=converged,
+    )
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description='Register two point clouds stored in .npy files of '
+                    'shape (N, 3), without correspondences (ICP).')
+    parser.add_argument('source', help='.npy file of the source cloud')
+    parser.add_argument('target', help='.npy file of the target cloud')
+    parser.add_argument('transformation_type',
+                        choices=leastsquares.TRANSFORMATION_TYPES)
+    parser.add_argument('--initial-matrix',
+                        help='JSON file containing the initial 4×4 matrix, '
+                        'or a response of /api/least-squares')
+    parser.add_argument('--trim-fraction', type=float, default=0.1,
+                        help='fraction of the worst matches rejected at '
+                        'each iteration (default: %(default)s)')
+    parser.add_argument('--max-distance', type=float,
+                        help='reject the matches farther than this')
+    parser.add_argument('--max-iterations', type=int, default=50,
+                        help='maximum number of iterations per resolution '
+                        'level (default: %(default)s)')
+    parser.add_argument('--index', choices=INDEX_METHODS, default='auto',
+                        help='spatial index of the target cloud '
+                        '(default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=-1,
+                        help='number of threads for the nearest-neighbour '
+                        'queries (default: all CPUs)')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_command_line(argv)
+    initial_matrix = None
+    if args.initial_matrix:
+        initial_matrix = resample.read_matrix(args.initial_matrix)
+    try:
+        result = icp(np.load(args.source, mmap_mode='r'),
+                     np.load(args.target, mmap_mode='r'),
+                     args.transformation_type,
+                     initial_matrix=initial_matrix,
+                     max_iterations=args.max_iterations,
+                     trim_fraction=args.trim_fraction,
+                     max_distance=args.max_distance,
+                     index=args.index, workers=args.workers)
+    except leastsquares.UnderdeterminedProblem as exc:
+        print(str(exc), file=sys.stderr)
+        return 1
+    json.dump({
+        'transformation_matrix': result.transformation_matrix.tolist(),
+        'inverse_matrix': result.inverse_matrix.tolist(),
+        'RMSE': result.rmse,
+        'inlier_count': result.inlier_count,
+        'iterations': result.iterations,
+        'converged': result.converged,
+    }, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,7 +15,10 @@
 # See the Licence for the specific language governing permissions and
 # limitations under the Licence.
 
+import collections
+import hashlib
 import logging
+import threading
 
 import numpy as np
 
@@ -23,14 +26,47 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
+TRANSFORMATION_TYPES = [
+    'rigid',
+    'rigid+reflection',
+    'similarity',
+    'similarity+reflection',
+    'affine',
+]
+"""Transformation types supported by :func:`estimate`."""
+
+
 def np_matrix_to_json(np_matrix):
     return [list(row) for row in np_matrix]
 
 
+def hash_key(*parts):
+    """Compute a canonical key from strings and numpy arrays.
+
+    Used to key the source cache, and the single-flight deduplication of
+    the server (see :mod:`linear_voluba.singleflight`).
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            digest.update(b's')
+            part = part.encode('utf-8')
+        else:
+            # Adding 0.0 turns negative zeros into positive zeros, which give
+            # the same results
+            part = np.ascontiguousarray(part, dtype=np.float64) + 0.0
+            digest.update('a{0}'.format(part.shape).encode('ascii'))
+            # The bytes are hashed in place, without another copy
+            part = part.reshape(-1).view(np.uint8)
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
 def per_landmark_mismatch(src, dst, matrix):
     src_block = np.r_[src.T, np.ones((1, len(src)))]
     transformed_src_block = matrix @ src_block
-    distances = np.sqrt(np.sum((dst - transformed_src_block[:3].T) ** 2,
+    distances = np.sqrt(np.sum((dst - transformed_src_block[:-1].T) ** 2,
                                axis=1))
     return distances
 
@@ -38,30 +74,12 @@ def per_landmark_mismatch(src, dst, matrix):
 def affine(src, dst, rcond=1e-6):
     """Estimate the best affine matrix by least-squares in target space.
 
-    The implementation is specific to 3-dimensional source and target spaces,
-    but could be generalized easily.
+    The problem is solved on the (M, 4) matrix of source points in
+    homogeneous coordinates, whose factorization is cached (see
+    :func:`factorize_source`). dst can also be a (K, M, 3) stack of target
+    points, then a (K, 4, 4) stack of matrices is returned.
     """
-    assert src.shape[1] == dst.shape[1] == 3
-    flat_dst = dst.flatten(order="C")  # order: dst1x, dst1y, dst1z, dst2x...
-
-    src_mat = np.zeros((len(flat_dst), 12))
-    for src_idx, src_vec in enumerate(src):
-        src_mat[3 * src_idx][:3] = src_vec
-        src_mat[3 * src_idx][3] = 1
-        src_mat[3 * src_idx + 1][4:7] = src_vec
-        src_mat[3 * src_idx + 1][7] = 1
-        src_mat[3 * src_idx + 2][8:11] = src_vec
-        src_mat[3 * src_idx + 2][11] = 1
-
-    flat_mat, _, rank, _ = np.linalg.lstsq(src_mat, flat_dst, rcond=rcond)
-    if rank < 12:
-        raise UnderdeterminedProblem(
-            'underdetermined problem: not enough linearly independent points, '
-            'missing {0} point(s)'.format((12 - rank + 2) // 3)
-        )
-    mat = flat_mat.reshape((3, 4), order="C")
-    mat = np.concatenate((mat, [[0, 0, 0, 1]]), axis=0)
-    return mat
+    return factorize_source(src).affine(dst, rcond=rcond)
 
 
 def affine_gergely(src, dst):
@@ -75,11 +93,465 @@ def affine_gergely(src, dst):
     return mat
 
 
+def estimate(transformation_type, src, dst):
+    """Estimate a transformation matrix of the given type by least-squares.
+
+    transformation_type is one of TRANSFORMATION_TYPES, src and dst are
+    (M, N) arrays of corresponding points (N = 3 for volumes, N = 2 for
+    sections). The result is a (N + 1)×(N + 1) matrix in homogeneous
+    coordinates. UnderdeterminedProblem is raised if there are not enough
+    linearly independent points.
+    """
+    return factorize_source(src).estimate(transformation_type, dst)
+
+
+def estimate_many(transformation_type, src, dsts):
+    """Estimate the transformations from src to several sets of targets.
+
+    dsts is a (K, M, 3) array of target points, the result is a (K, 4, 4)
+    array of matrices. The source side of the problem is factorized only
+    once. UnderdeterminedProblem is raised if any of the problems is
+    underdetermined.
+    """
+    dsts = np.asarray(dsts, dtype=float)
+    if dsts.ndim != 3:
+        raise ValueError('dsts must be a (K, M, N) array')
+    return factorize_source(src).estimate(transformation_type, dsts)
+
+
+def _group_sums(values, groups, group_count):
+    """Sum the (M, ...) values by group, giving a (group_count, ...) array."""
+    columns = values.reshape(len(values), int(np.prod(values.shape[1:])))
+    sums = np.empty((group_count, columns.shape[1]))
+    for j in range(columns.shape[1]):
+        sums[:, j] = np.bincount(groups, weights=columns[:, j],
+                                 minlength=group_count)
+    return sums.reshape((group_count,) + values.shape[1:])
+
+
+def estimate_grouped(transformation_type, src, dst, groups, group_count=None,
+                     rcond=1e-6):
+    """Estimate one transformation for each group of corresponding points.
+
+    src and dst are (M, N) arrays of corresponding points, groups is the
+    (M,) array of the group index of each pair (e.g. the section on which
+    the landmarks were placed). The result is a (group_count, N + 1, N + 1)
+    array of matrices, which by default has one matrix per group index up
+    to the largest one.
+
+    The problems of all groups are solved together, from the moments of the
+    centred points of each group, with batched linear algebra: this is much
+    faster than calling :func:`estimate` for each of many small problems.
+    UnderdeterminedProblem is raised if any of the problems is
+    underdetermined, the message gives the index of the first one.
+    """
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    groups = np.asarray(groups)
+    if src.ndim != 2 or src.shape != dst.shape:
+        raise ValueError('src and dst must be (M, N) arrays of the same shape')
+    if groups.shape != src.shape[:1]:
+        raise ValueError('there must be one group index per pair of points')
+    if group_count is None:
+        group_count = int(groups.max()) + 1 if len(groups) else 0
+    if len(groups) and (groups.min() < 0 or groups.max() >= group_count):
+        raise ValueError('invalid group index')
+    groups = groups.astype(np.intp, copy=False)
+    dim = src.shape[1]
+
+    counts = np.bincount(groups, minlength=group_count)
+    nonempty_counts = np.maximum(counts, 1)[:, np.newaxis]
+    src_mean = _group_sums(src, groups, group_count) / nonempty_counts
+    dst_mean = _group_sums(dst, groups, group_count) / nonempty_counts
+    src_demean = src - src_mean[groups]
+    dst_demean = dst - dst_mean[groups]
+    src_src = _group_sums(src_demean[:, :, np.newaxis]
+                          * src_demean[:, np.newaxis, :],
+                          groups, group_count)
+    dst_src = _group_sums(dst_demean[:, :, np.newaxis]
+                          * src_demean[:, np.newaxis, :],
+                          groups, group_count)
+
+    if transformation_type == 'affine':
+        # Rank of the source points in homogeneous coordinates: rank of the
+        # centred points, plus one for any non-empty group. The singular
+        # values of the centred points are the square roots of the
+        # eigenvalues of src_src (in ascending order).
+        singular_values = np.sqrt(np.clip(np.linalg.eigvalsh(src_src),
+                                          0, None))
+        rank = np.count_nonzero(
+            singular_values > rcond * singular_values[:, -1:], axis=-1)
+        rank += counts > 0
+        _raise_if_missing(
+            dim + 1 - rank,
+            'underdetermined problem: not enough linearly independent '
+            'points, missing {0} point(s)')
+        linear = np.swapaxes(
+            np.linalg.solve(src_src, np.swapaxes(dst_src, -1, -2)), -1, -2)
+        mat = np.zeros((group_count, dim + 1, dim + 1))
+        mat[:, :dim, :dim] = linear
+        mat[:, :dim, dim] = dst_mean - (linear
+                                        @ src_mean[:, :, np.newaxis])[..., 0]
+        mat[:, dim, dim] = 1
+        return mat
+
+    try:
+        estimate_scale, allow_reflection = _UMEYAMA_PARAMETERS[
+            transformation_type]
+    except KeyError:
+        raise ValueError('unknown transformation type {0!r}'
+                         .format(transformation_type)) from None
+    _raise_if_missing(
+        np.where(counts == 0, dim + allow_reflection, 0),
+        'underdetermined problem: not enough linearly independent points, '
+        'missing {0} point(s)')
+    return _umeyama_from_covariance(
+        dst_src / nonempty_counts[:, :, np.newaxis], src_mean, dst_mean,
+        np.trace(src_src, axis1=-2, axis2=-1) / nonempty_counts[:, 0],
+        estimate_scale=estimate_scale, allow_reflection=allow_reflection,
+        rcond=rcond)
+
+
+# Parameters of extended_umeyama (estimate_scale, allow_reflection) for each
+# transformation type
+_UMEYAMA_PARAMETERS = {
+    'rigid': (False, False),
+    'rigid+reflection': (False, True),
+    'similarity': (True, False),
+    'similarity+reflection': (True, True),
+}
+
+
+# Memory budget (in bytes) of the cache of source factorizations
+SOURCE_CACHE_MAX_BYTES = 64 * 2 ** 20
+
+
+class SourceFactorization:
+    """Factorization of the source side of the least-squares problems.
+
+    Everything that depends only on the source points (the SVD of the
+    source points in homogeneous coordinates for :meth:`affine`, the
+    centred source points for :meth:`umeyama`) is computed once, lazily.
+    Fitting several sets of target points then only costs a product with
+    the target points each. The target points can be given as a (M, N)
+    array, or as a (K, M, N) stack for a multi-target solve.
+    """
+
+    def __init__(self, src):
+        self.src = np.array(src, dtype=float)
+        self.src.flags.writeable = False
+        self._svd = None
+        self._centred = None
+
+    @staticmethod
+    def nbytes_for(shape):
+        """Upper bound of the memory used by the factorization of (M, N)
+        source points, when all factors are computed."""
+        # src, U (M × (N + 1)) and the centred source points, in float64
+        num, dim = shape
+        return 8 * num * (3 * dim + 1)
+
+    @property
+    def nbytes(self):
+        """Upper bound of the memory used, when all factors are computed."""
+        return self.nbytes_for(self.src.shape)
+
+    def _homogeneous_svd(self):
+        if self._svd is None:
+            hsrc = np.c_[self.src, np.ones(len(self.src))]
+            self._svd = np.linalg.svd(hsrc, full_matrices=False)
+        return self._svd
+
+    def _centred_source(self):
+        if self._centred is None:
+            src_mean = self.src.mean(axis=0)
+            src_demean = self.src - src_mean
+            self._centred = (src_mean, src_demean,
+                             src_demean.var(axis=0).sum())
+        return self._centred
+
+    def affine(self, dst, rcond=1e-6):
+        """Same as :func:`affine`, for the factorized source points."""
+        dim = self.src.shape[1]
+        U, S, Vt = self._homogeneous_svd()
+        # The system solved for the 3 (M, 4) blocks of the affine matrix has
+        # the same singular values as the homogeneous source matrix
+        rank = np.count_nonzero(S > rcond * S[0]) if len(S) else 0
+        if rank < dim + 1:
+            raise UnderdeterminedProblem(
+                'underdetermined problem: not enough linearly independent '
+                'points, missing {0} point(s)'.format(dim + 1 - rank)
+            )
+        dst = np.asarray(dst, dtype=float)
+        solution = Vt.T @ ((U.T @ dst) / S[:, np.newaxis])
+        mat = np.zeros(dst.shape[:-2] + (dim + 1, dim + 1))
+        mat[..., :dim, :] = np.swapaxes(solution, -1, -2)
+        mat[..., dim, dim] = 1
+        return mat
+
+    def umeyama(self, dst, estimate_scale=False, allow_reflection=False,
+                rcond=1e-6):
+        """Same as :func:`extended_umeyama`, for the factorized source points.
+        """
+        num = len(self.src)
+        if num == 0:
+            raise UnderdeterminedProblem(
+                'underdetermined problem: not enough linearly independent '
+                'points, at least 3 points are needed'
+            )
+        src_mean, src_demean, src_variance = self._centred_source()
+        dst = np.asarray(dst, dtype=float)
+        dst_mean = dst.mean(axis=-2)
+        dst_demean = dst - dst_mean[..., np.newaxis, :]
+        # Eq. (38), for all the targets at once
+        A = np.swapaxes(dst_demean, -1, -2) @ src_demean / num
+        return _umeyama_from_covariance(
+            A, src_mean, dst_mean, src_variance,
+            estimate_scale=estimate_scale,
+            allow_reflection=allow_reflection, rcond=rcond)
+
+    def estimate(self, transformation_type, dst):
+        """Same as :func:`estimate`, for the factorized source points."""
+        if transformation_type == 'affine':
+            return self.affine(dst)
+        try:
+            estimate_scale, allow_reflection = _UMEYAMA_PARAMETERS[
+                transformation_type]
+        except KeyError:
+            raise ValueError('unknown transformation type {0!r}'
+                             .format(transformation_type)) from None
+        return self.umeyama(dst, estimate_scale=estimate_scale,
+                            allow_reflection=allow_reflection)
+
+
+class SourceFactorizationCache:
+    """LRU cache of SourceFactorization, keyed by a hash of the points.
+
+    The same source points are often registered to several targets (or only
+    the target points are moved between requests), so their factorization
+    is reused. Sources whose factorization would not fit in max_bytes are
+    not cached at all, which also saves hashing them.
+    """
+
+    def __init__(self, max_bytes=SOURCE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, src):
+        """Return the SourceFactorization of src, from the cache if possible.
+        """
+        src = np.asarray(src, dtype=float)
+        if src.ndim != 2:
+            raise ValueError('src must be a (M, N) array')
+        if SourceFactorization.nbytes_for(src.shape) > self.max_bytes:
+            return SourceFactorization(src)
+        # A hit only costs the hash: the points are copied on a miss
+        key = hash_key(src)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+            factorization = SourceFactorization(src)
+            self._entries[key] = factorization
+            self._bytes += factorization.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return factorization
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+source_cache = SourceFactorizationCache()
+"""Cache of the source factorizations used by :func:`factorize_source`."""
+
+
+def factorize_source(src):
+    """Return the (cached) SourceFactorization of the (M, N) source points."""
+    return source_cache.get(src)
+
+
+class LandmarkMoments:
+    """Sufficient statistics of a set of landmark pairs.
+
+    The least-squares solutions only depend on the number of pairs, the sums
+    of the points, and the sums of their outer products. These can be
+    updated in O(1) when pairs are added or removed, so that the
+    transformation can be re-estimated without going through all the pairs
+    (see :func:`estimate_from_moments`).
+
+    The sums are accumulated relative to an origin (the mean of the first
+    points that are added), which keeps them well-conditioned for points that
+    are far from the origin of space. Removing pairs by subtraction
+    accumulates rounding errors: :meth:`from_points` should be used to
+    rebuild the moments from time to time.
+    """
+
+    def __init__(self, dim=3):
+        self.dim = dim
+        self.count = 0
+        self.src_origin = None
+        self.dst_origin = None
+        self.src_sum = np.zeros(dim)
+        self.dst_sum = np.zeros(dim)
+        self.src_src = np.zeros((dim, dim))
+        self.dst_src = np.zeros((dim, dim))
+
+    @classmethod
+    def from_points(cls, src, dst):
+        moments = cls(dim=np.shape(src)[1])
+        moments.add(src, dst)
+        return moments
+
+    def add(self, src, dst, sign=1):
+        """Add the (M, dim) arrays of corresponding points (or remove them if
+        sign is -1)."""
+        src = np.asarray(src, dtype=float).reshape(-1, self.dim)
+        dst = np.asarray(dst, dtype=float).reshape(-1, self.dim)
+        if len(src) == 0:
+            return
+        if self.src_origin is None:
+            self.src_origin = src.mean(axis=0)
+            self.dst_origin = dst.mean(axis=0)
+        src = src - self.src_origin
+        dst = dst - self.dst_origin
+        self.count += sign * len(src)
+        self.src_sum += sign * src.sum(axis=0)
+        self.dst_sum += sign * dst.sum(axis=0)
+        self.src_src += sign * (src.T @ src)
+        self.dst_src += sign * (dst.T @ src)
+
+    def remove(self, src, dst):
+        self.add(src, dst, sign=-1)
+
+
+def affine_from_moments(moments, rcond=1e-6):
+    """Estimate the best affine matrix from LandmarkMoments.
+
+    This gives the same solution as :func:`affine`. The rank is determined
+    on the (M, 4) matrix of source points in homogeneous coordinates, whose
+    rank is a third of the rank of the system solved by :func:`affine`.
+    """
+    dim = moments.dim
+    missing_message = ('underdetermined problem: not enough linearly '
+                       'independent points, missing {0} point(s)')
+    if moments.count <= 0:
+        raise UnderdeterminedProblem(missing_message.format(dim + 1))
+    # Normal equations of the problem in homogeneous coordinates
+    gram = np.empty((dim + 1, dim + 1))
+    gram[:dim, :dim] = moments.src_src
+    gram[:dim, dim] = gram[dim, :dim] = moments.src_sum
+    gram[dim, dim] = moments.count
+    rhs = np.c_[moments.dst_src, moments.dst_sum]
+    # The singular values of the homogeneous source matrix are the square
+    # roots of the eigenvalues of its Gram matrix
+    singular_values = np.sqrt(np.clip(np.linalg.eigvalsh(gram), 0, None))
+    rank = np.count_nonzero(singular_values
+                            > rcond * singular_values.max())
+    if rank < dim + 1:
+        raise UnderdeterminedProblem(missing_message.format(dim + 1 - rank))
+    solution = np.linalg.solve(gram, rhs.T).T
+    mat = np.eye(dim + 1)
+    mat[:dim, :dim] = solution[:, :dim]
+    # Undo the shift of origins of the moments
+    mat[:dim, dim] = (solution[:, dim] + moments.dst_origin
+                      - solution[:, :dim] @ moments.src_origin)
+    return mat
+
+
+def extended_umeyama_from_moments(moments, estimate_scale=False,
+                                  allow_reflection=False, rcond=1e-6):
+    """Equivalent of :func:`extended_umeyama` working on LandmarkMoments."""
+    num = moments.count
+    if num <= 0:
+        raise UnderdeterminedProblem(
+            'underdetermined problem: not enough linearly independent points, '
+            'at least 3 points are needed'
+        )
+    src_mean = moments.src_sum / num
+    dst_mean = moments.dst_sum / num
+    A = moments.dst_src / num - np.outer(dst_mean, src_mean)
+    src_variance = np.trace(moments.src_src) / num - src_mean @ src_mean
+    return _umeyama_from_covariance(
+        A, src_mean + moments.src_origin, dst_mean + moments.dst_origin,
+        src_variance,
+        estimate_scale=estimate_scale, allow_reflection=allow_reflection,
+        rcond=rcond)
+
+
+def estimate_from_moments(transformation_type, moments):
+    """Same as :func:`estimate`, from the LandmarkMoments of the points."""
+    if transformation_type == 'affine':
+        return affine_from_moments(moments)
+    try:
+        estimate_scale, allow_reflection = _UMEYAMA_PARAMETERS[
+            transformation_type]
+    except KeyError:
+        raise ValueError('unknown transformation type {0!r}'
+                         .format(transformation_type)) from None
+    return extended_umeyama_from_moments(moments,
+                                         estimate_scale=estimate_scale,
+                                         allow_reflection=allow_reflection)
+
+
+def warm_up():
+    """Run every solver code path once on a small problem.
+
+    The first call to each numpy.linalg routine is much slower than the
+    following ones (the LAPACK code and data are paged in, caches and thread
+    pools are set up), so this is called before a server reports that it is
+    ready to serve requests.
+    """
+    src = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 1]],
+                   dtype=float)
+    dst = 2 * src + 1
+    for transformation_type in TRANSFORMATION_TYPES:
+        mat = estimate(transformation_type, src, dst)
+        np.linalg.inv(mat)
+        per_landmark_mismatch(src, dst, mat)
+        try:
+            estimate(transformation_type, src[:2], dst[:2])
+        except UnderdeterminedProblem:
+            pass
+
+
 class UnderdeterminedProblem(Exception):
     """Exception raised for an underdetermined problem (ambiguous solution)."""
     pass
 
 
+def _raise_if_missing(missing, message):
+    """Raise UnderdeterminedProblem if points are missing.
+
+    missing is the number of missing points of a problem, or a (K,) array for
+    a batch of problems (then the index of the first underdetermined problem
+    is prepended to the message).
+    """
+    missing = np.asarray(missing)
+    if missing.ndim == 0:
+        if missing > 0:
+            raise UnderdeterminedProblem(message.format(missing))
+        return
+    underdetermined = np.flatnonzero(missing > 0)
+    if len(underdetermined):
+        index = underdetermined[0]
+        raise UnderdeterminedProblem('problem {0}: '.format(index)
+                                     + message.format(missing[index]))
+
+
 # This function is based on code borrowed from scikit-image, copyright and
 # licence below:
 # (https://github.com/scikit-image/scikit-image/blob/8022d048bbcb74ef072e45faf925a4106414308e/skimage/transform/_geometric.py#L72)
@@ -140,63 +612,64 @@ def extended_umeyama(src, dst, estimate_scale=False, allow_reflection=False,
             point patterns", Shinji Umeyama, PAMI 1991, :DOI:`10.1109/34.88573`
     """
 
-    num = src.shape[0]
-    dim = src.shape[1]
-    if num == 0:
-        raise UnderdeterminedProblem(
-            'underdetermined problem: not enough linearly independent points, '
-            'at least 3 points are needed'
-        )
-
-    # Compute mean of src and dst.
-    src_mean = src.mean(axis=0)
-    dst_mean = dst.mean(axis=0)
+    return factorize_source(src).umeyama(
+        dst, estimate_scale=estimate_scale, allow_reflection=allow_reflection,
+        rcond=rcond)
 
-    # Subtract mean from src and dst.
-    src_demean = src - src_mean
-    dst_demean = dst - dst_mean
 
-    # Eq. (38).
-    A = dst_demean.T @ src_demean / num
+def _umeyama_from_covariance(A, src_mean, dst_mean, src_variance,  # noqa: N803
+                             estimate_scale, allow_reflection, rcond):
+    """Second half of extended_umeyama, from the cross-covariance matrix A.
 
-    T = np.eye(dim + 1, dtype=np.double)
+    src_variance is the total variance of the source points (the trace of
+    their covariance matrix). A can also be a (K, N, N) stack of matrices
+    (with (K, N) means and (K,) variances), for solving a batch of problems:
+    a (K, N + 1, N + 1) stack of matrices is returned.
+    """
+    dim = A.shape[-1]
+    src_mean = np.asarray(src_mean, dtype=np.double)
+    dst_mean = np.asarray(dst_mean, dtype=np.double)
+    T = np.zeros(A.shape[:-2] + (dim + 1, dim + 1), dtype=np.double)
+    T[..., dim, dim] = 1
 
     U, S, V = np.linalg.svd(A)
 
-    logger.debug('singular values = %s', S)
-    largest_singular_value = S[0]
-    rank = np.count_nonzero(S > rcond * largest_singular_value)
-    logger.debug('rank = %s', rank)
-
-    if rank < dim - 1:
-        raise UnderdeterminedProblem(
-            'underdetermined problem: not enough linearly independent points, '
-            'missing {0} point(s)'.format(dim - 1 - rank)
-        )
-    elif allow_reflection and rank < dim:
-        raise UnderdeterminedProblem(
+    largest_singular_value = S[..., :1]
+    rank = np.count_nonzero(S > rcond * largest_singular_value, axis=-1)
+    logger.debug('singular values = %s, rank = %s', S, rank)
+
+    _raise_if_missing(
+        dim - 1 - rank,
+        'underdetermined problem: not enough linearly independent points, '
+        'missing {0} point(s)'
+    )
+    if allow_reflection:
+        _raise_if_missing(
+            dim - rank,
             'underdetermined problem: not enough linearly independent points '
             'to detect if a reflection is present, missing {0} point(s)'
-            .format(dim - rank)
         )
 
     # Eq. (39).
     # assert ((np.linalg.det(U) * np.linalg.det(V)) * np.linalg.det(A) >= 0
     #         or np.isclose(np.linalg.det(A), 0))
-    d = np.ones((dim,), dtype=np.double)
-    if not allow_reflection and np.linalg.det(U) * np.linalg.det(V) < 0:
-        d[dim - 1] = -1
+    d = np.ones(S.shape, dtype=np.double)
+    if not allow_reflection:
+        d[..., dim - 1] = np.where(
+            np.linalg.det(U) * np.linalg.det(V) < 0, -1, 1)
 
     # Eq. (40) and (43).
-    T[:dim, :dim] = U @ np.diag(d) @ V
+    rotation = (U * d[..., np.newaxis, :]) @ V
 
     if estimate_scale:
         # Eq. (41) and (42).
-        scale = 1.0 / src_demean.var(axis=0).sum() * (S @ d)
+        scale = np.sum(S * d, axis=-1) / src_variance
     else:
-        scale = 1.0
+        scale = np.ones(S.shape[:-1])
+    scale = np.asarray(scale, dtype=np.double)[..., np.newaxis]
 
-    T[:dim, dim] = dst_mean - scale * (T[:dim, :dim] @ src_mean.T)
-    T[:dim, :dim] *= scale
+    T[..., :dim, dim] = dst_mean - scale * (
+        rotation @ src_mean[..., np.newaxis])[..., 0]
+    T[..., :dim, :dim] = scale[..., np.newaxis] * rotation
 
     return T
@@ -0,0 +1,159 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Configuration of logging from the application config.
+
+The relevant configuration keys are:
+
+- LOG_LEVEL: level of the root logger (by default, the level of Gunicorn's
+  error log when running under Gunicorn, INFO otherwise);
+- LOG_LEVELS: mapping of logger names to levels, e.g.
+  ``{'linear_voluba.leastsquares': 'DEBUG'}``;
+- LOG_FORMAT: ``'text'`` for human-readable lines, or ``'json'`` for one
+  JSON object per line;
+- DEBUG_PAYLOAD_SAMPLE_RATE and DEBUG_PAYLOAD_MAX_BYTES: fraction of the
+  request payloads that are logged at the DEBUG level, and maximum size of
+  the logged excerpt (see :func:`log_request_payload`).
+"""
+
+import datetime
+import json
+import logging
+import logging.config
+import random
+
+import flask
+
+from . import tracing
+
+
+TEXT_FORMAT = ('[%(asctime)s] [%(process)d] %(levelname)s in %(module)s: '
+               '%(message)s')
+TEXT_DATEFMT = '%Y-%m-%d %H:%M:%S %z'
+
+
+class JSONFormatter(logging.Formatter):
+    """Format log records as one JSON object per line.
+
+    The records emitted during a traced request carry the trace identifier
+    (see linear_voluba.tracing).
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        trace_id = tracing.current_trace_id()
+        if trace_id is not None:
+            entry['trace_id'] = trace_id
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class HealthProbeFilter(logging.Filter):
+    """Hide Kubernetes health probes from the Gunicorn access log.
+
+    The checks are ordered so that the vast majority of records (which are
+    not requests to /health, /health/live or /health/ready) are let through
+    after a single dict lookup.
+    """
+
+    def filter(self, record):
+        args = record.args
+        try:
+            if not args['U'].startswith('/health'):
+                return True
+            return not (args['m'] == 'GET'
+                        and args['h'].startswith('10.')
+                        and 'kube-probe' in args['a'])
+        except (KeyError, TypeError):
+            return True
+
+
+def configure_logging(config):
+    """Configure the root logger according to the application config."""
+    if config.get('LOG_FORMAT') == 'json':
+        formatter = {'()': JSONFormatter}
+    else:
+        formatter = {'format': TEXT_FORMAT, 'datefmt': TEXT_DATEFMT}
+    gunicorn_handlers = logging.getLogger('gunicorn.error').handlers
+    # If we are running under Gunicorn, the root logger uses the same handler
+    # as the Gunicorn error stream (unless structured output is requested).
+    use_gunicorn_handlers = (gunicorn_handlers
+                             and config.get('LOG_FORMAT') != 'json')
+    root_level = config.get('LOG_LEVEL')
+    if root_level is None:
+        if gunicorn_handlers:
+            root_level = logging.getLogger('gunicorn.error').level
+        else:
+            root_level = logging.INFO
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,  # preserve Gunicorn loggers
+        'formatters': {'default': formatter},
+        'handlers': {'wsgi': {
+            'class': 'logging.StreamHandler',
+            'stream': 'ext://flask.logging.wsgi_errors_stream',
+            'formatter': 'default'
+        }},
+        'root': {
+            'level': root_level,
+            'handlers': [] if use_gunicorn_handlers else ['wsgi'],
+        },
+        'loggers': {
+            name: {'level': level}
+            for name, level in (config.get('LOG_LEVELS') or {}).items()
+        },
+    })
+    if use_gunicorn_handlers:
+        logging.getLogger().handlers = gunicorn_handlers
+
+
+def install_access_log_filter():
+    access_logger = logging.getLogger('gunicorn.access')
+    if not any(isinstance(f, HealthProbeFilter)
+               for f in access_logger.filters):
+        access_logger.addFilter(HealthProbeFilter())
+
+
+def log_request_payload(logger, msg):
+    """Log an excerpt of the body of the current request at DEBUG level.
+
+    Only a fraction DEBUG_PAYLOAD_SAMPLE_RATE of the requests is logged, and
+    the excerpt is truncated to DEBUG_PAYLOAD_MAX_BYTES. msg must contain a
+    single %s placeholder for the payload.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    config = flask.current_app.config
+    sample_rate = config.get('DEBUG_PAYLOAD_SAMPLE_RATE', 1.0)
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    max_bytes = config.get('DEBUG_PAYLOAD_MAX_BYTES')
+    data = flask.request.get_data(cache=True)
+    if max_bytes is not None and len(data) > max_bytes:
+        payload = '{0}... ({1} bytes truncated)'.format(
+            data[:max_bytes].decode('utf-8', 'replace'),
+            len(data) - max_bytes)
+    else:
+        payload = data.decode('utf-8', 'replace')
+    logger.debug(msg, payload)
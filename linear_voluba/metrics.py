@@ -0,0 +1,138 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Prometheus metrics exposed on the /metrics endpoint.
+
+The metrics are collected with the prometheus_client package, which is
+imported only if ENABLE_METRICS is set. When several Gunicorn workers are
+used, the PROMETHEUS_MULTIPROC_DIR environment variable must point to an empty
+directory that is shared by all workers (see the prometheus_client
+documentation on multiprocess mode), so that /metrics reports the aggregated
+values of all workers whichever worker serves the scrape.
+"""
+
+import os
+
+import flask
+
+from . import timing
+
+
+# Histogram buckets (in seconds) suited to the typical duration of the
+# processing stages, which range from tens of microseconds to seconds.
+STAGE_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Upper bounds of the landmark-count buckets used as labels. Labels must have
+# a small number of distinct values, so the exact count cannot be used.
+LANDMARK_COUNT_BOUNDS = (10, 100, 1000, 10000)
+
+
+def landmark_count_bucket(count):
+    """Return the label of the landmark-count bucket of count."""
+    for bound in LANDMARK_COUNT_BOUNDS:
+        if count < bound:
+            return '<{0}'.format(bound)
+    return '>={0}'.format(LANDMARK_COUNT_BOUNDS[-1])
+
+
+class Metrics:
+    """Collection of the Prometheus metrics of an application."""
+
+    def __init__(self):
+        import prometheus_client
+        self.multiprocess = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+        # A private registry is used so that several applications can be
+        # instantiated in the same process (e.g. in the tests).
+        self.registry = prometheus_client.CollectorRegistry(auto_describe=True)
+        self.requests = prometheus_client.Counter(
+            'voluba_requests', 'Number of HTTP requests handled.',
+            ['endpoint', 'method', 'status'],
+            registry=self.registry,
+        )
+        self.errors = prometheus_client.Counter(
+            'voluba_request_errors',
+            'Number of HTTP requests that resulted in an error response.',
+            ['endpoint', 'status', 'transformation_type'],
+            registry=self.registry,
+        )
+        self.request_duration = prometheus_client.Histogram(
+            'voluba_request_duration_seconds',
+            'Duration of the processing of instrumented requests.',
+            ['endpoint', 'transformation_type', 'landmarks'],
+            buckets=STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.stage_duration = prometheus_client.Histogram(
+            'voluba_stage_duration_seconds',
+            'Duration of each stage of the processing of instrumented '
+            'requests (validate, solve, invert, mismatch, serialize).',
+            ['endpoint', 'stage', 'transformation_type', 'landmarks'],
+            buckets=STAGE_BUCKETS,
+            registry=self.registry,
+        )
+
+    def observe(self, response, timings):
+        request = flask.request
+        if request.url_rule is None:
+            endpoint = 'unmatched'
+        else:
+            endpoint = request.url_rule.rule
+        if endpoint == '/metrics':
+            return
+        status = response.status_code
+        self.requests.labels(endpoint, request.method, status).inc()
+        transformation_type = timings.labels.get('transformation_type', '')
+        if status >= 400:
+            self.errors.labels(endpoint, status, transformation_type).inc()
+            # Fast failures would pull the latency histograms down
+            return
+        if not timings.stages:
+            return
+        landmarks = landmark_count_bucket(
+            timings.labels.get('landmark_count', 0))
+        self.request_duration.labels(
+            endpoint, transformation_type, landmarks
+        ).observe(timings.total_ns * 1e-9)
+        for stage_name, duration_ns in timings.stages:
+            self.stage_duration.labels(
+                endpoint, stage_name, transformation_type, landmarks
+            ).observe(duration_ns * 1e-9)
+
+    def generate(self):
+        import prometheus_client
+        if self.multiprocess:
+            from prometheus_client import multiprocess
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = self.registry
+        return (prometheus_client.generate_latest(registry),
+                prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """Collect metrics on the application and expose them on /metrics."""
+    metrics = Metrics()
+    app.extensions['voluba_metrics'] = metrics
+    timing.add_listener(app, metrics.observe)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        data, content_type = metrics.generate()
+        return flask.Response(data, content_type=content_type)
@@ -0,0 +1,93 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Serving of the OpenAPI document from a per-process cache.
+
+The spec is serialized (and gzip-compressed) only once per process, when it
+is first requested. It is then served as pre-built bytes with a strong ETag,
+so that clients can revalidate their cached copy cheaply, and with a
+Cache-Control header whose max-age is set by OPENAPI_CACHE_MAX_AGE.
+
+The cached view replaces the view of flask_smorest on its JSON endpoint
+(see :func:`init_app`), so that the documentation pages (ReDoc and Swagger
+UI) also load the cached spec.
+"""
+
+import gzip
+import hashlib
+import json
+
+import flask
+
+
+# Endpoint of the JSON spec in the documentation blueprint of flask_smorest
+JSON_ENDPOINT = 'api-docs.openapi_json'
+
+
+class SerializedSpec:
+    """Pre-serialized representations of an OpenAPI document."""
+
+    def __init__(self, spec_dict):
+        # Same serialization as flask_smorest (json.dumps preserves the order
+        # of the keys, whereas Flask.jsonify would sort them).
+        self.identity = json.dumps(spec_dict, indent=2).encode('utf-8')
+        self.gzip = gzip.compress(self.identity, compresslevel=9)
+        digest = hashlib.sha256(self.identity).hexdigest()[:32]
+        self.identity_etag = digest
+        # Each representation needs its own strong validator
+        self.gzip_etag = digest + '-gzip'
+
+
+def serve_spec(serialized_spec):
+    """Return the response to a request for the serialized spec."""
+    request = flask.request
+    use_gzip = request.accept_encodings['gzip'] > 0
+    if use_gzip:
+        body = serialized_spec.gzip
+        etag = serialized_spec.gzip_etag
+    else:
+        body = serialized_spec.identity
+        etag = serialized_spec.identity_etag
+    response = flask.current_app.response_class(
+        body, mimetype='application/json')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = flask.current_app.config.get(
+        'OPENAPI_CACHE_MAX_AGE')
+    return response.make_conditional(request)
+
+
+def init_app(app, api):
+    """Serve the spec of api (a flask_smorest.Api) from a per-process cache.
+
+    The spec is serialized on the first request, once all the blueprints
+    have been registered.
+    """
+    if JSON_ENDPOINT not in app.view_functions:
+        raise RuntimeError('flask_smorest does not serve the spec at the '
+                           '{0} endpoint'.format(JSON_ENDPOINT))
+    cache = []
+
+    def openapi_json():
+        """Serve JSON spec file"""
+        if not cache:
+            cache.append(SerializedSpec(api.spec.to_dict()))
+        return serve_spec(cache[0])
+
+    app.view_functions[JSON_ENDPOINT] = openapi_json
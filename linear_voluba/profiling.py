@@ -0,0 +1,180 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""On-demand profiling of live requests with cProfile.
+
+Profiling is triggered for a request if one of these conditions is met:
+
+- the request carries a ``X-Voluba-Profile`` header containing a token that
+  was signed with PROFILING_SECRET (see :func:`make_token`);
+- the request comes from an address listed in PROFILING_ALLOWED_ADDRESSES and
+  carries a ``X-Voluba-Profile`` header (with any value);
+- the request is drawn at random, with probability PROFILING_SAMPLE_RATE.
+
+The profile is written in the ``profiles`` sub-directory of the instance
+folder, in the binary format of :mod:`pstats`, next to a JSON file describing
+the anonymised shape of the request (number of landmarks and transformation
+type). Only the PROFILING_MAX_FILES most recent profiles are kept. The
+request hooks are not installed at all if profiling is disabled.
+
+Note that cProfile measures the whole thread, so with the gevent worker the
+profile may include the work of other greenlets that ran concurrently.
+"""
+
+import cProfile
+import glob
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import os
+import random
+import time
+
+import flask
+
+from . import timing
+
+
+logger = logging.getLogger(__name__)
+
+HEADER_NAME = 'X-Voluba-Profile'
+
+
+def _signature(secret, expiry):
+    return hmac.new(secret.encode('utf-8'), str(expiry).encode('ascii'),
+                    hashlib.sha256).hexdigest()
+
+
+def make_token(secret, lifetime=3600):
+    """Create a value for the X-Voluba-Profile header.
+
+    The token is valid for lifetime seconds.
+    """
+    expiry = int(time.time()) + lifetime
+    return '{0}:{1}'.format(expiry, _signature(secret, expiry))
+
+
+def verify_token(secret, token):
+    """Check that the token was created by make_token and has not expired."""
+    try:
+        expiry_str, signature = token.split(':', 1)
+        expiry = int(expiry_str)
+    except ValueError:
+        return False
+    if expiry < time.time():
+        return False
+    return hmac.compare_digest(signature, _signature(secret, expiry))
+
+
+class RequestProfiler:
+    def __init__(self, app):
+        self.sample_rate = app.config.get('PROFILING_SAMPLE_RATE') or 0.0
+        self.secret = app.config.get('PROFILING_SECRET')
+        self.allowed_addresses = frozenset(
+            app.config.get('PROFILING_ALLOWED_ADDRESSES') or ())
+        self.max_files = app.config.get('PROFILING_MAX_FILES') or 100
+        self._counter = itertools.count()
+
+    def trigger(self, request):
+        """Return the reason for profiling the request, or None."""
+        header = request.headers.get(HEADER_NAME)
+        if header is not None:
+            if request.remote_addr in self.allowed_addresses:
+                return 'allow-list'
+            if self.secret and verify_token(self.secret, header):
+                return 'token'
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sampled'
+        return None
+
+    def start(self):
+        reason = self.trigger(flask.request)
+        if reason is None:
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return
+        flask.g.profile = (profile, reason)
+
+    def finish(self, response, timings):
+        profile, reason = flask.g.pop('profile', (None, None))
+        if profile is None:
+            return
+        profile.disable()
+        output_dir = os.path.join(flask.current_app.instance_path, 'profiles')
+        basename = os.path.join(output_dir, '{0}-{1}-{2}'.format(
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid(), next(self._counter)))
+        shape = {
+            'method': flask.request.method,
+            'path': flask.request.path,
+            'status': response.status_code,
+            'trigger': reason,
+            'transformation_type': timings.labels.get('transformation_type'),
+            'landmark_count': timings.labels.get('landmark_count'),
+            'duration': timings.total_ns * 1e-9,
+            'stages': {stage_name: duration_ns * 1e-9
+                       for stage_name, duration_ns in timings.stages},
+        }
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            profile.dump_stats(basename + '.prof')
+            with open(basename + '.json', 'w') as f:
+                json.dump(shape, f)
+        except OSError:
+            logger.exception('cannot write the profile of the request')
+            return
+        logger.info('Request profile written to %s.prof', basename)
+        self._prune(output_dir)
+
+    def _prune(self, output_dir):
+        # The files are shared with the other processes, which may remove
+        # them concurrently
+        profiles = []
+        for path in glob.glob(os.path.join(output_dir, '*.prof')):
+            try:
+                profiles.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        profiles.sort(reverse=True)
+        for _, path in profiles[self.max_files:]:
+            for extension in ('.prof', '.json'):
+                try:
+                    os.remove(path[:-len('.prof')] + extension)
+                except OSError:
+                    pass
+
+    def teardown(self, exc):
+        # Stop the profiler if the request ended with an unhandled exception
+        profile, _ = flask.g.pop('profile', (None, None))
+        if profile is not None:
+            profile.disable()
+
+
+def init_app(app):
+    """Install the request hooks, if profiling is enabled in the config."""
+    if not (app.config.get('PROFILING_SAMPLE_RATE')
+            or app.config.get('PROFILING_SECRET')
+            or app.config.get('PROFILING_ALLOWED_ADDRESSES')):
+        return
+    profiler = RequestProfiler(app)
+    timing.add_listener(app, profiler.finish)
+    app.before_request(profiler.start)
+    app.teardown_request(profiler.teardown)
@@ -0,0 +1,43 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Readiness of the process to serve requests, reported by /health/ready.
+
+The process becomes ready at the end of create_app, once the solvers have
+been warmed up (see WARMUP). It stops being ready when it starts shutting
+down: the hooks of :mod:`linear_voluba.gunicorn_conf` call
+:func:`set_not_ready` when a worker is interrupted or exits, so that the
+probe fails while the worker drains its last requests. This does not depend
+on how the application is loaded by Gunicorn (with or without preload_app or
+--reload): a worker that loads the application itself is not ready until
+create_app has returned.
+"""
+
+_ready = False
+
+
+def set_ready():
+    global _ready
+    _ready = True
+
+
+def set_not_ready():
+    global _ready
+    _ready = False
+
+
+def is_ready():
+    return _ready
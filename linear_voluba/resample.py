@@ -0,0 +1,563 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Resampling of a volume into the grid of another, with a linear transform.
+
+The source volume is memory-mapped, and the output volume is computed by
+bricks, which are processed in parallel by a pool of processes and written
+directly into a memory-mapped output file. Each brick only reads the block
+of the source volume that it needs, so the peak memory does not depend on
+the size of the volumes. The output file is only given its final name once
+it is complete.
+
+Supported formats are uncompressed NIfTI-1 (``.nii``), numpy (``.npy``), and
+raw arrays (whose shape and data type must be given). Compressed files
+cannot be memory-mapped, they must be decompressed beforehand.
+
+Command-line usage::
+
+    python3 -m linear_voluba.resample source.nii output.nii \\
+        --reference target.nii --matrix response.json
+
+where response.json contains a 4×4 matrix, or a response of
+/api/least-squares.
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import struct
+import sys
+import uuid
+
+import numpy as np
+
+
+INTERPOLATIONS = ['nearest', 'linear']
+
+# Side of the cubic bricks of the output volume
+DEFAULT_BRICK_SIZE = 64
+
+# Maximum number of source voxels that a brick can read at once: bricks that
+# need a larger block of the source volume (e.g. when it is downsampled) are
+# split further.
+MAX_BLOCK_VOXELS = 16 * 2 ** 20
+
+_NIFTI1_HEADER_SIZE = 348
+_NIFTI1_VOX_OFFSET = 352
+_NIFTI1_DTYPES = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+    1024: np.int64,
+    1280: np.uint64,
+}
+_NIFTI1_CODES = {np.dtype(dtype): code
+                 for code, dtype in _NIFTI1_DTYPES.items()}
+
+
+class VolumeFile:
+    """A volume stored in a file, which can be memory-mapped.
+
+    affine is the 4×4 matrix from voxel indices to physical coordinates.
+    scaling is a (slope, intercept) pair to apply to the stored values, or
+    None.
+    """
+
+    def __init__(self, path, shape, dtype, offset=0, order='C', affine=None,
+                 scaling=None):
+        self.path = path
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self.order = order
+        self.affine = np.eye(4) if affine is None else np.asarray(affine)
+        self.scaling = scaling
+
+    def open(self, mode='r'):
+        return np.memmap(self.path, dtype=self.dtype, mode=mode,
+                         offset=self.offset, shape=self.shape,
+                         order=self.order)
+
+
+def _quaternion_affine(quatern, qoffset, pixdim):
+    b, c, d = quatern
+    a = np.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+    rotation = np.array([
+        [a * a + b * b - c * c - d * d, 2 * (b * c - a * d),
+         2 * (b * d + a * c)],
+        [2 * (b * c + a * d), a * a + c * c - b * b - d * d,
+         2 * (c * d - a * b)],
+        [2 * (b * d - a * c), 2 * (c * d + a * b),
+         a * a + d * d - c * c - b * b],
+    ])
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    affine = np.eye(4)
+    affine[:3, :3] = rotation * [pixdim[1], pixdim[2], qfac * pixdim[3]]
+    affine[:3, 3] = qoffset
+    return affine
+
+
+def read_nifti_header(path):
+    """Read the header of an uncompressed NIfTI-1 file as a VolumeFile."""
+    with open(path, 'rb') as f:
+        header = f.read(_NIFTI1_HEADER_SIZE)
+    if len(header) < _NIFTI1_HEADER_SIZE:
+        raise ValueError('{0} is not a NIfTI-1 file'.format(path))
+    for endianness in '<>':
+        if struct.unpack(endianness + 'i', header[:4])[0] \
+                == _NIFTI1_HEADER_SIZE:
+            break
+    else:
+        raise ValueError('{0} is not a NIfTI-1 file'.format(path))
+    if header[344:348] != b'n+1\0':
+        raise ValueError('{0} is not a single-file NIfTI-1 image'
+                         .format(path))
+
+    def unpack(fmt, offset):
+        return struct.unpack_from(endianness + fmt, header, offset)
+    dim = unpack('8h', 40)
+    if not 3 <= dim[0] <= 7 or any(n != 1 for n in dim[4:dim[0] + 1]):
+        raise ValueError('{0} is not a 3-dimensional volume'.format(path))
+    datatype, = unpack('h', 70)
+    try:
+        dtype = np.dtype(_NIFTI1_DTYPES[datatype]).newbyteorder(endianness)
+    except KeyError:
+        raise ValueError('unsupported NIfTI datatype {0}'
+                         .format(datatype)) from None
+    pixdim = unpack('8f', 76)
+    vox_offset, scl_slope, scl_inter = unpack('3f', 108)
+    qform_code, sform_code = unpack('2h', 252)
+    if sform_code > 0:
+        affine = np.eye(4)
+        affine[:3] = np.reshape(unpack('12f', 280), (3, 4))
+    elif qform_code > 0:
+        affine = _quaternion_affine(unpack('3f', 256), unpack('3f', 268),
+                                    pixdim)
+    else:
+        affine = np.diag([pixdim[1], pixdim[2], pixdim[3], 1.0])
+    scaling = None
+    # A slope of 0 (or NaN) means that the values are not scaled
+    if np.isfinite(scl_slope) and scl_slope != 0.0:
+        scl_inter = scl_inter if np.isfinite(scl_inter) else 0.0
+        if (scl_slope, scl_inter) != (1.0, 0.0):
+            scaling = (scl_slope, scl_inter)
+    return VolumeFile(path, dim[1:4], dtype, offset=int(vox_offset),
+                      order='F', affine=affine, scaling=scaling)
+
+
+def write_nifti_header(path, shape, dtype, affine):
+    """Create an uncompressed NIfTI-1 file, return it as a VolumeFile.
+
+    The data is not written (the file is extended with zeros), it is meant
+    to be written through VolumeFile.open('r+').
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    try:
+        datatype = _NIFTI1_CODES[dtype.newbyteorder('=')]
+    except KeyError:
+        raise ValueError('data type {0} cannot be stored in NIfTI'
+                         .format(dtype)) from None
+    affine = np.asarray(affine, dtype=float)
+    header = bytearray(_NIFTI1_HEADER_SIZE)
+    struct.pack_into('<i', header, 0, _NIFTI1_HEADER_SIZE)
+    struct.pack_into('<8h', header, 40, 3, *shape, 1, 1, 1, 1)
+    struct.pack_into('<2h', header, 70, datatype, dtype.itemsize * 8)
+    voxel_size = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+    struct.pack_into('<8f', header, 76, 1.0, *voxel_size, 1, 1, 1, 1)
+    struct.pack_into('<3f', header, 108, _NIFTI1_VOX_OFFSET, 1.0, 0.0)
+    struct.pack_into('<B', header, 123, 2)  # xyzt_units: millimetres
+    struct.pack_into('<2h', header, 252, 0, 2)  # sform_code: aligned
+    struct.pack_into('<12f', header, 280, *affine[:3].ravel())
+    header[344:348] = b'n+1\0'
+    size = _NIFTI1_VOX_OFFSET + int(np.prod(shape)) * dtype.itemsize
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(b'\0' * (_NIFTI1_VOX_OFFSET - _NIFTI1_HEADER_SIZE))
+        f.truncate(size)
+    return VolumeFile(path, shape, dtype, offset=_NIFTI1_VOX_OFFSET,
+                      order='F', affine=affine)
+
+
+def _read_npy_header(path):
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if len(shape) != 3:
+        raise ValueError('{0} is not a 3-dimensional volume'.format(path))
+    return VolumeFile(path, shape, dtype, offset=offset,
+                      order='F' if fortran_order else 'C')
+
+
+def open_volume(path, raw_shape=None, raw_dtype=None, raw_offset=0,
+                raw_order='C', affine=None):
+    """Describe the volume stored in path, according to its extension.
+
+    raw_shape and raw_dtype are required for files that are neither NIfTI
+    (.nii) nor numpy (.npy). affine overrides the affine of the file.
+    """
+    if path.endswith(('.gz', '.bz2', '.zst')):
+        raise ValueError('compressed volumes cannot be memory-mapped, please '
+                         'decompress {0}'.format(path))
+    if path.endswith('.nii'):
+        volume = read_nifti_header(path)
+    elif path.endswith('.npy'):
+        volume = _read_npy_header(path)
+    else:
+        if raw_shape is None or raw_dtype is None:
+            raise ValueError('the shape and data type of the raw volume {0} '
+                             'must be given'.format(path))
+        volume = VolumeFile(path, raw_shape, raw_dtype, offset=raw_offset,
+                            order=raw_order)
+    if affine is not None:
+        volume.affine = np.asarray(affine, dtype=float)
+    return volume
+
+
+def create_volume(path, shape, dtype, affine):
+    """Create the output volume file (NIfTI for .nii, numpy otherwise)."""
+    if path.endswith('.nii'):
+        return write_nifti_header(path, shape, dtype, affine)
+    np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                              shape=tuple(shape))
+    volume = _read_npy_header(path)
+    volume.affine = np.asarray(affine, dtype=float)
+    return volume
+
+
+def voxel_mapping(matrix, source_affine, target_affine):
+    """Matrix from target voxel indices to source voxel indices.
+
+    matrix transforms physical coordinates from the source space to the
+    target space (as returned by /api/least-squares).
+    """
+    return (np.linalg.inv(source_affine) @ np.linalg.inv(matrix)
+            @ target_affine)
+
+
+def make_bricks(shape, brick_size=DEFAULT_BRICK_SIZE):
+    """Split a volume of the given shape into (start, stop) bricks."""
+    ranges = [[(start, min(start + brick_size, n))
+               for start in range(0, n, brick_size)] for n in shape]
+    return [tuple(zip(*brick_ranges))
+            for brick_ranges in itertools.product(*ranges)]
+
+
+def _source_block(mapping, start, stop, source_shape, margin):
+    """Bounding box of the source voxels needed by the brick (or None)."""
+    corners = np.array([[c[0], c[1], c[2], 1] for c in np.ndindex(2, 2, 2)],
+                       dtype=float)
+    corners[:, :3] = np.where(corners[:, :3] == 0, start,
+                              np.subtract(stop, 1))
+    mapped = corners @ mapping[:3].T
+    low = np.maximum(np.floor(mapped.min(axis=0)) - margin, 0).astype(int)
+    high = np.minimum(np.ceil(mapped.max(axis=0)) + margin + 1,
+                      source_shape).astype(int)
+    if np.any(high <= low):
+        return None
+    return low, high
+
+
+def _sample(block, low, source_shape, coords, interpolation):
+    """Sample the block of the source volume at the source voxel coords.
+
+    low is the position of the block in the source volume. NaN is returned
+    for the coordinates that fall outside of the source volume.
+    """
+    source_shape = np.reshape(source_shape, (3,) + (1,) * coords[0].ndim)
+    if interpolation == 'nearest':
+        indices = np.rint(coords).astype(int)
+        valid = np.all((indices >= 0) & (indices < source_shape), axis=0)
+        local = [np.clip(indices[axis] - low[axis], 0,
+                         block.shape[axis] - 1) for axis in range(3)]
+        values = block[tuple(local)].astype(float)
+    else:
+        # Tolerate rounding errors on the borders of the source volume
+        tolerance = 1e-6
+        valid = np.all((coords >= -tolerance)
+                       & (coords <= source_shape - 1 + tolerance), axis=0)
+        floor = np.clip(np.floor(coords), 0,
+                        np.maximum(source_shape - 2, 0)).astype(int)
+        weights = np.clip(coords - floor, 0, 1)
+        values = np.zeros(coords.shape[1:])
+        for corner in np.ndindex(2, 2, 2):
+            weight = np.ones(coords.shape[1:])
+            local = []
+            for axis in range(3):
+                index = np.minimum(floor[axis] + corner[axis],
+                                   source_shape[axis] - 1)
+                local.append(np.clip(index - low[axis], 0,
+                                     block.shape[axis] - 1))
+                weight *= (weights[axis] if corner[axis]
+                           else 1 - weights[axis])
+            values += weight * block[tuple(local)]
+    values[~valid] = np.nan
+    return values
+
+
+def resample_brick(source, output, mapping, start, stop,
+                   interpolation='linear', fill_value=0,
+                   max_block_voxels=MAX_BLOCK_VOXELS):
+    """Compute the [start, stop) brick of the output volume.
+
+    source and output are VolumeFile objects, which are memory-mapped by
+    this function (so that it can run in another process).
+    """
+    margin = 0 if interpolation == 'nearest' else 1
+    block_range = _source_block(mapping, start, stop, source.shape, margin)
+    if block_range is not None:
+        low, high = block_range
+        sizes = np.subtract(stop, start)
+        if np.prod(high - low) > max_block_voxels and np.any(sizes > 1):
+            # Split the brick in two along its longest axis
+            axis = int(np.argmax(sizes))
+            middle = list(stop)
+            middle[axis] = start[axis] + sizes[axis] // 2
+            second_start = list(start)
+            second_start[axis] = middle[axis]
+            for brick in ((start, tuple(middle)),
+                          (tuple(second_start), stop)):
+                resample_brick(source, output, mapping, *brick,
+                               interpolation=interpolation,
+                               fill_value=fill_value,
+                               max_block_voxels=max_block_voxels)
+            return
+
+    out = output.open('r+')
+    brick = tuple(slice(a, b) for a, b in zip(start, stop))
+    if block_range is None:
+        out[brick] = fill_value
+        out.flush()
+        return
+    block = np.asarray(source.open('r')[tuple(slice(a, b) for a, b
+                                              in zip(low, high))])
+    # Coordinates are computed by broadcasting rather than by a matrix
+    # product, which would start BLAS threads in every process of the pool
+    grid = np.ogrid[brick]
+    coords = np.array([mapping[axis, 0] * grid[0] + mapping[axis, 1] * grid[1]
+                       + mapping[axis, 2] * grid[2] + mapping[axis, 3]
+                       for axis in range(3)])
+    values = _sample(block, low, source.shape, coords, interpolation)
+    if source.scaling is not None:
+        slope, intercept = source.scaling
+        values = values * slope + intercept
+    values[np.isnan(values)] = fill_value
+    if output.dtype.kind in 'iub':
+        info = np.iinfo(output.dtype)
+        values = np.clip(np.rint(values), info.min, info.max)
+    out[brick] = values
+    out.flush()
+
+
+def default_dtype(source, interpolation):
+    """Data type of the output: that of the source, unless it is an integer
+    type and the values are interpolated or scaled."""
+    if source.dtype.kind == 'f' or (interpolation == 'nearest'
+                                    and source.scaling is None):
+        return source.dtype.newbyteorder('=')
+    return np.dtype(np.float32)
+
+
+def _create_partial_file(output_path):
+    """Create an empty file next to output_path, with a unique hidden name.
+
+    The name keeps the extension of output_path, which selects the format of
+    the volume.
+    """
+    directory, name = os.path.split(output_path)
+    root, extension = os.path.splitext(name)
+    while True:
+        path = os.path.join(directory, '.{0}.{1}.partial{2}'.format(
+            root, uuid.uuid4().hex[:8], extension))
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o666))
+        except FileExistsError:
+            continue
+        return path
+
+
+def resample(source, output_path, matrix, target_shape, target_affine,
+             interpolation='linear', dtype=None, fill_value=0, workers=None,
+             brick_size=DEFAULT_BRICK_SIZE, overwrite=True):
+    """Resample the source volume into a target grid.
+
+    source is a VolumeFile (see open_volume), matrix transforms physical
+    coordinates from the source space to the target space. The output volume
+    has the target_shape and target_affine, and is written to output_path
+    (NIfTI if it ends in .nii, numpy otherwise). workers is the number of
+    processes (all available CPUs by default, 1 runs in this process).
+    Return the output VolumeFile.
+
+    The volume is computed in a hidden file of the same directory, which is
+    renamed to output_path once complete: an interrupted run leaves no
+    partial output. If overwrite is False, FileExistsError is raised if
+    output_path exists, including when it is created by someone else during
+    the computation.
+    """
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError('unknown interpolation {0!r}'.format(interpolation))
+    if dtype is None:
+        dtype = default_dtype(source, interpolation)
+    if not overwrite and os.path.lexists(output_path):
+        raise FileExistsError('{0} already exists'.format(output_path))
+    if workers is None:
+        from . import resources
+        workers = resources.available_cpus()
+    partial_path = _create_partial_file(output_path)
+    try:
+        output = create_volume(partial_path, target_shape, dtype,
+                               target_affine)
+        _resample_bricks(source, output, matrix, interpolation, fill_value,
+                         workers, brick_size)
+        if overwrite:
+            os.replace(partial_path, output_path)
+        else:
+            # Unlike a rename, a hard link never replaces an existing file
+            try:
+                os.link(partial_path, output_path)
+            except FileExistsError:
+                raise FileExistsError('{0} already exists'
+                                      .format(output_path)) from None
+            os.unlink(partial_path)
+    except BaseException:
+        try:
+            os.unlink(partial_path)
+        except OSError:
+            pass
+        raise
+    output.path = output_path
+    return output
+
+
+def _resample_bricks(source, output, matrix, interpolation, fill_value,
+                     workers, brick_size):
+    mapping = voxel_mapping(matrix, source.affine, output.affine)
+    bricks = make_bricks(output.shape, brick_size)
+    kwargs = {'interpolation': interpolation, 'fill_value': fill_value}
+    if workers <= 1 or len(bricks) <= 1:
+        for start, stop in bricks:
+            resample_brick(source, output, mapping, start, stop, **kwargs)
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(resample_brick, source, output, mapping,
+                                   start, stop, **kwargs)
+                   for start, stop in bricks]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+
+def resolve_data_path(data_directory, relative_path):
+    """Resolve a path relative to data_directory, refusing to escape it."""
+    root = os.path.realpath(data_directory)
+    path = os.path.realpath(os.path.join(root, relative_path))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError('{0} is outside of the data directory'
+                         .format(relative_path))
+    return path
+
+
+def read_matrix(path):
+    """Read a 4×4 matrix (or a response of /api/least-squares) from JSON."""
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data['transformation_matrix']
+    matrix = np.asarray(data, dtype=float)
+    if matrix.shape == (3, 4):
+        matrix = np.r_[matrix, [[0, 0, 0, 1]]]
+    if matrix.shape != (4, 4):
+        raise ValueError('invalid matrix shape {0}'.format(matrix.shape))
+    return matrix
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description='Resample a volume into the grid of a target volume, '
+                    'with a matrix estimated by voluba-linear-backend.')
+    parser.add_argument('source', help='source volume (.nii, .npy, or raw)')
+    parser.add_argument('output', help='output volume (.nii or .npy)')
+    parser.add_argument('--matrix', required=True,
+                        help='JSON file containing the 4×4 matrix from '
+                        'source to target space, or a response of '
+                        '/api/least-squares')
+    grid = parser.add_mutually_exclusive_group(required=True)
+    grid.add_argument('--reference',
+                      help='volume that defines the target grid')
+    grid.add_argument('--shape', type=int, nargs=3,
+                      help='shape of the target grid (its voxel-to-'
+                      'physical matrix is given by --affine)')
+    parser.add_argument('--affine',
+                        help='JSON file containing the voxel-to-physical '
+                        'matrix of the target grid (identity by default)')
+    parser.add_argument('--interpolation', choices=INTERPOLATIONS,
+                        default='linear')
+    parser.add_argument('--dtype', help='data type of the output')
+    parser.add_argument('--fill-value', type=float, default=0,
+                        help='value of the voxels outside of the source')
+    parser.add_argument('--workers', type=int,
+                        help='number of processes (default: available CPUs)')
+    parser.add_argument('--brick-size', type=int, default=DEFAULT_BRICK_SIZE)
+    raw = parser.add_argument_group('raw source volumes')
+    raw.add_argument('--raw-shape', type=int, nargs=3)
+    raw.add_argument('--raw-dtype')
+    raw.add_argument('--raw-offset', type=int, default=0,
+                     help='size of the header to skip, in bytes')
+    raw.add_argument('--raw-fortran-order', action='store_true')
+    raw.add_argument('--source-affine',
+                     help='JSON file containing the voxel-to-physical '
+                     'matrix of the source volume')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_command_line(argv)
+    source = open_volume(
+        args.source, raw_shape=args.raw_shape, raw_dtype=args.raw_dtype,
+        raw_offset=args.raw_offset,
+        raw_order='F' if args.raw_fortran_order else 'C',
+        affine=read_matrix(args.source_affine) if args.source_affine
+        else None)
+    if args.reference:
+        reference = open_volume(args.reference)
+        target_shape, target_affine = reference.shape, reference.affine
+    else:
+        target_shape = args.shape
+        target_affine = (read_matrix(args.affine) if args.affine
+                         else np.eye(4))
+    resample(source, args.output, read_matrix(args.matrix),
+             target_shape, target_affine,
+             interpolation=args.interpolation, dtype=args.dtype,
+             fill_value=args.fill_value, workers=args.workers,
+             brick_size=args.brick_size)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Background jobs of /api/resample.
+
+Resampling a large volume takes much longer than a request may last, so each
+resampling runs in a separate process (``python3 -m
+linear_voluba.resample_jobs``), started by :meth:`JobStore.submit`. The
+records of the jobs are JSON files in a directory that is shared by the
+worker processes (RESAMPLE_JOB_DIRECTORY), so that the status of a job can
+be polled through any worker, and a job outlives the recycling of the worker
+that started it.
+
+A job holds an exclusive lock on its lock file until its process exits (the
+lock is taken by the server, and inherited by the process), so a job whose
+process was killed is reported as failed rather than running forever. The
+records of the finished jobs are removed after RESAMPLE_JOB_TTL seconds.
+The number of running jobs is limited for all the processes together: the
+jobs are counted and started under an exclusive lock on the directory.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from . import resample
+from . import singleflight
+
+
+logger = logging.getLogger(__name__)
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class TooManyJobs(RuntimeError):
+    """Exception raised when the maximum number of running jobs is reached."""
+    pass
+
+
+def _write_record(path, job):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _job_environment():
+    # The job process must import this package even if it is not installed
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        path for path in (package_root, env.get('PYTHONPATH')) if path)
+    return env
+
+
+class JobStore:
+    """Records of the jobs, shared by the processes using the same directory.
+
+    A record is a dictionary with the job_id, the status of the job (RUNNING,
+    DONE or FAILED), the request that it runs (see :func:`run_job`), and the
+    time at which it finished. ttl is the duration (in seconds) for which
+    the record of a finished job is kept.
+    """
+
+    def __init__(self, directory, ttl, clock=time.time, poll_interval=0.005):
+        self.directory = directory
+        self.ttl = ttl
+        self.clock = clock
+        self.poll_interval = poll_interval
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, job_id, suffix='.json'):
+        # The identifiers come from the URL: reject anything but our own
+        if not _JOB_ID_RE.match(job_id):
+            return None
+        return os.path.join(self.directory, job_id + suffix)
+
+    def _job_ids(self):
+        return [filename[:-len('.json')]
+                for filename in os.listdir(self.directory)
+                if filename.endswith('.json')]
+
+    def _read(self, job_id):
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _is_running(self, job_id):
+        """Whether the process of a job still holds its lock."""
+        try:
+            with open(self._path(job_id, '.lock'), 'rb') as lock_file:
+                return not singleflight.try_lock(lock_file)
+        except FileNotFoundError:
+            return False
+
+    def get(self, job_id):
+        """Return the record of a job, or None if it is unknown or expired."""
+        if self._path(job_id) is None:
+            return None
+        job = self._read(job_id)
+        if job is None:
+            return None
+        if job['status'] == RUNNING and not self._is_running(job_id):
+            # The process writes its result before releasing the lock
+            job = self._read(job_id)
+            if job is None:
+                return None
+            if job['status'] == RUNNING:
+                job.update(status=FAILED, message='the job was interrupted',
+                           finished=self.clock())
+                _write_record(self._path(job_id), job)
+        if (job['status'] != RUNNING
+                and self.clock() - job['finished'] > self.ttl):
+            return None
+        return job
+
+    def running_count(self):
+        """Return the number of jobs whose process is running."""
+        return sum(self._is_running(job_id) for job_id in self._job_ids())
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Lock the whole directory (in all processes) for starting a job."""
+        lock_path = os.path.join(self.directory, 'submit.lock')
+        with open(lock_path, 'a') as lock_file:
+            while not singleflight.try_lock(lock_file):
+                time.sleep(self.poll_interval)
+            yield
+
+    def submit(self, request, max_running=None):
+        """Start a job in a new process, return its record.
+
+        request contains the arguments of the resampling (see
+        :func:`run_job`). TooManyJobs is raised if max_running jobs are
+        already running, in any process that uses the same directory.
+        """
+        with self._locked():
+            self.cleanup()
+            if (max_running is not None
+                    and self.running_count() >= max_running):
+                raise TooManyJobs('{0} jobs are already running'
+                                  .format(max_running))
+            job_id = uuid.uuid4().hex
+            job = {'job_id': job_id, 'status': RUNNING, 'request': request}
+            lock_path = self._path(job_id, '.lock')
+            with open(lock_path, 'wb') as lock_file:
+                singleflight.try_lock(lock_file)
+                try:
+                    _write_record(self._path(job_id), job)
+                    # The process shares the lock through its copy of the
+                    # file descriptor, and keeps it until it exits
+                    subprocess.Popen(
+                        [sys.executable, '-m', __name__, self._path(job_id)],
+                        stdin=subprocess.DEVNULL,
+                        pass_fds=(lock_file.fileno(),),
+                        start_new_session=True,
+                        env=_job_environment())
+                except BaseException:
+                    self._remove(job_id)
+                    raise
+        return job
+
+    def _remove(self, job_id):
+        for suffix in ('.json', '.lock'):
+            try:
+                os.unlink(self._path(job_id, suffix))
+            except OSError:
+                pass
+
+    def cleanup(self):
+        """Remove the records of the jobs that have expired."""
+        for job_id in self._job_ids():
+            if self.get(job_id) is None:
+                self._remove(job_id)
+
+
+def run_job(path):
+    """Run the job whose record is in path, and write its result there.
+
+    The request of the job contains the absolute source_path, target_path
+    and output_path, the output_image (relative to the data directory), the
+    transformation_matrix, the interpolation, and the number of workers.
+    """
+    with open(path) as f:
+        job = json.load(f)
+    request = job['request']
+    try:
+        source = resample.open_volume(request['source_path'])
+        target = resample.open_volume(request['target_path'])
+        output = resample.resample(
+            source, request['output_path'],
+            np.asarray(request['transformation_matrix']),
+            target.shape, target.affine,
+            interpolation=request['interpolation'],
+            workers=request['workers'],
+            overwrite=False,
+        )
+    except FileExistsError:
+        job.update(status=FAILED, message='{0} already exists'
+                   .format(request['output_image']))
+    except (OSError, ValueError) as exc:
+        job.update(status=FAILED, message=str(exc))
+    except Exception:
+        logger.exception('resampling job %s failed', job['job_id'])
+        job.update(status=FAILED, message='internal error')
+    else:
+        job.update(status=DONE, shape=list(output.shape),
+                   dtype=output.dtype.name, affine=output.affine.tolist())
+    job['finished'] = time.time()
+    _write_record(path, job)
+
+
+def get_store(app=None):
+    """Return the JobStore of the application (created on first use)."""
+    # Imported here, the job processes do not need Flask
+    import flask
+    if app is None:
+        app = flask.current_app
+    store = app.extensions.get('voluba_resample_jobs')
+    if store is None:
+        directory = app.config.get('RESAMPLE_JOB_DIRECTORY')
+        if directory is None:
+            directory = os.path.join(app.instance_path, 'resample-jobs')
+        store = app.extensions.setdefault('voluba_resample_jobs', JobStore(
+            directory, ttl=app.config['RESAMPLE_JOB_TTL']))
+    return store
+
+
+def main(argv=sys.argv[1:]):
+    run_job(argv[0])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Detection of the resources granted to the container, and thread control.
+
+The CPU quota and memory limit are read from the cgroup filesystem (both
+cgroup v2 and v1 are supported), because os.cpu_count() and the total memory
+reported by the kernel are those of the node, whatever the limits of the pod.
+"""
+
+import logging
+import math
+import os
+
+
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Environment variables that control the size of the thread pools of the
+# common BLAS and OpenMP implementations. They are only taken into account if
+# they are set before numpy is imported.
+THREAD_ENVIRONMENT_VARIABLES = [
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'BLIS_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+]
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def cpu_quota(cgroup_root=CGROUP_ROOT):
+    """Return the CPU quota of the container (in CPUs), or None if unlimited.
+
+    The result is a float, e.g. 0.5 for a Kubernetes limit of 500m.
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    line = _read_first_line(os.path.join(cgroup_root, 'cpu.max'))
+    if line is not None:
+        quota, _, period = line.partition(' ')
+        if quota == 'max':
+            return None
+        try:
+            return int(quota) / int(period)
+        except ValueError:
+            return None
+    # cgroup v1
+    for cpu_dir in ('cpu', 'cpu,cpuacct', 'cpuacct,cpu'):
+        quota = _read_first_line(
+            os.path.join(cgroup_root, cpu_dir, 'cpu.cfs_quota_us'))
+        period = _read_first_line(
+            os.path.join(cgroup_root, cpu_dir, 'cpu.cfs_period_us'))
+        if quota is not None and period is not None:
+            try:
+                quota, period = int(quota), int(period)
+            except ValueError:
+                return None
+            if quota <= 0 or period <= 0:
+                return None
+            return quota / period
+    return None
+
+
+def available_cpus(cgroup_root=CGROUP_ROOT):
+    """Return the number of CPUs that this process can use (at least 1).
+
+    This is the CPU quota of the container rounded up, capped by the number
+    of CPUs on which the process is allowed to run.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on all platforms
+        cpus = os.cpu_count() or 1
+    quota = cpu_quota(cgroup_root)
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def memory_limit(cgroup_root=CGROUP_ROOT):
+    """Return the memory limit of the container in bytes, or None."""
+    # cgroup v2
+    line = _read_first_line(os.path.join(cgroup_root, 'memory.max'))
+    if line is None:
+        # cgroup v1
+        line = _read_first_line(
+            os.path.join(cgroup_root, 'memory', 'memory.limit_in_bytes'))
+    if line is None or line == 'max':
+        return None
+    try:
+        limit = int(line)
+    except ValueError:
+        return None
+    # cgroup v1 reports "unlimited" as a huge number (close to 2**63)
+    if limit <= 0 or limit >= 2 ** 60:
+        return None
+    return limit
+
+
+def threads_per_worker(workers=None, cgroup_root=CGROUP_ROOT):
+    """Size the BLAS thread pools so that workers do not oversubscribe CPUs.
+
+    workers defaults to the WEB_CONCURRENCY environment variable (which is
+    also used by Gunicorn as the default number of workers), or 1.
+    """
+    if workers is None:
+        try:
+            workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+        except ValueError:
+            workers = 1
+    return max(1, available_cpus(cgroup_root) // max(1, workers))
+
+
+def limit_blas_threads(num_threads):
+    """Limit the size of the BLAS and OpenMP thread pools of this process.
+
+    threadpoolctl is used if it is installed, because it acts on libraries
+    that are already loaded. Otherwise, the environment variables are set,
+    which only affects libraries loaded afterwards (and child processes).
+    """
+    for variable in THREAD_ENVIRONMENT_VARIABLES:
+        os.environ[variable] = str(num_threads)
+    try:
+        import threadpoolctl
+    except ImportError:
+        logger.warning('threadpoolctl is not installed, the BLAS thread '
+                       'pools may not be limited to %d thread(s)',
+                       num_threads)
+        return
+    threadpoolctl.threadpool_limits(limits=num_threads)
+    logger.debug('BLAS and OpenMP thread pools limited to %d thread(s)',
+                 num_threads)
+
+
+def configure_blas_threads(setting):
+    """Apply the BLAS_THREADS setting (a number of threads, 'auto' or None).
+    """
+    if not setting:
+        return
+    if setting == 'auto':
+        setting = threads_per_worker()
+    limit_blas_threads(setting)
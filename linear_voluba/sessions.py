@@ -0,0 +1,657 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Registration sessions that keep the landmark pairs on the server.
+
+A session stores the landmark pairs of one interactive registration, so that
+clients only send the pairs that changed. The transformation is re-estimated
+from the LandmarkMoments of the active pairs, which are updated in proportion
+to the number of changes. The mismatches are cached, and only those of the
+changed pairs are recomputed as long as the transformation has moved so
+little that the cached mismatches of the other pairs are guaranteed to be
+within the mismatch tolerance of their exact values (see
+:meth:`Session.refresh`). Otherwise, the mismatches of all pairs are
+recomputed. Reading and writing the session file still copies all the pairs
+(which is cheap on a tmpfs), but no computation goes through all the pairs
+unless the transformation has changed noticeably.
+
+Sessions are stored in files in a directory that is shared by the worker
+processes (SESSION_DIRECTORY, preferably on a tmpfs such as /dev/shm), so
+that the requests of a client can be served by any worker, and sessions
+survive the recycling of workers. Each request reads the session, and writes
+it back if it was changed, under an exclusive lock (see
+:meth:`SessionStore.checkout`). Sessions expire after SESSION_TTL seconds of
+inactivity, and the least recently used sessions are evicted when
+SESSION_MAX_COUNT or SESSION_MAX_TOTAL_LANDMARKS are exceeded. A request for
+an unknown session returns 404, and the client is expected to create a new
+session. The directory is not shared between the replicas of a deployment:
+with several replicas, the requests of a session must reach the same one.
+
+The solutions of a session can be pushed to the client as Server-Sent Events
+(see :func:`event_stream`), with the updates that arrive while a solution is
+computed coalesced into one. A stream polls the header of the session file,
+so it sees the updates received by any worker. An idle stream only costs a
+greenlet with the gevent workers of Gunicorn (with synchronous workers, each
+open stream would occupy a whole worker).
+"""
+
+import contextlib
+import io
+import json
+import math
+import os
+import re
+import struct
+import tempfile
+import time
+import uuid
+
+import flask
+import numpy as np
+
+from . import leastsquares
+from . import singleflight
+
+
+# Minimum number of pair removals before the moments are rebuilt from the
+# points, to discard the rounding errors accumulated by the subtractions
+REBUILD_MIN_REMOVALS = 100
+
+_SESSION_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+# Header of the session files: version, number of landmark pairs, and serial
+# number of the event stream that follows the session
+_HEADER = struct.Struct('<qqq')
+
+# Attributes of a Session stored in the session files, as numpy arrays or
+# in the JSON metadata (the files are never unpickled)
+_SESSION_ARRAYS = ('source_points', 'target_points', 'active', 'mismatches',
+                   'touched')
+_OPTIONAL_ARRAYS = ('transformation_matrix', 'inverse_matrix')
+_SESSION_METADATA = ('id', 'transformation_type', 'dim',
+                     'removals_since_rebuild', 'rmse', 'message', 'version',
+                     'solved_version', 'stream_serial', 'radius',
+                     'mismatch_error', 'squared_mismatch_sum')
+_MOMENTS_ARRAYS = ('src_origin', 'dst_origin', 'src_sum', 'dst_sum',
+                   'src_src', 'dst_src')
+
+
+class InvalidUpdate(ValueError):
+    """Exception raised for an update that does not apply to the session."""
+    pass
+
+
+class TooManyLandmarks(InvalidUpdate):
+    """Exception raised when a session would exceed its number of pairs."""
+    pass
+
+
+class Session:
+    """Landmark pairs of a registration session, and the current solution."""
+
+    def __init__(self, session_id, transformation_type, dim=3):
+        self.id = session_id
+        self.transformation_type = transformation_type
+        self.dim = dim
+        self.source_points = np.empty((0, dim))
+        self.target_points = np.empty((0, dim))
+        self.active = np.empty(0, dtype=bool)
+        self.moments = leastsquares.LandmarkMoments(dim)
+        self.removals_since_rebuild = 0
+        self.transformation_matrix = None
+        self.inverse_matrix = None
+        self.mismatches = np.empty(0)
+        self.rmse = None
+        # The cached mismatches of the pairs that were not changed differ
+        # from their exact values by at most mismatch_error. radius is an
+        # upper bound of the norm of the source points, which bounds how much
+        # the mismatches move when the transformation changes.
+        self.mismatch_error = 0.0
+        self.radius = 0.0
+        self.squared_mismatch_sum = 0.0
+        self.message = None
+        # Pairs changed since the last call to refresh
+        self.touched = np.empty(0, dtype=bool)
+        # Incremented by each update, so that refresh can be skipped when
+        # the solution is up to date
+        self.version = 0
+        self.solved_version = 0
+        # Incremented by each new event stream, which ends the previous one
+        self.stream_serial = 0
+
+    @property
+    def landmark_count(self):
+        return len(self.active)
+
+    def update(self, landmark_pairs=(), removed=(), transformation_type=None,
+               mismatch_tolerance=0.0, max_landmarks=None):
+        """Apply changes to the landmark pairs, and re-estimate the solution.
+
+        This calls :meth:`apply` then :meth:`refresh`, and returns the result
+        of the latter.
+        """
+        self.apply(landmark_pairs, removed, transformation_type,
+                   max_landmarks=max_landmarks)
+        return self.refresh(mismatch_tolerance)
+
+    def apply(self, landmark_pairs=(), removed=(), transformation_type=None,
+              max_landmarks=None):
+        """Apply changes to the landmark pairs.
+
+        removed is a list of indices of the pairs to remove, which refer to
+        the pairs before the update. landmark_pairs is a list of dicts with
+        an 'index' key (referring to the pairs after the removals) and
+        optional 'source_point', 'target_point', and 'active' keys. Pairs are
+        appended by using the indices that follow the last pair, in which
+        case both points are required.
+
+        The solution is not re-estimated until :meth:`refresh` is called, so
+        that several updates can be coalesced. InvalidUpdate is raised
+        (before any modification is made) if the update does not apply,
+        TooManyLandmarks if the session would contain more than
+        max_landmarks pairs.
+        """
+        removed = np.unique(np.asarray(removed, dtype=int))
+        if len(removed) and (removed[0] < 0
+                             or removed[-1] >= self.landmark_count):
+            raise InvalidUpdate('cannot remove a landmark pair that does not '
+                                'exist')
+        count = self.landmark_count - len(removed)
+        indices = [pair['index'] for pair in landmark_pairs]
+        new_indices = sorted(set(i for i in indices if i >= count))
+        if new_indices != list(range(count, count + len(new_indices))):
+            raise InvalidUpdate('new landmark pairs must be added at the end '
+                                'of the list (index {0})'.format(count))
+        if (max_landmarks is not None
+                and count + len(new_indices) > max_landmarks):
+            raise TooManyLandmarks('a session cannot contain more than {0} '
+                                   'landmark pairs'.format(max_landmarks))
+        first_occurrence = {}
+        for pair in landmark_pairs:
+            first_occurrence.setdefault(pair['index'], pair)
+        for index in new_indices:
+            pair = first_occurrence[index]
+            if 'source_point' not in pair or 'target_point' not in pair:
+                raise InvalidUpdate('source_point and target_point are '
+                                    'required for a new landmark pair')
+        if transformation_type is not None:
+            self.transformation_type = transformation_type
+
+        if len(removed):
+            self._remove_moments(removed)
+            self.squared_mismatch_sum -= np.nansum(
+                self.mismatches[removed] ** 2)
+            self.removals_since_rebuild += len(removed)
+            self.source_points = np.delete(self.source_points, removed,
+                                           axis=0)
+            self.target_points = np.delete(self.target_points, removed,
+                                           axis=0)
+            self.active = np.delete(self.active, removed)
+            self.mismatches = np.delete(self.mismatches, removed)
+            self.touched = np.delete(self.touched, removed)
+
+        changed_existing = np.array(sorted(set(indices) - set(new_indices)),
+                                    dtype=int)
+        self._remove_moments(changed_existing)
+        self.removals_since_rebuild += len(changed_existing)
+        if new_indices:
+            added = len(new_indices)
+            self.source_points = np.r_[self.source_points,
+                                       np.empty((added, self.dim))]
+            self.target_points = np.r_[self.target_points,
+                                       np.empty((added, self.dim))]
+            self.active = np.r_[self.active, np.ones(added, dtype=bool)]
+            self.mismatches = np.r_[self.mismatches, np.full(added, np.nan)]
+            self.touched = np.r_[self.touched, np.zeros(added, dtype=bool)]
+        for pair in landmark_pairs:
+            index = pair['index']
+            if 'source_point' in pair:
+                self.source_points[index] = pair['source_point']
+            if 'target_point' in pair:
+                self.target_points[index] = pair['target_point']
+            if 'active' in pair:
+                self.active[index] = pair['active']
+        changed = np.array(sorted(set(indices)), dtype=int)
+        self._add_moments(changed)
+        self.touched[changed] = True
+        if len(changed):
+            self.radius = max(self.radius, float(np.max(np.linalg.norm(
+                self.source_points[changed], axis=1))))
+
+        if self.removals_since_rebuild > max(REBUILD_MIN_REMOVALS,
+                                             self.landmark_count):
+            self.rebuild_moments()
+        self.version += 1
+
+    def refresh(self, mismatch_tolerance=0.0):
+        """Re-estimate the solution after one or more calls to apply.
+
+        Return the sorted array of indices of the pairs whose mismatch has
+        changed by more than mismatch_tolerance, or which were changed since
+        the previous refresh.
+
+        The mismatch of a pair moves by at most |dA| radius + |dt| when the
+        linear part of the transformation moves by dA and its translation by
+        dt. These bounds are accumulated in mismatch_error: while it stays
+        within mismatch_tolerance, only the mismatches of the changed pairs
+        are recomputed, and the RMSE is updated from their difference.
+        """
+        previous_matrix = self.transformation_matrix
+        touched = np.flatnonzero(self.touched)
+        self.touched = np.zeros(self.landmark_count, dtype=bool)
+        self.solved_version = self.version
+        if not self.solve():
+            return np.empty(0, dtype=int)
+        if previous_matrix is not None:
+            error = self.mismatch_error + self._mismatch_bound(
+                self.transformation_matrix - previous_matrix)
+            if error <= mismatch_tolerance:
+                self.mismatch_error = error
+                self._update_mismatches(touched)
+                return touched
+        old_mismatches = self.mismatches
+        self._update_mismatches()
+        differs = ~(np.abs(self.mismatches - old_mismatches)
+                    <= mismatch_tolerance)
+        differs[touched] = True
+        return np.flatnonzero(differs)
+
+    def _mismatch_bound(self, difference):
+        dim = self.dim
+        return (np.linalg.norm(difference[:dim, :dim], 2) * self.radius
+                + np.linalg.norm(difference[:dim, dim]))
+
+    def _update_mismatches(self, indices=None):
+        """Recompute the mismatches of some pairs (all if indices is None)."""
+        if indices is None:
+            self.mismatches = leastsquares.per_landmark_mismatch(
+                self.source_points, self.target_points,
+                self.transformation_matrix)
+            self.squared_mismatch_sum = float(np.sum(self.mismatches ** 2))
+            self.mismatch_error = 0.0
+            self.radius = (float(np.max(np.linalg.norm(self.source_points,
+                                                       axis=1)))
+                           if self.landmark_count else 0.0)
+        else:
+            mismatches = leastsquares.per_landmark_mismatch(
+                self.source_points[indices], self.target_points[indices],
+                self.transformation_matrix)
+            # The mismatches of the new pairs were unknown (NaN)
+            self.squared_mismatch_sum += float(
+                np.sum(mismatches ** 2)
+                - np.nansum(self.mismatches[indices] ** 2))
+            self.mismatches[indices] = mismatches
+        self.rmse = (math.sqrt(max(self.squared_mismatch_sum, 0.0)
+                               / self.landmark_count)
+                     if self.landmark_count else 0.0)
+
+    def _add_moments(self, indices, sign=1):
+        indices = indices[self.active[indices]]
+        self.moments.add(self.source_points[indices],
+                         self.target_points[indices], sign=sign)
+
+    def _remove_moments(self, indices):
+        self._add_moments(indices, sign=-1)
+
+    def rebuild_moments(self):
+        self.moments = leastsquares.LandmarkMoments.from_points(
+            self.source_points[self.active], self.target_points[self.active])
+        self.removals_since_rebuild = 0
+
+    def solve(self):
+        """Estimate the transformation, return False if it is undetermined.
+
+        The mismatches are not recomputed (see :meth:`refresh`), unless the
+        problem is underdetermined, in which case they are all NaN.
+        """
+        try:
+            mat = leastsquares.estimate_from_moments(
+                self.transformation_type, self.moments)
+        except leastsquares.UnderdeterminedProblem as exc:
+            self.transformation_matrix = self.inverse_matrix = None
+            self.mismatches = np.full(self.landmark_count, np.nan)
+            self.squared_mismatch_sum = 0.0
+            self.rmse = None
+            self.message = str(exc)
+            return False
+        self.transformation_matrix = mat
+        self.inverse_matrix = np.linalg.inv(mat)
+        self.message = None
+        return True
+
+    def dumps(self):
+        """Serialize the session into bytes, see :meth:`loads`."""
+        arrays = {name: getattr(self, name) for name in _SESSION_ARRAYS}
+        for name in _OPTIONAL_ARRAYS:
+            if getattr(self, name) is not None:
+                arrays[name] = getattr(self, name)
+        for name in _MOMENTS_ARRAYS:
+            if getattr(self.moments, name) is not None:
+                arrays['moments_' + name] = getattr(self.moments, name)
+        metadata = {name: getattr(self, name) for name in _SESSION_METADATA}
+        metadata['moments_count'] = self.moments.count
+        arrays['metadata'] = np.array(json.dumps(metadata))
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def loads(cls, data):
+        """Return the session serialized by :meth:`dumps`.
+
+        The data is a plain npz archive, which is loaded without unpickling
+        anything.
+        """
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            metadata = json.loads(str(arrays['metadata']))
+            session = cls(metadata['id'], metadata['transformation_type'],
+                          metadata['dim'])
+            for name in _SESSION_METADATA:
+                setattr(session, name, metadata[name])
+            session.moments.count = metadata['moments_count']
+            for name in _SESSION_ARRAYS + _OPTIONAL_ARRAYS:
+                if name in arrays:
+                    setattr(session, name, arrays[name])
+            for name in _MOMENTS_ARRAYS:
+                if 'moments_' + name in arrays:
+                    setattr(session.moments, name, arrays['moments_' + name])
+        return session
+
+
+class SessionStore:
+    """Store of the sessions, shared by the processes using the same directory.
+
+    Each session is stored in a file (a header followed by the npz archive
+    of :meth:`Session.dumps`), whose modification time is the time of its
+    last use. ttl is the duration (in seconds) after which an unused
+    session expires, max_count and max_total_landmarks bound the number of
+    sessions and the total number of landmark pairs that they contain, by
+    evicting the least recently used sessions (see :meth:`enforce_limits`).
+    """
+
+    def __init__(self, directory, ttl, max_count, max_total_landmarks,
+                 clock=time.time, poll_interval=0.005, cleanup_interval=1.0):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_count = max_count
+        self.max_total_landmarks = max_total_landmarks
+        self.clock = clock
+        self.poll_interval = poll_interval
+        self.cleanup_interval = cleanup_interval
+        self._last_cleanup = -math.inf
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, session_id, suffix='.session'):
+        # The identifiers come from the URL: reject anything but our own
+        if not _SESSION_ID_RE.match(session_id):
+            return None
+        return os.path.join(self.directory, session_id + suffix)
+
+    def _session_ids(self):
+        return [filename[:-len('.session')]
+                for filename in os.listdir(self.directory)
+                if filename.endswith('.session')]
+
+    def __len__(self):
+        return len(self._session_ids())
+
+    def create(self, transformation_type):
+        """Return a new session, which is stored by :meth:`save`."""
+        return Session(uuid.uuid4().hex, transformation_type)
+
+    def save(self, session):
+        data = _HEADER.pack(session.version, session.landmark_count,
+                            session.stream_serial) + session.dumps()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            now = self.clock()
+            os.utime(tmp_path, (now, now))
+            os.replace(tmp_path, self._path(session.id))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _read(self, session_id, header_only=False):
+        path = self._path(session_id)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                data = f.read(_HEADER.size if header_only else -1)
+        except OSError:
+            return None
+        if len(data) < _HEADER.size:
+            return None
+        if self.clock() - mtime > self.ttl:
+            self._discard(session_id)
+            return None
+        return data
+
+    def read_header(self, session_id):
+        """Return the (version, landmark_count, stream_serial) of a session.
+
+        None is returned if the session does not exist or has expired.
+        """
+        data = self._read(session_id, header_only=True)
+        return None if data is None else _HEADER.unpack(data)
+
+    def get(self, session_id):
+        """Return a copy of the session, or None if it does not exist or has
+        expired.
+
+        The changes made to the copy are not stored, use :meth:`checkout`
+        to update a session.
+        """
+        data = self._read(session_id)
+        if data is None:
+            return None
+        self.touch(session_id)
+        return Session.loads(data[_HEADER.size:])
+
+    def touch(self, session_id):
+        """Mark a session as used (which postpones its expiry)."""
+        now = self.clock()
+        try:
+            os.utime(self._path(session_id), (now, now))
+        except (OSError, TypeError):
+            pass
+
+    @contextlib.contextmanager
+    def _locked(self, session_id):
+        with open(self._path(session_id, '.lock'), 'a') as lock_file:
+            while not singleflight.try_lock(lock_file):
+                time.sleep(self.poll_interval)
+            yield
+
+    @contextlib.contextmanager
+    def checkout(self, session_id):
+        """Lock a session for reading and updating it.
+
+        Yield the session, or None if it does not exist or has expired. The
+        session is written back when the block exits, if it was changed and
+        no exception was raised. The other requests for the same session, in
+        any process, wait for the lock.
+        """
+        path = self._path(session_id)
+        if path is None or not os.path.exists(path):
+            yield None
+            return
+        with self._locked(session_id):
+            session = self.get(session_id)
+            if session is None:
+                yield None
+                return
+            state = (session.version, session.solved_version,
+                     session.stream_serial)
+            yield session
+            if state != (session.version, session.solved_version,
+                         session.stream_serial):
+                self.save(session)
+
+    def _discard(self, session_id):
+        """Remove a session unless it is in use, return True if removed."""
+        with open(self._path(session_id, '.lock'), 'a') as lock_file:
+            if not singleflight.try_lock(lock_file):
+                return False
+            return self._unlink(session_id)
+
+    def _unlink(self, session_id):
+        # Called with the lock held: the processes that wait for the lock
+        # will find that the session no longer exists
+        try:
+            os.unlink(self._path(session_id))
+        except OSError:
+            return False
+        finally:
+            try:
+                os.unlink(self._path(session_id, '.lock'))
+            except OSError:
+                pass
+        return True
+
+    def delete(self, session_id):
+        path = self._path(session_id)
+        if path is None or not os.path.exists(path):
+            return False
+        with self._locked(session_id):
+            return self._unlink(session_id)
+
+    def enforce_limits(self):
+        """Remove the expired sessions, and evict the least recently used
+        sessions beyond the limits.
+
+        The directory is scanned at most every cleanup_interval seconds by
+        each process. The most recently used session is never evicted, nor
+        are the sessions that are in use.
+        """
+        now = self.clock()
+        if now - self._last_cleanup < self.cleanup_interval:
+            return
+        self._last_cleanup = now
+        entries = []
+        for session_id in self._session_ids():
+            try:
+                with open(self._path(session_id), 'rb') as f:
+                    mtime = os.fstat(f.fileno()).st_mtime
+                    header = f.read(_HEADER.size)
+            except OSError:
+                continue
+            if len(header) < _HEADER.size or now - mtime > self.ttl:
+                self._discard(session_id)
+                continue
+            entries.append((mtime, session_id, _HEADER.unpack(header)[1]))
+        entries.sort()
+        count = len(entries)
+        total = sum(landmark_count for _, _, landmark_count in entries)
+        for _, session_id, landmark_count in entries[:-1]:
+            if (count <= max(1, self.max_count)
+                    and total <= self.max_total_landmarks):
+                break
+            if self._discard(session_id):
+                count -= 1
+                total -= landmark_count
+
+
+def format_event(event, data, event_id=None):
+    """Format a Server-Sent Event (data must not contain line breaks)."""
+    lines = []
+    if event_id is not None:
+        lines.append('id: {0}'.format(event_id))
+    lines.append('event: {0}'.format(event))
+    lines.append('data: {0}'.format(data))
+    return '\n'.join(lines) + '\n\n'
+
+
+def event_stream(store, session_id, serialize, mismatch_tolerance=0.0,
+                 keepalive=15, max_duration=600, poll_interval=0.05,
+                 clock=time.monotonic):
+    """Generate the Server-Sent Events that push the solutions of a session.
+
+    The header of the session file is polled every poll_interval seconds,
+    so the updates received by any process are seen. The solution is
+    re-estimated only when the stream is ready to send it, so the updates
+    that arrive in the meantime are coalesced: the result of the latest
+    update is pushed, and the intermediate solutions are never computed.
+    serialize(session, indices) must return the data of an event, as a
+    string without line breaks.
+
+    Only one stream can follow a session: opening a new stream ends the
+    previous one. The stream also ends when the session is deleted or
+    expires, and after max_duration seconds (EventSource clients reconnect
+    automatically). A comment is sent after keepalive seconds without
+    updates, so that idle connections are not closed by proxies.
+    """
+    with store.checkout(session_id) as session:
+        if session is None:
+            return
+        session.stream_serial += 1
+        serial = session.stream_serial
+        if session.solved_version != session.version:
+            session.refresh(mismatch_tolerance)
+        version = session.version
+        data = serialize(session, np.arange(session.landmark_count))
+    yield format_event('result', data, version)
+
+    start = last_sent = clock()
+    while clock() - start < max_duration:
+        time.sleep(poll_interval)
+        header = store.read_header(session_id)
+        if header is None or header[2] != serial:
+            return
+        if header[0] == version:
+            if clock() - last_sent >= keepalive:
+                # Also keeps the session alive while the stream is open
+                store.touch(session_id)
+                last_sent = clock()
+                yield ': keep-alive\n\n'
+            continue
+        with store.checkout(session_id) as session:
+            if session is None or session.stream_serial != serial:
+                return
+            if session.solved_version != session.version:
+                indices = session.refresh(mismatch_tolerance)
+                data = serialize(session, indices)
+            else:
+                # Already refreshed by a synchronous update, whose changes
+                # are unknown here
+                data = serialize(session, np.arange(session.landmark_count))
+            version = session.version
+        last_sent = clock()
+        yield format_event('result', data, version)
+
+
+def get_store(app=None):
+    """Return the SessionStore of the application (created on first use)."""
+    if app is None:
+        app = flask.current_app
+    store = app.extensions.get('voluba_sessions')
+    if store is None:
+        directory = app.config.get('SESSION_DIRECTORY')
+        if directory is None:
+            directory = os.path.join(app.instance_path, 'sessions')
+        store = app.extensions.setdefault('voluba_sessions', SessionStore(
+            directory,
+            ttl=app.config['SESSION_TTL'],
+            max_count=app.config['SESSION_MAX_COUNT'],
+            max_total_landmarks=app.config['SESSION_MAX_TOTAL_LANDMARKS'],
+        ))
+    return store
@@ -0,0 +1,307 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Single-flight deduplication of identical concurrent computations.
+
+When several identical computations are requested at the same time, only
+the first one (the leader) is run, and the others wait for its result. This
+works between the threads (or greenlets) of a process, and optionally
+between processes, through lock and result files in a shared directory
+(preferably on a tmpfs such as /dev/shm).
+
+Results are not cached: a computation that starts after the previous
+identical one has finished is run again. Between processes, the result is
+passed through a file, which is only read by the calls that waited for that
+computation, and removed after RESULT_LIFETIME seconds. These files are npz
+archives, which are loaded without unpickling anything: only results made
+of numeric arrays (or tuples of arrays), and the exceptions listed in
+shared_exceptions, are passed between processes. The waiting processes run
+the computation themselves for other results.
+
+The leader holds an flock on the lock file of the key, and removes that
+file when it has finished. A process only computes as the leader while the
+file that it has locked is still the one at the path of the lock file, so
+two processes never lead the same computation, and a process never removes
+a lock file that it has not locked.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+from . import leastsquares
+
+
+logger = logging.getLogger(__name__)
+
+# Result files (and lock files left by killed processes) older than this (in
+# seconds) are removed by the periodic clean-up of the shared directory
+RESULT_LIFETIME = 60
+
+
+def try_lock(lock_file):
+    """Take an exclusive flock on an open file without blocking.
+
+    Return False if the lock is held through another open file (possibly by
+    the same process). The callers poll rather than block, so that the other
+    greenlets of the process can run.
+    """
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as exc:
+        if exc.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+    return True
+
+
+def _is_current(lock_file, lock_path):
+    """Whether lock_path still refers to the open lock_file."""
+    try:
+        stat = os.stat(lock_path)
+    except FileNotFoundError:
+        return False
+    own_stat = os.fstat(lock_file.fileno())
+    return (stat.st_dev, stat.st_ino) == (own_stat.st_dev, own_stat.st_ino)
+
+
+def _encode_result(result):
+    """Return the arrays that store result in a result file, or None."""
+    values = result if isinstance(result, tuple) else (result,)
+    arrays = {'status': np.array('tuple' if isinstance(result, tuple)
+                                 else 'ok')}
+    for i, value in enumerate(values):
+        array = np.asarray(value)
+        if array.dtype.hasobject:
+            return None
+        arrays['value_{0}'.format(i)] = array
+    return arrays
+
+
+def _decode_result(arrays):
+    values = []
+    while 'value_{0}'.format(len(values)) in arrays:
+        array = arrays['value_{0}'.format(len(values))]
+        values.append(array[()] if array.ndim == 0 else array)
+    if str(arrays['status']) == 'tuple':
+        return tuple(values)
+    return values[0]
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'exception')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    """Deduplicate the concurrent calls that have the same key.
+
+    If directory is given, the calls are also deduplicated with the other
+    processes that use the same directory. A process waits at most timeout
+    seconds for another process, before running the computation itself.
+    shared_exceptions is the tuple of the exception classes that are raised
+    in the waiting processes, re-created from their message.
+    """
+
+    def __init__(self, directory=None, timeout=30, poll_interval=0.005,
+                 shared_exceptions=()):
+        self.directory = directory
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.shared_exceptions = tuple(shared_exceptions)
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._last_cleanup = 0
+        if directory is not None:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def do(self, key, func):
+        """Return (func(), shared), running func only once per key at a time.
+
+        shared is True if the result was computed by another call. An
+        exception raised by func is raised in all the waiting calls.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result, True
+        try:
+            if self.directory is None:
+                call.result, shared = func(), False
+            else:
+                call.result, shared = self._do_across_processes(key, func)
+        except BaseException as exc:
+            call.exception = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, shared
+
+    def _do_across_processes(self, key, func):
+        lock_path = os.path.join(self.directory, key + '.lock')
+        result_path = os.path.join(self.directory, key + '.result')
+        deadline = time.time() + self.timeout
+        while True:
+            with open(lock_path, 'a') as lock_file:
+                locked = try_lock(lock_file)
+                if not locked:
+                    # Another process is computing the same result: wait
+                    # until it releases the lock (polling, so that greenlets
+                    # can run)
+                    while not locked and time.time() < deadline:
+                        time.sleep(self.poll_interval)
+                        locked = try_lock(lock_file)
+                    if not locked:
+                        logger.warning('timeout while waiting for another '
+                                       'process to compute %s', key)
+                        # The lock file is left to the other process
+                        return func(), False
+                    outcome = self._read_result(result_path)
+                    if outcome is not None:
+                        status, value = outcome
+                        if status == 'error':
+                            raise value
+                        return value, True
+                if _is_current(lock_file, lock_path):
+                    return self._lead(lock_file, lock_path, result_path,
+                                      func)
+            # The lock file was removed by a leader that has just finished
+            # (without a result for us): start a new computation
+
+    def _lead(self, lock_file, lock_path, result_path, func):
+        try:
+            try:
+                result = func()
+            except Exception as exc:
+                if isinstance(exc, self.shared_exceptions):
+                    self._write_result(result_path, {
+                        'status': np.array('error'),
+                        'exception': np.array(type(exc).__name__),
+                        'message': np.array(str(exc)),
+                    })
+                raise
+            arrays = _encode_result(result)
+            if arrays is None:
+                logger.debug('cannot share the result of %s', result_path)
+            else:
+                self._write_result(result_path, arrays)
+            return result, False
+        finally:
+            # Unlink the lock file while holding the lock, so that the
+            # waiting processes (which hold the old file open) get the
+            # result, and new calls start a new computation.
+            if _is_current(lock_file, lock_path):
+                try:
+                    os.unlink(lock_path)
+                except OSError:
+                    pass
+            self._cleanup()
+
+    def _write_result(self, result_path, arrays):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, result_path)
+        except OSError:
+            logger.warning('cannot write %s', result_path, exc_info=True)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def _read_result(self, result_path):
+        """Read the outcome written by another process, or return None.
+
+        The outcome is ('ok', result) or ('error', exception). A result file
+        may be older than the computation that was waited for (if that
+        computation failed to write its result), but the key identifies the
+        inputs, so its contents are the same.
+        """
+        try:
+            with np.load(result_path, allow_pickle=False) as arrays:
+                status = str(arrays['status'])
+                if status != 'error':
+                    return 'ok', _decode_result(arrays)
+                name = str(arrays['exception'])
+                message = str(arrays['message'])
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        for exception_class in self.shared_exceptions:
+            if exception_class.__name__ == name:
+                return 'error', exception_class(message)
+        return None
+
+    def _cleanup(self):
+        """Remove the old result files (at most once per RESULT_LIFETIME)."""
+        now = time.time()
+        if now - self._last_cleanup < RESULT_LIFETIME:
+            return
+        self._last_cleanup = now
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            if not entry.name.endswith(('.result', '.tmp', '.lock')):
+                continue
+            try:
+                if now - entry.stat().st_mtime <= RESULT_LIFETIME:
+                    continue
+                if not entry.name.endswith('.lock'):
+                    os.unlink(entry.path)
+                    continue
+                # Left by a killed process: only removed if nobody uses it
+                with open(entry.path, 'a') as lock_file:
+                    if (try_lock(lock_file)
+                            and _is_current(lock_file, entry.path)):
+                        os.unlink(entry.path)
+            except OSError:
+                pass
+
+
+def get_single_flight(app):
+    """Return the SingleFlight of the application, or None if disabled."""
+    if not app.config.get('SINGLE_FLIGHT'):
+        return None
+    flight = app.extensions.get('voluba_single_flight')
+    if flight is None:
+        flight = app.extensions.setdefault(
+            'voluba_single_flight',
+            SingleFlight(directory=app.config.get('SINGLE_FLIGHT_DIRECTORY'),
+                         timeout=app.config.get('SINGLE_FLIGHT_TIMEOUT', 30),
+                         shared_exceptions=(
+                             leastsquares.UnderdeterminedProblem,)))
+    return flight
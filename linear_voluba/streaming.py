@@ -0,0 +1,255 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Out-of-core estimation from millions of point correspondences.
+
+The correspondences are read by chunks (e.g. from memory-mapped .npy
+files, or from a generator function that reads them from another source), so
+the memory used does not depend on their number. A first pass
+accumulates the LandmarkMoments of the points, from which any of the
+transformation types is estimated (see
+:func:`linear_voluba.leastsquares.estimate_from_moments`). A second pass
+computes the RMSE and a histogram of the mismatches.
+
+The sums over the chunks are accumulated with Neumaier's compensated
+summation, and the sums within a chunk use numpy's pairwise summation, so
+the rounding errors do not grow with the number of points.
+
+Command-line usage::
+
+    python3 -m linear_voluba.streaming source.npy target.npy affine
+"""
+
+import argparse
+import collections
+import json
+import sys
+
+import numpy as np
+
+from . import leastsquares
+
+
+DEFAULT_CHUNK_SIZE = 2 ** 16
+
+# Edges of the default mismatch histogram: logarithmic bins from 0.001 to
+# 1000 (in the units of the target space) with 10 bins per decade, plus a
+# first bin for [0, 0.001) and a last bin for [1000, inf)
+DEFAULT_HISTOGRAM_EDGES = np.r_[0, np.logspace(-3, 3, 61), np.inf]
+
+
+StreamingResult = collections.namedtuple('StreamingResult', [
+    'transformation_matrix',
+    'inverse_matrix',
+    'count',
+    'rmse',
+    'max_mismatch',
+    'histogram',
+    'histogram_edges',
+])
+
+
+class CompensatedSum:
+    """Neumaier's compensated summation of arrays (element-wise)."""
+
+    def __init__(self, shape=()):
+        self.sum = np.zeros(shape)
+        self.compensation = np.zeros(shape)
+
+    def add(self, value):
+        total = self.sum + value
+        large = np.abs(self.sum) >= np.abs(value)
+        self.compensation += np.where(large, (self.sum - total) + value,
+                                      (value - total) + self.sum)
+        self.sum = total
+
+    @property
+    def value(self):
+        return self.sum + self.compensation
+
+
+class ChunkedCorrespondences:
+    """Re-iterable sequence of (source, target) chunks of two point arrays.
+
+    The arrays can be memory-mapped: only one chunk at a time is read in
+    memory.
+    """
+
+    def __init__(self, source_points, target_points,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        if (source_points.ndim != 2
+                or source_points.shape != target_points.shape):
+            raise ValueError('source and target points must be arrays of '
+                             'the same (N, dim) shape')
+        self.source_points = source_points
+        self.target_points = target_points
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_npy(cls, source_path, target_path,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        return cls(np.load(source_path, mmap_mode='r'),
+                   np.load(target_path, mmap_mode='r'),
+                   chunk_size=chunk_size)
+
+    def __len__(self):
+        return len(self.source_points)
+
+    def __iter__(self):
+        for start in range(0, len(self.source_points), self.chunk_size):
+            stop = start + self.chunk_size
+            yield (np.asarray(self.source_points[start:stop], dtype=float),
+                   np.asarray(self.target_points[start:stop], dtype=float))
+
+
+def accumulate_moments(chunks, dim=3):
+    """Compute the LandmarkMoments of an iterable of (src, dst) chunks."""
+    moments = leastsquares.LandmarkMoments(dim)
+    count = 0
+    sums = {name: CompensatedSum(getattr(moments, name).shape)
+            for name in ('src_sum', 'dst_sum', 'src_src', 'dst_src')}
+    for src, dst in chunks:
+        src = np.asarray(src, dtype=float).reshape(-1, dim)
+        dst = np.asarray(dst, dtype=float).reshape(-1, dim)
+        if len(src) == 0:
+            continue
+        if moments.src_origin is None:
+            # Accumulate relative to the mean of the first chunk, which
+            # avoids the cancellation errors of far-off coordinates
+            moments.src_origin = src.mean(axis=0)
+            moments.dst_origin = dst.mean(axis=0)
+        src = src - moments.src_origin
+        dst = dst - moments.dst_origin
+        count += len(src)
+        sums['src_sum'].add(src.sum(axis=0))
+        sums['dst_sum'].add(dst.sum(axis=0))
+        sums['src_src'].add(src.T @ src)
+        sums['dst_src'].add(dst.T @ src)
+    moments.count = count
+    for name, compensated_sum in sums.items():
+        setattr(moments, name, compensated_sum.value)
+    return moments
+
+
+def mismatch_statistics(chunks, matrix,
+                        histogram_edges=DEFAULT_HISTOGRAM_EDGES):
+    """Compute the mismatches of all correspondences in a streaming pass.
+
+    Return (count, rmse, max_mismatch, histogram).
+    """
+    linear = matrix[:-1, :-1]
+    translation = matrix[:-1, -1]
+    count = 0
+    sum_of_squares = CompensatedSum()
+    max_mismatch = 0.0
+    histogram = np.zeros(len(histogram_edges) - 1, dtype=np.int64)
+    for src, dst in chunks:
+        src = np.asarray(src, dtype=float)
+        if len(src) == 0:
+            continue
+        squared = np.sum((dst - (src @ linear.T + translation)) ** 2, axis=1)
+        mismatches = np.sqrt(squared)
+        count += len(src)
+        sum_of_squares.add(squared.sum())
+        max_mismatch = max(max_mismatch, float(mismatches.max()))
+        histogram += np.histogram(mismatches, bins=histogram_edges)[0]
+    rmse = float(np.sqrt(sum_of_squares.value / count)) if count else 0.0
+    return count, rmse, max_mismatch, histogram
+
+
+def _chunk_reader(chunks):
+    """Return a function that returns a new iterator over chunks."""
+    if callable(chunks):
+        return chunks
+    if iter(chunks) is chunks:
+        raise TypeError('chunks must be re-iterable or a function that '
+                        'returns a new iterator, because it is read twice')
+    return lambda: iter(chunks)
+
+
+def estimate(transformation_type, chunks, dim=3,
+             histogram_edges=DEFAULT_HISTOGRAM_EDGES):
+    """Estimate a transformation from chunks of correspondences.
+
+    chunks is read twice: once for the estimation, once for the mismatches.
+    It must be re-iterable (e.g. ChunkedCorrespondences, or a list), or a
+    function without arguments that returns a new iterator over the chunks
+    (e.g. a generator function), which is called once for each pass. Return
+    a StreamingResult. UnderdeterminedProblem is raised if there are not
+    enough linearly independent points.
+    """
+    read_chunks = _chunk_reader(chunks)
+    moments = accumulate_moments(read_chunks(), dim=dim)
+    matrix = leastsquares.estimate_from_moments(transformation_type, moments)
+    count, rmse, max_mismatch, histogram = mismatch_statistics(
+        read_chunks(), matrix, histogram_edges)
+    return StreamingResult(
+        transformation_matrix=matrix,
+        inverse_matrix=np.linalg.inv(matrix),
+        count=count,
+        rmse=rmse,
+        max_mismatch=max_mismatch,
+        histogram=histogram,
+        histogram_edges=np.asarray(histogram_edges),
+    )
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description='Estimate a transformation from point correspondences '
+                    'stored in two .npy files of shape (N, 3), with constant '
+                    'memory.')
+    parser.add_argument('source', help='.npy file of the source points')
+    parser.add_argument('target', help='.npy file of the target points')
+    parser.add_argument('transformation_type',
+                        choices=leastsquares.TRANSFORMATION_TYPES)
+    parser.add_argument('--chunk-size', type=int,
+                        default=DEFAULT_CHUNK_SIZE,
+                        help='number of correspondences read at once '
+                        '(default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_command_line(argv)
+    chunks = ChunkedCorrespondences.from_npy(args.source, args.target,
+                                             chunk_size=args.chunk_size)
+    try:
+        result = estimate(args.transformation_type, chunks)
+    except leastsquares.UnderdeterminedProblem as exc:
+        print(str(exc), file=sys.stderr)
+        return 1
+    json.dump({
+        'transformation_matrix': leastsquares.np_matrix_to_json(
+            result.transformation_matrix.tolist()),
+        'inverse_matrix': leastsquares.np_matrix_to_json(
+            result.inverse_matrix.tolist()),
+        'count': result.count,
+        'RMSE': result.rmse,
+        'max_mismatch': result.max_mismatch,
+        'histogram': {
+            'counts': result.histogram.tolist(),
+            # JSON has no infinity
+            'edges': [edge if np.isfinite(edge) else None
+                      for edge in result.histogram_edges.tolist()],
+        },
+    }, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
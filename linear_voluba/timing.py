@@ -0,0 +1,143 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Per-request timing of the processing stages.
+
+A request is split into consecutive stages by calling :func:`lap` at the end
+of each stage: the duration of a stage is the time elapsed since the previous
+lap (or since the start of the request for the first stage). The last stage,
+``serialize``, is closed automatically when the response has been built.
+
+The timings are only collected if at least one consumer (e.g. the Prometheus
+metrics, or the Server-Timing header) has registered a listener with
+:func:`add_listener`, so that the instrumentation costs nothing when it is not
+used.
+"""
+
+import time
+
+import flask
+
+
+_EXTENSION_KEY = 'voluba_timing_listeners'
+
+try:
+    perf_counter_ns = time.perf_counter_ns
+except AttributeError:  # Python < 3.7
+    def perf_counter_ns():
+        return int(time.perf_counter() * 1e9)
+
+
+class RequestTimings:
+    """Stage durations (in nanoseconds) and labels of a single request."""
+
+    __slots__ = ('start_ns', 'last_ns', 'stages', 'labels')
+
+    def __init__(self):
+        self.start_ns = self.last_ns = perf_counter_ns()
+        self.stages = []
+        self.labels = {}
+
+    def lap(self, stage_name):
+        now = perf_counter_ns()
+        self.stages.append((stage_name, now - self.last_ns))
+        self.last_ns = now
+
+    @property
+    def total_ns(self):
+        return self.last_ns - self.start_ns
+
+
+def current():
+    """Return the timings of the current request, or None if disabled."""
+    return flask.g.get('timings')
+
+
+def lap(stage_name):
+    """Close the current stage of the request under the given name."""
+    timings = flask.g.get('timings')
+    if timings is not None:
+        timings.lap(stage_name)
+
+
+def annotate(**labels):
+    """Attach labels (e.g. the transformation type) to the current request."""
+    timings = flask.g.get('timings')
+    if timings is not None:
+        timings.labels.update(labels)
+
+
+def add_listener(app, listener):
+    """Call listener(response, timings) at the end of every request.
+
+    The listener is called after the ``serialize`` stage has been closed, and
+    may modify the response (e.g. to add headers).
+    """
+    listeners = app.extensions.get(_EXTENSION_KEY)
+    if listeners is None:
+        listeners = app.extensions[_EXTENSION_KEY] = []
+        app.before_request(_start_request)
+        app.after_request(_finish_request)
+    listeners.append(listener)
+
+
+def _start_request():
+    flask.g.timings = RequestTimings()
+
+
+def _finish_request(response):
+    timings = flask.g.get('timings')
+    if timings is None:
+        return response
+    # Only the views that are instrumented with lap() get a serialize stage,
+    # and only if they ran to completion.
+    if timings.stages and response.status_code < 400:
+        timings.lap('serialize')
+    else:
+        timings.last_ns = perf_counter_ns()
+    for listener in flask.current_app.extensions[_EXTENSION_KEY]:
+        listener(response, timings)
+    return response
+
+
+def server_timing_header(timings):
+    """Format the timings as the value of a Server-Timing header."""
+    entries = ['{0};dur={1:.3f}'.format(stage_name, duration_ns * 1e-6)
+               for stage_name, duration_ns in timings.stages]
+    entries.append('total;dur={0:.3f}'.format(timings.total_ns * 1e-6))
+    return ', '.join(entries)
+
+
+def init_server_timing(app):
+    """Emit a Server-Timing header with the stage durations on all responses.
+
+    The header is displayed by the network panel of the browser developer
+    tools. For cross-origin requests, browsers only expose it if the response
+    also carries a Timing-Allow-Origin header, which is derived from the
+    CORS_ORIGINS setting.
+    """
+    allow_origin = app.config.get('CORS_ORIGINS')
+    if isinstance(allow_origin, (list, tuple)):
+        allow_origin = ', '.join(allow_origin)
+    elif not isinstance(allow_origin, str):
+        allow_origin = None
+
+    def add_server_timing(response, timings):
+        response.headers['Server-Timing'] = server_timing_header(timings)
+        if allow_origin:
+            response.headers['Timing-Allow-Origin'] = allow_origin
+
+    add_listener(app, add_server_timing)
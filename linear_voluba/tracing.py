@@ -0,0 +1,313 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Distributed tracing of the API requests.
+
+Each traced request gives a trace made of a server span, covering the whole
+request, and of one child span per processing stage of :mod:`timing`
+(``receive`` for reading the body, then e.g. ``validate``, ``solve``,
+``invert``, ``mismatch`` and ``serialize`` for /api/least-squares). The
+spans are dictionaries that follow the JSON encoding of OpenTelemetry
+(OTLP), so that they can be imported into the usual tracing tools.
+
+The W3C Trace Context is propagated: if the request carries a
+``traceparent`` header (e.g. sent by the Voluba frontend), the server span
+is a child of the caller's span, in the same trace, and the caller's sampling
+decision is followed. The ``traceresponse`` header of the response gives the
+trace and span of the request to the caller.
+
+The spans are sent to an exporter: :class:`FileExporter` (JSON lines, for
+offline analysis), :class:`InMemoryExporter` (for tests and debugging), or
+any object with an ``export(spans)`` method. Sampling is decided by a
+:class:`Sampler`, which also bounds the number of traces recorded per
+second. The request hooks are not installed at all if tracing is disabled.
+"""
+
+import collections
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import flask
+
+from . import timing
+
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_HEADER = 'traceparent'
+TRACERESPONSE_HEADER = 'traceresponse'
+
+_TRACEPARENT_RE = re.compile(
+    r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$')
+
+try:
+    time_ns = time.time_ns
+except AttributeError:  # Python < 3.7
+    def time_ns():
+        return int(time.time() * 1e9)
+
+
+TraceParent = collections.namedtuple('TraceParent',
+                                     ['trace_id', 'span_id', 'sampled'])
+"""Trace context received from the caller (hexadecimal identifiers)."""
+
+
+def parse_traceparent(value):
+    """Parse a W3C traceparent header, return a TraceParent or None.
+
+    None is returned for a missing or invalid header, in which case a new
+    trace is started.
+    """
+    if not value:
+        return None
+    match = _TRACEPARENT_RE.match(value.strip())
+    if not match:
+        return None
+    version, trace_id, span_id, flags, rest = match.groups()
+    # Version ff is forbidden, and version 00 has no other fields
+    if version == 'ff' or (version == '00' and rest):
+        return None
+    if trace_id == '0' * 32 or span_id == '0' * 16:
+        return None
+    return TraceParent(trace_id, span_id, bool(int(flags, 16) & 1))
+
+
+def format_traceparent(trace_id, span_id, sampled=True):
+    """Format a W3C traceparent (or traceresponse) header."""
+    return '00-{0}-{1}-{2}'.format(trace_id, span_id,
+                                   '01' if sampled else '00')
+
+
+def _random_id(nbytes):
+    while True:
+        value = random.getrandbits(8 * nbytes)
+        if value:
+            return '{0:0{1}x}'.format(value, 2 * nbytes)
+
+
+class Sampler:
+    """Decide which requests are traced.
+
+    The decision of the caller (the sampled flag of its traceparent) is
+    followed. Otherwise, a fraction rate of the traces is sampled, based on
+    the trace identifier (as the TraceIdRatioBased sampler of OpenTelemetry,
+    so that the services that use the same rate agree). In both cases, at
+    most max_per_second traces are recorded (None for no limit), which bounds
+    the overhead under load.
+    """
+
+    def __init__(self, rate=0.0, max_per_second=None):
+        self.rate = rate
+        self.max_per_second = max_per_second
+        self._tokens = max_per_second
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def should_sample(self, trace_id, parent=None):
+        if parent is not None:
+            sampled = parent.sampled
+        else:
+            sampled = int(trace_id[16:], 16) < self.rate * 2 ** 64
+        return sampled and self._acquire()
+
+    def _acquire(self):
+        if self.max_per_second is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                max(self.max_per_second, 1),
+                self._tokens
+                + (now - self._last_refill) * self.max_per_second)
+            self._last_refill = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class InMemoryExporter:
+    """Keep the last max_spans spans in memory (in the spans attribute)."""
+
+    def __init__(self, max_spans=10000):
+        self.spans = collections.deque(maxlen=max_spans)
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+    def clear(self):
+        self.spans.clear()
+
+
+class FileExporter:
+    """Append the spans to a file, as one JSON object per line.
+
+    Each trace is written with a single write in append mode, so that several
+    processes can share the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, spans):
+        data = ''.join(json.dumps(span, separators=(',', ':')) + '\n'
+                       for span in spans).encode('utf-8')
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+class Tracer:
+    """Sampler and exporter of the traces of an application."""
+
+    def __init__(self, sampler, exporter):
+        self.sampler = sampler
+        self.exporter = exporter
+
+
+class _RequestTrace:
+    __slots__ = ('trace_id', 'span_id', 'parent_span_id',
+                 'clock_offset_ns', 'receive')
+
+    def __init__(self, trace_id, parent_span_id):
+        self.trace_id = trace_id
+        self.span_id = _random_id(8)
+        self.parent_span_id = parent_span_id
+        # Converts the perf_counter_ns of timing into Unix time
+        self.clock_offset_ns = time_ns() - timing.perf_counter_ns()
+        self.receive = None
+
+    def span(self, name, start_ns, end_ns, parent_span_id, span_id=None,
+             kind='SPAN_KIND_INTERNAL', attributes=None, error=False):
+        return {
+            'traceId': self.trace_id,
+            'spanId': span_id or _random_id(8),
+            'parentSpanId': parent_span_id or '',
+            'name': name,
+            'kind': kind,
+            'startTimeUnixNano': start_ns + self.clock_offset_ns,
+            'endTimeUnixNano': end_ns + self.clock_offset_ns,
+            'attributes': attributes or {},
+            'status': {'code': 'STATUS_CODE_ERROR' if error
+                       else 'STATUS_CODE_UNSET'},
+        }
+
+
+def get_tracer(app):
+    """Return the Tracer of the application, or None if tracing is disabled."""
+    return app.extensions.get('voluba_tracer')
+
+
+def current_trace_id():
+    """Return the trace identifier of the current request, or None."""
+    if not flask.has_app_context():
+        return None
+    trace = flask.g.get('voluba_trace')
+    return trace.trace_id if trace is not None else None
+
+
+def _start_trace():
+    request = flask.request
+    if request.blueprint != 'api':
+        return
+    tracer = get_tracer(flask.current_app)
+    parent = parse_traceparent(request.headers.get(TRACEPARENT_HEADER))
+    trace_id = parent.trace_id if parent is not None else _random_id(16)
+    if not tracer.sampler.should_sample(trace_id, parent):
+        return
+    trace = flask.g.voluba_trace = _RequestTrace(
+        trace_id, parent.span_id if parent is not None else None)
+    if request.content_length:
+        # The body is cached, so it is not read again by the parser
+        start_ns = timing.perf_counter_ns()
+        request.get_data(cache=True)
+        trace.receive = (start_ns, timing.perf_counter_ns())
+
+
+def _finish_trace(response, timings):
+    trace = flask.g.get('voluba_trace')
+    if trace is None:
+        return
+    request = flask.request
+    attributes = {
+        'http.method': request.method,
+        'http.route': (request.url_rule.rule
+                       if request.url_rule is not None else request.path),
+        'http.status_code': response.status_code,
+    }
+    attributes.update(('voluba.' + key, value)
+                      for key, value in timings.labels.items())
+    spans = [trace.span(
+        '{0} {1}'.format(request.method, attributes['http.route']),
+        timings.start_ns, timings.last_ns, trace.parent_span_id,
+        span_id=trace.span_id, kind='SPAN_KIND_SERVER',
+        attributes=attributes, error=response.status_code >= 500)]
+    if trace.receive is not None:
+        spans.append(trace.span('receive', trace.receive[0], trace.receive[1],
+                                trace.span_id))
+        # The first stage starts once the body has been read
+        stage_start_ns = trace.receive[1]
+    else:
+        stage_start_ns = timings.start_ns
+    stage_end_ns = timings.start_ns
+    for stage_name, duration_ns in timings.stages:
+        stage_end_ns += duration_ns
+        spans.append(trace.span(stage_name, min(stage_start_ns, stage_end_ns),
+                                stage_end_ns, trace.span_id))
+        stage_start_ns = stage_end_ns
+    try:
+        get_tracer(flask.current_app).exporter.export(spans)
+    except Exception:
+        logger.exception('cannot export the spans of trace %s',
+                         trace.trace_id)
+    response.headers[TRACERESPONSE_HEADER] = format_traceparent(
+        trace.trace_id, trace.span_id)
+
+
+def make_exporter(app):
+    """Create the exporter selected by TRACING_EXPORTER."""
+    exporter = app.config.get('TRACING_EXPORTER', 'file')
+    if exporter == 'memory':
+        return InMemoryExporter()
+    if exporter == 'file':
+        path = app.config.get('TRACING_FILE')
+        if path is None:
+            path = os.path.join(app.instance_path, 'traces.jsonl')
+        return FileExporter(path)
+    if not hasattr(exporter, 'export'):
+        raise ValueError('invalid TRACING_EXPORTER {0!r}'.format(exporter))
+    return exporter
+
+
+def init_app(app):
+    """Install the request hooks, if tracing is enabled in the config."""
+    if not app.config.get('TRACING'):
+        return
+    app.extensions['voluba_tracer'] = Tracer(
+        Sampler(app.config.get('TRACING_SAMPLE_RATE', 0.0),
+                app.config.get('TRACING_MAX_TRACES_PER_SECOND')),
+        make_exporter(app))
+    # The timings are started by a before_request hook, which must run first
+    timing.add_listener(app, _finish_trace)
+    app.before_request(_start_trace)
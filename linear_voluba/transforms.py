@@ -0,0 +1,113 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Composition and application of affine transformations.
+
+Matrices are 4×4 in homogeneous coordinates, as returned by
+/api/least-squares.
+"""
+
+import functools
+
+import numpy as np
+
+
+# Number of composed chains kept in the cache of each process
+COMPOSITION_CACHE_SIZE = 1024
+
+
+class SingularMatrix(ValueError):
+    """Exception raised when a non-invertible matrix must be inverted."""
+    pass
+
+
+def _inv(matrix):
+    try:
+        return np.linalg.inv(matrix)
+    except np.linalg.LinAlgError:
+        raise SingularMatrix('the matrix is not invertible') from None
+
+
+@functools.lru_cache(maxsize=COMPOSITION_CACHE_SIZE)
+def _compose_cached(steps):
+    composed = np.eye(4)
+    for matrix_bytes, invert in steps:
+        matrix = np.frombuffer(matrix_bytes, dtype=np.float64).reshape(4, 4)
+        if invert:
+            matrix = _inv(matrix)
+        composed = matrix @ composed
+    inverse = _inv(composed)
+    # The cached arrays are shared between callers
+    composed.flags.writeable = False
+    inverse.flags.writeable = False
+    return composed, inverse
+
+
+def compose(matrices, invert=None):
+    """Compose a chain of transformations.
+
+    matrices are given in the order in which they are applied (e.g. section
+    to block, then block to reference), invert is an optional list of flags
+    that select the steps whose matrix is inverted before composition.
+    Return the composed matrix and its inverse (read-only arrays, which are
+    cached by the value of the steps). SingularMatrix is raised if an
+    inversion is impossible.
+    """
+    if invert is None:
+        invert = [False] * len(matrices)
+    if len(invert) != len(matrices):
+        raise ValueError('there must be one invert flag per matrix')
+    steps = tuple(
+        (np.ascontiguousarray(matrix, dtype=np.float64).tobytes(),
+         bool(flag))
+        for matrix, flag in zip(matrices, invert)
+    )
+    if any(len(matrix_bytes) != 16 * 8 for matrix_bytes, _ in steps):
+        raise ValueError('the matrices must be 4×4')
+    return _compose_cached(steps)
+
+
+def apply_transform(matrix, points):
+    """Transform an (N, 3) array of points by a 4×4 affine matrix."""
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def embed_slice_transforms(matrices, z, target_z=None):
+    """Embed the 2D transformations of slices into 3D affine matrices.
+
+    matrices is a (K, 3, 3) array of the transformations of K slices, in
+    homogeneous 2D coordinates, z is the (K,) array of the positions of the
+    slices along the third axis of the source space. The result is a
+    (K, 4, 4) array of matrices that transform the (x, y) coordinates in the
+    plane of each slice, and move the slice to target_z (by default, the
+    slices keep their position).
+    """
+    matrices = np.asarray(matrices, dtype=float)
+    if matrices.ndim != 3 or matrices.shape[1:] != (3, 3):
+        raise ValueError('the matrices must be a (K, 3, 3) array')
+    z = np.broadcast_to(np.asarray(z, dtype=float), matrices.shape[:1])
+    if target_z is None:
+        target_z = z
+    target_z = np.broadcast_to(np.asarray(target_z, dtype=float),
+                               matrices.shape[:1])
+    embedded = np.zeros((len(matrices), 4, 4))
+    embedded[:, :2, :2] = matrices[:, :2, :2]
+    embedded[:, :2, 3] = matrices[:, :2, 2]
+    embedded[:, 2, 2] = 1
+    embedded[:, 2, 3] = target_z - z
+    embedded[:, 3, 3] = 1
+    return embedded
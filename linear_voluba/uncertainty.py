@@ -0,0 +1,326 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Prediction of the target registration error (TRE).
+
+The TRE at a point of source space is the expected distance between the
+position given by the estimated transformation and the true position, due
+to the errors in the localization of the landmarks (the fiducial
+localization error, FLE). It is predicted from the configuration of the
+source landmarks:
+
+- for rigid and similarity transformations, by the formula of Fitzpatrick,
+  West and Maurer (IEEE TMI 1998, :DOI:`10.1109/42.736021`):
+  TRE²(r) = FLE² / N · (1 + 1/3 · Σ_k d_k² / f_k²), where d_k is the
+  distance of r to the k-th principal axis of the landmarks, and f_k the
+  RMS distance of the landmarks to that axis (plus a radial term for the
+  error on the scale factor of similarity transformations);
+- for affine transformations, from the covariance of the least-squares
+  parameters: TRE²(r) = FLE² · hᵀ (HᵀH)⁻¹ h, where h is r in homogeneous
+  coordinates and H the (N, 4) matrix of the landmarks.
+
+Both are a quadratic function of the position, α + |(r - c) · T|², which is
+evaluated on large grids by broadcasting, one slab at a time.
+
+:func:`score_candidates` ranks candidate positions for a new landmark, by
+the information that it would add (D-optimal design), or by the maximum TRE
+after adding it. Adding a landmark is a rank-3 update of the information
+matrix of the linearized problem, so all candidates are evaluated in a
+batch, without solving a new problem for each of them.
+"""
+
+import collections
+
+import numpy as np
+
+from linear_voluba import leastsquares
+
+
+# Number of parameters of each transformation type, used for estimating the
+# FLE from the residuals of the fit
+PARAMETER_COUNTS = {
+    'rigid': 6,
+    'rigid+reflection': 6,
+    'similarity': 7,
+    'similarity+reflection': 7,
+    'affine': 12,
+}
+
+# Number of grid points evaluated at once by tre_map
+DEFAULT_CHUNK_VOXELS = 2 ** 20
+
+SUGGESTION_CRITERIA = ['d-optimal', 'max-tre']
+"""Criteria supported by :func:`score_candidates`."""
+
+# Number of candidates evaluated at once by score_candidates
+DEFAULT_CHUNK_CANDIDATES = 2 ** 13
+
+# Relative regularization of a singular information matrix (criterion
+# d-optimal), so that the candidates that lift the degeneracy get a large
+# information gain
+INFORMATION_RIDGE = 1e-9
+
+
+TREModel = collections.namedtuple(
+    'TREModel', ['offset', 'centre', 'transform', 'fle'])
+TREModel.__doc__ = """Quadratic model of the squared TRE.
+
+TRE²(r) = offset + |(r - centre) @ transform|², for the fiducial
+localization error fle.
+"""
+
+
+def estimate_fle(transformation_type, src, dst):
+    """Estimate the FLE from the residuals of the fit (the FRE).
+
+    The expected squared FRE is FLE² · (1 - p / 3N) for a transformation
+    with p parameters fitted to N landmark pairs.
+    """
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    degrees_of_freedom = src.size - PARAMETER_COUNTS[transformation_type]
+    if degrees_of_freedom <= 0:
+        raise leastsquares.UnderdeterminedProblem(
+            'not enough landmark pairs to estimate the fiducial localization '
+            'error, at least {0} are needed'.format(
+                PARAMETER_COUNTS[transformation_type] // src.shape[1] + 1))
+    mat = leastsquares.estimate(transformation_type, src, dst)
+    mismatches = leastsquares.per_landmark_mismatch(src, dst, mat)
+    return np.sqrt(np.sum(mismatches ** 2) * src.shape[1]
+                   / degrees_of_freedom)
+
+
+def tre_model(transformation_type, src, fle, rcond=1e-6):
+    """Compute the TREModel for the (N, 3) source landmarks."""
+    if transformation_type not in PARAMETER_COUNTS:
+        raise ValueError('unknown transformation type {0!r}'
+                         .format(transformation_type))
+    src = np.asarray(src, dtype=float)
+    num = len(src)
+    if num == 0:
+        raise leastsquares.UnderdeterminedProblem(
+            'underdetermined problem: no landmark pairs')
+    centre = src.mean(axis=0)
+    src_demean = src - centre
+    # Principal axes of the landmark configuration, and the mean squared
+    # coordinate of the landmarks along each axis
+    eigenvalues, axes = np.linalg.eigh(src_demean.T @ src_demean / num)
+    eigenvalues = np.clip(eigenvalues, 0, None)
+    fle_squared = float(fle) ** 2
+    if transformation_type == 'affine':
+        if eigenvalues[0] <= rcond * eigenvalues[-1]:
+            raise leastsquares.UnderdeterminedProblem(
+                'underdetermined problem: the landmarks are coplanar')
+        # (HᵀH)⁻¹ restricted to the centred coordinates is the inverse of
+        # the scatter matrix of the landmarks
+        weights = 1 / (num * eigenvalues)
+    else:
+        # f_k², the mean squared distance of the landmarks to each axis
+        axis_distances = eigenvalues.sum() - eigenvalues
+        if axis_distances.min() <= rcond * axis_distances.max():
+            raise leastsquares.UnderdeterminedProblem(
+                'underdetermined problem: the landmarks are collinear')
+        # Σ_k d_k² / f_k² = Σ_j q_j² Σ_{k≠j} 1 / f_k², where q_j is the
+        # coordinate along the j-th axis
+        inverse = 1 / axis_distances
+        weights = (inverse.sum() - inverse) / (3 * num)
+        if transformation_type.startswith('similarity'):
+            # The error on the scale factor is independent of the rotation
+            # and translation errors, and adds a radial term
+            weights += 1 / (3 * num * eigenvalues.sum())
+    transform = axes * np.sqrt(fle_squared * weights)
+    return TREModel(fle_squared / num, centre, transform, float(fle))
+
+
+def predict_tre(model, points):
+    """Predict the TRE at the (M, 3) points of source space."""
+    weighted = (np.asarray(points, dtype=float) - model.centre) \
+        @ model.transform
+    return np.sqrt(model.offset + np.sum(weighted ** 2, axis=-1))
+
+
+def grid_affine_from_bounding_box(bounding_box, shape):
+    """Voxel-to-space matrix of a grid spanning bounding_box.
+
+    bounding_box is a pair of opposite corners, which are the centres of the
+    first and last voxels of the grid.
+    """
+    corner_min, corner_max = np.asarray(bounding_box, dtype=float)
+    shape = np.asarray(shape)
+    affine = np.eye(4)
+    affine[:3, :3] = np.diag(
+        (corner_max - corner_min) / np.maximum(shape - 1, 1))
+    affine[:3, 3] = corner_min
+    return affine
+
+
+def tre_map(model, shape, grid_affine, chunk_voxels=DEFAULT_CHUNK_VOXELS,
+            dtype=np.float32):
+    """Predict the TRE on a grid of source space.
+
+    grid_affine maps the voxel indices of the grid to the coordinates of
+    source space. The weighted coordinates are an affine function of the
+    indices, so each chunk is computed by broadcasting three 1-D arrays
+    rather than by materializing the coordinates of every voxel.
+    """
+    nx, ny, nz = shape
+    grid_affine = np.asarray(grid_affine, dtype=float)
+    steps = grid_affine[:3, :3].T @ model.transform  # one row per axis
+    origin = (grid_affine[:3, 3] - model.centre) @ model.transform
+    along_y = np.arange(ny)[:, np.newaxis, np.newaxis] * steps[1]
+    along_z = np.arange(nz)[np.newaxis, :, np.newaxis] * steps[2]
+    plane = along_y + along_z + origin  # (ny, nz, 3)
+    result = np.empty((nx, ny, nz), dtype=dtype)
+    slabs = max(1, chunk_voxels // max(ny * nz, 1))
+    for start in range(0, nx, slabs):
+        along_x = np.arange(start, min(start + slabs, nx))
+        weighted = (plane
+                    + along_x[:, np.newaxis, np.newaxis, np.newaxis]
+                    * steps[0])
+        squared = np.einsum('...i,...i->...', weighted, weighted)
+        squared += model.offset
+        result[start:start + slabs] = np.sqrt(squared)
+    return result
+
+
+def _jacobians(transformation_type, points):
+    """Jacobians (M, 3, P) of the transformed points w.r.t. the parameters.
+
+    The transformation is linearized around the identity, with the
+    parameters (translation, rotation vector, log-scale) for the rigid and
+    similarity types, and the 12 matrix coefficients for affine.
+    """
+    num = len(points)
+    if transformation_type == 'affine':
+        jacobians = np.zeros((num, 3, 12))
+        for i in range(3):
+            jacobians[:, i, 4 * i:4 * i + 3] = points
+            jacobians[:, i, 4 * i + 3] = 1
+        return jacobians
+    parameter_count = PARAMETER_COUNTS[transformation_type]
+    jacobians = np.zeros((num, 3, parameter_count))
+    jacobians[:, :, :3] = np.eye(3)
+    # δy = ω × x = -[x]× ω
+    x, y, z = points.T
+    jacobians[:, 0, 4], jacobians[:, 0, 5] = z, -y
+    jacobians[:, 1, 3], jacobians[:, 1, 5] = -z, x
+    jacobians[:, 2, 3], jacobians[:, 2, 4] = y, -x
+    if parameter_count == 7:
+        jacobians[:, :, 6] = points
+    return jacobians
+
+
+def score_candidates(transformation_type, src, candidates,
+                     criterion='d-optimal', fle=1.0,
+                     chunk_size=DEFAULT_CHUNK_CANDIDATES):
+    """Score candidate positions (K, 3) for adding a landmark to src.
+
+    With criterion 'd-optimal', the score is the information gain (in nats,
+    larger is better): log det(F') - log det(F), where F and F' are the
+    information matrices before and after adding the candidate. With
+    'max-tre', the score is the maximum TRE (lower is better) on the
+    bounding box of the candidates after adding the candidate. TRE² being
+    convex, its maximum is reached on a corner of the box.
+
+    Return (scores, current), where current is the score of the current
+    landmarks (0 for 'd-optimal', the current maximum TRE for 'max-tre').
+    """
+    if transformation_type not in PARAMETER_COUNTS:
+        raise ValueError('unknown transformation type {0!r}'
+                         .format(transformation_type))
+    if criterion not in SUGGESTION_CRITERIA:
+        raise ValueError('unknown criterion {0!r}'.format(criterion))
+    src = np.asarray(src, dtype=float).reshape(-1, 3)
+    candidates = np.asarray(candidates, dtype=float).reshape(-1, 3)
+    # Centre and scale the coordinates, which reparametrizes the problem
+    # linearly (all the scores are invariant) but keeps it well-conditioned
+    reference = src if len(src) else candidates
+    centre = reference.mean(axis=0)
+    scale = np.sqrt(np.mean(np.sum((reference - centre) ** 2, axis=1)))
+    if not scale > 0:
+        scale = 1.0
+    jacobians = _jacobians(transformation_type, (src - centre) / scale)
+    information = np.einsum('nip,niq->pq', jacobians, jacobians)
+    parameter_count = information.shape[0]
+    eigenvalues = np.linalg.eigvalsh(information)
+    singular = eigenvalues[0] <= 1e-12 * max(eigenvalues[-1], 1)
+    if singular:
+        if criterion != 'd-optimal':
+            raise leastsquares.UnderdeterminedProblem(
+                'underdetermined problem: add landmarks before predicting '
+                'the TRE (use the d-optimal criterion)')
+        information = information + INFORMATION_RIDGE * max(
+            np.trace(information) / parameter_count, 1) * np.eye(
+                parameter_count)
+    covariance = np.linalg.inv(information)
+    identity = np.eye(3)
+    if criterion == 'max-tre':
+        lower, upper = candidates.min(axis=0), candidates.max(axis=0)
+        corners = np.array([[upper[i] if (c >> i) & 1 else lower[i]
+                             for i in range(3)] for c in range(8)])
+        corner_jacobians = _jacobians(transformation_type,
+                                      (corners - centre) / scale)
+        corner_covariance = corner_jacobians @ covariance  # (8, 3, P)
+        # trace(J_r F⁻¹ J_rᵀ) for each corner
+        current_traces = np.einsum('mip,mip->m', corner_covariance,
+                                   corner_jacobians)
+        # Per-coordinate variance FLE² / 3
+        variance = fle ** 2 / 3
+        current = float(np.sqrt(variance * current_traces.max()))
+    else:
+        current = 0.0
+    scores = np.empty(len(candidates))
+    for start in range(0, len(candidates), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        jc = _jacobians(transformation_type,
+                        (candidates[chunk] - centre) / scale)
+        # J_c F⁻¹ J_cᵀ, the (3, 3) matrix of the rank-3 update
+        update = (jc @ covariance) @ jc.transpose(0, 2, 1) + identity
+        if criterion == 'd-optimal':
+            # Matrix determinant lemma: det(F + J_cᵀ J_c) / det(F)
+            # = det(I + J_c F⁻¹ J_cᵀ)
+            scores[chunk] = np.linalg.slogdet(update)[1]
+        else:
+            # Woodbury: the trace for corner r decreases by
+            # trace(B (I + J_c F⁻¹ J_cᵀ)⁻¹ Bᵀ), with B = J_r F⁻¹ J_cᵀ
+            cross = np.matmul(corner_covariance,
+                              jc.transpose(0, 2, 1)[:, np.newaxis])
+            reduction = np.sum(
+                (cross @ np.linalg.inv(update)[:, np.newaxis]) * cross,
+                axis=(2, 3))
+            traces = current_traces - reduction
+            scores[chunk] = np.sqrt(variance * traces.max(axis=1))
+    return scores, current
+
+
+def suggest_landmarks(transformation_type, src, candidates, count=10,
+                      criterion='d-optimal', fle=1.0):
+    """Return the indices and scores of the count best candidates.
+
+    See :func:`score_candidates`. The indices are sorted from the best
+    candidate to the worst.
+    """
+    scores, current = score_candidates(transformation_type, src,
+                                       candidates, criterion=criterion,
+                                       fle=fle)
+    # Sort in decreasing order of preference
+    keys = -scores if criterion == 'd-optimal' else scores
+    count = min(count, len(scores))
+    if count == 0:
+        return np.zeros(0, dtype=int), scores[:0], current
+    best = np.argpartition(keys, count - 1)[:count]
+    best = best[np.argsort(keys[best], kind='stable')]
+    return best, scores[best], current
@@ -18,4 +18,8 @@
 
 
 import linear_voluba
+from linear_voluba import resources
 application = linear_voluba.create_app()
+# The thread pools are limited here rather than in create_app, which is also
+# used by the tests and scripts
+resources.configure_blas_threads(application.config.get('BLAS_THREADS'))
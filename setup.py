@@ -29,6 +29,7 @@ def find_version(*file_paths):
 
 # Remember keep synchronized with the list of dependencies in tox.ini
 tests_require = [
+    "prometheus_client",
     "pytest",
 ]
 
@@ -46,6 +47,7 @@ setuptools.setup(
         "Flask-Cors",
         "flask-smorest ~= 0.18.3",
         "numpy",
+        "threadpoolctl",
     ],
     python_requires="~= 3.5",
     extras_require={
@@ -58,6 +60,8 @@ setuptools.setup(
             "readme_renderer",
             "tox",
         ],
+        "icp": ["scipy"],
+        "metrics": ["prometheus_client"],
         "tests": tests_require,
     },
     setup_requires=pytest_runner,
@@ -206,6 +206,69 @@ def test_least_squares_invalid_requests(client):
     assert 400 <= response.status_code < 500
 
 
+def test_least_squares_inactive_pairs(client):
+    landmark_pairs = [dict(pair, active=True) for pair in TEST_LANDMARK_PAIRS]
+    landmark_pairs.insert(1, {'source_point': [0, 0, 0],
+                              'target_point': [1000, 0, 0],
+                              'active': False})
+    response = client.post('/api/least-squares', json={
+        'landmark_pairs': landmark_pairs,
+        'transformation_type': 'similarity',
+    })
+    assert response.status_code == 200
+    reference = client.post('/api/least-squares', json={
+        'landmark_pairs': TEST_LANDMARK_PAIRS,
+        'transformation_type': 'similarity',
+    }).json
+    assert numpy.allclose(response.json['transformation_matrix'],
+                          reference['transformation_matrix'])
+    mismatches = [pair['mismatch']
+                  for pair in response.json['landmark_pairs']]
+    # The mismatches are aligned with the pairs, including inactive ones
+    assert mismatches[1] > 900
+    assert numpy.allclose(mismatches[:1] + mismatches[2:],
+                          [pair['mismatch']
+                           for pair in reference['landmark_pairs']])
+    response = client.post('/api/least-squares?compact=true', json={
+        'landmark_pairs': landmark_pairs,
+        'transformation_type': 'similarity',
+    })
+    assert response.json['mismatches'] == mismatches
+
+
+def test_least_squares_compact(client):
+    request = {
+        'landmark_pairs': TEST_LANDMARK_PAIRS,
+        'transformation_type': 'affine',
+    }
+    full = client.post('/api/least-squares', json=request).json
+    response = client.post('/api/least-squares?compact=true', json=request)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    assert list(response.json) == ['transformation_matrix', 'inverse_matrix',
+                                   'RMSE', 'mismatches']
+    assert response.json['transformation_matrix'] == \
+        full['transformation_matrix']
+    assert response.json['RMSE'] == full['RMSE']
+    assert response.json['mismatches'] == [
+        pair['mismatch'] for pair in full['landmark_pairs']]
+
+    response = client.post(
+        '/api/least-squares?compact=true&significant_digits=3', json=request)
+    assert response.status_code == 200
+    matrix = numpy.array(response.json['transformation_matrix'])
+    assert numpy.allclose(matrix, full['transformation_matrix'],
+                          rtol=5e-3, atol=1e-12)
+    assert all(float('%.3g' % value) == value for value in matrix.flat)
+
+    response = client.post(
+        '/api/least-squares?significant_digits=3', json=request)
+    assert response.status_code == 422
+    response = client.post(
+        '/api/least-squares?compact=true&significant_digits=0', json=request)
+    assert response.status_code == 422
+
+
 def test_transformation_matrix_field():
     import marshmallow
     from marshmallow.exceptions import ValidationError
@@ -269,3 +332,69 @@ def test_transformation_matrix_field():
             "type": "number"
         },
     }
+
+
+def test_slice_stack(client, app):
+    rng = numpy.random.RandomState(0)
+    slices = []
+    expected = []
+    for z in range(10):
+        angle = rng.uniform(-0.5, 0.5)
+        rotation = numpy.array([[numpy.cos(angle), -numpy.sin(angle)],
+                                [numpy.sin(angle), numpy.cos(angle)]])
+        translation = rng.uniform(-10, 10, size=2)
+        source = rng.uniform(0, 100, size=(5, 2))
+        target = source @ rotation.T + translation
+        slices.append({
+            'z': z,
+            'landmark_pairs': [
+                {'source_point': s.tolist(), 'target_point': t.tolist()}
+                for s, t in zip(source, target)
+            ],
+        })
+        matrix = numpy.eye(4)
+        matrix[:2, :2] = rotation
+        matrix[:2, 3] = translation
+        expected.append(matrix)
+    # An outlier which is ignored
+    slices[3]['landmark_pairs'].append({'source_point': [0, 0],
+                                        'target_point': [50, 50],
+                                        'active': False})
+    slices[4]['target_z'] = 40
+    response = client.post('/api/slice-stack', json={
+        'transformation_type': 'rigid',
+        'slices': slices,
+    })
+    assert response.status_code == 200
+    result = response.json['slices']
+    assert [slice_['z'] for slice_ in result] == list(range(10))
+    expected[4][2, 3] = 36
+    for slice_, matrix in zip(result, expected):
+        assert numpy.allclose(slice_['transformation_matrix'], matrix)
+        assert numpy.allclose(slice_['inverse_matrix'],
+                              numpy.linalg.inv(matrix))
+    assert result[0]['RMSE'] == pytest.approx(0, abs=1e-9)
+    assert result[3]['RMSE'] > 10
+
+    slices[5]['landmark_pairs'] = slices[5]['landmark_pairs'][:1]
+    response = client.post('/api/slice-stack', json={
+        'transformation_type': 'rigid',
+        'slices': slices,
+    })
+    assert response.status_code == 400
+    assert response.json['message'].startswith('problem 5: ')
+
+    response = client.post('/api/slice-stack', json={
+        'transformation_type': 'rigid',
+        'slices': [{'z': 0, 'landmark_pairs': [
+            {'source_point': [0, 0, 0], 'target_point': [0, 0]},
+        ]}],
+    })
+    assert response.status_code == 422
+
+    app.config['SLICE_STACK_MAX_LANDMARKS'] = 10
+    response = client.post('/api/slice-stack', json={
+        'transformation_type': 'rigid',
+        'slices': slices,
+    })
+    assert response.status_code == 413
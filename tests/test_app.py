@@ -17,6 +17,8 @@
 
 import logging
 
+import pytest
+
 
 def test_config():
     from linear_voluba import create_app
@@ -42,6 +44,40 @@ def test_source_route(client):
 def test_health_route(client):
     response = client.get('/health')
     assert response.status_code == 200
+    response = client.get('/health/live')
+    assert response.status_code == 200
+
+
+def test_readiness_route(client):
+    from linear_voluba import readiness
+    response = client.get('/health/ready')
+    assert response.status_code == 200
+    readiness.set_not_ready()
+    try:
+        response = client.get('/health/ready')
+        assert response.status_code == 503
+        # The liveness probe is not affected
+        assert client.get('/health/live').status_code == 200
+    finally:
+        readiness.set_ready()
+
+
+def test_create_app_keeps_blas_threads(monkeypatch):
+    from linear_voluba import create_app, resources
+    calls = []
+    monkeypatch.setattr(resources, 'limit_blas_threads', calls.append)
+    create_app({'TESTING': True, 'BLAS_THREADS': 2})
+    assert calls == []
+
+
+def test_warmup(monkeypatch):
+    from linear_voluba import create_app, leastsquares
+    calls = []
+    monkeypatch.setattr(leastsquares, 'warm_up', lambda: calls.append(True))
+    create_app({'TESTING': True, 'WARMUP': False})
+    assert calls == []
+    create_app({'TESTING': True, 'WARMUP': True})
+    assert calls == [True]
 
 
 def test_echo_route():
@@ -135,3 +171,36 @@ def test_openapi_spec_development_mode():
     with app.test_client() as client:
         response = client.get('/openapi.json')
     assert response.json['servers'][0]['url'] == '/'
+
+
+def test_openapi_spec_caching(client):
+    response = client.get('/openapi.json')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert 'public' in response.headers['Cache-Control']
+    assert 'max-age' in response.headers['Cache-Control']
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+    response = client.get('/openapi.json', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_openapi_spec_gzip(client):
+    import gzip
+    import json
+    identity = client.get('/openapi.json')
+    response = client.get('/openapi.json',
+                          headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] != identity.headers['ETag']
+    assert len(response.data) < len(identity.data)
+    assert json.loads(gzip.decompress(response.data)) == identity.json
+
+
+def test_openapi_spec_endpoint_required():
+    import flask
+    from linear_voluba import openapi
+    with pytest.raises(RuntimeError):
+        openapi.init_app(flask.Flask(__name__), api=None)
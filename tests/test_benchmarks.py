@@ -0,0 +1,172 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import glob
+import json
+import os.path
+import subprocess
+import sys
+
+import pytest
+
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(__file__), os.pardir,
+                              'benchmarks')
+
+
+def run_script(*args):
+    return subprocess.run(
+        [sys.executable, os.path.join(BENCHMARKS_DIR, 'solvers.py')]
+        + list(args),
+        stdout=subprocess.PIPE, universal_newlines=True,
+    )
+
+
+@pytest.fixture(scope='module')
+def results_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('benchmarks') / 'results.json')
+    process = run_script('run', '--max-landmarks', '10', '--repeat', '1',
+                         '--min-time', '0.001', '--filter', 'affine',
+                         '--output', path)
+    assert process.returncode == 0
+    return path
+
+
+def test_run(results_file):
+    with open(results_file) as f:
+        results = json.load(f)
+    assert 'numpy' in results['metadata']
+    assert 'estimate/affine/N=4' in results['results']
+    assert 'degenerate/affine/N=10' in results['results']
+    assert 'estimate/rigid/N=4' not in results['results']
+    assert results['results']['estimate/affine/N=4']['min'] > 0
+
+
+def test_compare(results_file, tmp_path):
+    process = run_script('compare', results_file, results_file)
+    assert process.returncode == 0
+    assert '0 regression(s)' in process.stdout
+
+    with open(results_file) as f:
+        results = json.load(f)
+    results['results']['estimate/affine/N=4']['min'] /= 2
+    faster_baseline = str(tmp_path / 'baseline.json')
+    with open(faster_baseline, 'w') as f:
+        json.dump(results, f)
+    process = run_script('compare', '--only-regressions',
+                         faster_baseline, results_file)
+    assert process.returncode == 1
+    assert 'estimate/affine/N=4' in process.stdout
+    assert 'REGRESSION' in process.stdout
+    assert '1 regression(s)' in process.stdout
+
+
+def import_benchmark_module(name):
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(BENCHMARKS_DIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_loadtest_request_pool(client):
+    loadtest = import_benchmark_module('loadtest')
+    pool = loadtest.make_request_pool(size=50)
+    categories = {request.category for request in pool}
+    assert categories <= {'least-squares', 'degenerate', 'health'}
+    assert 'least-squares' in categories
+    for request in pool[:20]:
+        response = client.open(request.path, method=request.method,
+                               data=request.body,
+                               content_type='application/json')
+        if request.category == 'degenerate':
+            assert response.status_code == 400
+        else:
+            assert response.status_code == 200
+
+
+def test_loadtest_summarize():
+    loadtest = import_benchmark_module('loadtest')
+    ok = loadtest.Request('least-squares', 'POST', '/api/least-squares')
+    health = loadtest.Request('health', 'GET', '/health')
+    results = ([(ok, 200, 0.010)] * 98 + [(ok, 500, 1.0), (health, 0, 2.0)])
+    summary = loadtest.summarize(results, elapsed=10.0)
+    assert summary['all']['count'] == 100
+    assert summary['all']['throughput'] == 10.0
+    assert summary['all']['p50'] == pytest.approx(0.010)
+    assert summary['all']['server_errors'] == 1
+    assert summary['all']['network_errors'] == 1
+    assert summary['health']['count'] == 1
+
+
+@pytest.fixture
+def replay(monkeypatch):
+    # replay.py imports loadtest from its own directory
+    monkeypatch.syspath_prepend(BENCHMARKS_DIR)
+    return import_benchmark_module('replay')
+
+
+def test_replay_requests(replay, client, tmp_path):
+    from linear_voluba import capture
+    writer = capture.CaptureWriter(str(tmp_path), 2 ** 20, 10)
+    body = {
+        'transformation_type': 'affine',
+        'landmark_pairs': [
+            {'source_point': [0, 0, 0], 'target_point': [1, 0, 0]},
+            {'source_point': [1, 0, 0], 'target_point': [2, 0, 0]},
+            {'source_point': [0, 1, 0], 'target_point': [1, 1, 0]},
+            {'source_point': [0, 0, 1], 'target_point': [1, 0, 1]},
+        ],
+    }
+    for t in [1000.0, 1010.0, 1001.0]:
+        writer.write({'time': t, 'method': 'POST',
+                      'path': '/api/least-squares', 'query': 'compact=1',
+                      'status': 200, 'duration': 0.001, 'body': body})
+    writer.close()
+    requests = replay.load_requests(
+        glob.glob(str(tmp_path / capture.FILE_PATTERN)))
+    assert [offset for offset, _, _ in requests] == [0.0, 1.0, 10.0]
+    request = requests[0][1]
+    assert request.category == 'least-squares/affine'
+    response = client.open(request.path, method=request.method,
+                           data=request.body,
+                           content_type='application/json')
+    assert response.status_code == 200
+    assert 'inverse_matrix' in response.json
+
+    schedule = replay.make_schedule(requests, speed=2.0)
+    assert [offset for offset, _ in schedule] == [0.0, 0.5, 5.0]
+    schedule = replay.make_schedule(requests, speed=2.0, max_gap=1.0)
+    assert [offset for offset, _ in schedule] == [0.0, 0.5, 1.5]
+
+
+def test_replay_compare(replay):
+    baseline = {
+        'categories': ['a'] * 10 + ['b'] * 10,
+        'latencies': [0.010] * 20,
+        'statuses': [200] * 20,
+    }
+    new = dict(baseline, latencies=[0.011] * 10 + [0.020] * 9 + [None])
+    comparison = replay.compare_replays(baseline, new)
+    assert [entry[0] for entry in comparison] == ['a', 'b']
+    assert comparison[0][1:5] == pytest.approx((10, 0.010, 0.011, 1.1))
+    assert not comparison[0][5]
+    assert comparison[1][1] == 9
+    assert comparison[1][4] == pytest.approx(2.0)
+    assert comparison[1][5]
+    with pytest.raises(ValueError):
+        replay.compare_replays(baseline, dict(new, categories=['a'] * 20))
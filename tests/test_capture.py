@@ -0,0 +1,138 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import glob
+import os.path
+import random
+
+import pytest
+
+import linear_voluba
+from linear_voluba import capture
+
+
+LANDMARK_PAIRS = [
+    {'source_point': [0, 0, 0], 'target_point': [1, 0, 0],
+     'name': 'anterior commissure', 'colour': '#8dd3c7'},
+    {'source_point': [1, 0, 0], 'target_point': [2, 0, 0], 'active': False},
+    {'source_point': [0, 1, 0], 'target_point': [1, 1, 0]},
+    {'source_point': [0, 0, 1], 'target_point': [1, 0, 1]},
+    {'source_point': [1, 1, 1], 'target_point': [2, 1, 1]},
+]
+
+
+def test_anonymise():
+    body = {
+        'transformation_type': 'affine',
+        'landmark_pairs': LANDMARK_PAIRS,
+        'comment': 'private',
+        'tags': ['private', 1],
+    }
+    anonymised = capture.anonymise(body)
+    assert anonymised == {
+        'transformation_type': 'affine',
+        'landmark_pairs': [
+            {'source_point': [0, 0, 0], 'target_point': [1, 0, 0]},
+        ] + LANDMARK_PAIRS[1:],
+        'tags': [1],
+    }
+    assert body['landmark_pairs'][0]['name'] == 'anterior commissure'
+
+    jittered = capture.anonymise(body, jitter=0.1, rng=random.Random(0))
+    for pair, jittered_pair in zip(body['landmark_pairs'],
+                                   jittered['landmark_pairs']):
+        assert jittered_pair['source_point'] == pytest.approx(
+            pair['source_point'], abs=1.0)
+        assert jittered_pair['source_point'] != pair['source_point']
+        # Only the coordinates are jittered
+        assert jittered_pair.get('active') == pair.get('active')
+
+
+def test_capture_writer(tmp_path):
+    writer = capture.CaptureWriter(str(tmp_path), max_bytes=1000, max_files=3)
+    for i in range(100):
+        writer.write({'index': i, 'padding': 'x' * 50})
+    paths = glob.glob(str(tmp_path / capture.FILE_PATTERN))
+    open_paths = glob.glob(str(tmp_path / capture.FILE_PATTERN)
+                           + capture.OPEN_SUFFIX)
+    assert (len(paths), len(open_paths)) == (2, 1)
+    # The file that is still being written can be read
+    paths = sorted(paths + open_paths, key=os.path.getmtime)
+    records = list(capture.read_capture(paths))
+    assert [record['index'] for record in records] == list(
+        range(100 - len(records), 100))
+    writer.close()
+    paths = sorted(glob.glob(str(tmp_path / capture.FILE_PATTERN)),
+                   key=os.path.getmtime)
+    assert len(paths) == 3
+    assert list(capture.read_capture(paths)) == records
+
+
+def test_capture_writer_shared_directory(tmp_path, monkeypatch):
+    # A file that another process is still writing is never removed
+    other_path = str(tmp_path / 'capture-20200101T000000-{0}-0.jsonl.gz'
+                     .format(os.getppid())) + capture.OPEN_SUFFIX
+    with open(other_path, 'wb'):
+        pass
+    os.utime(other_path, (0, 0))
+    # The file of a process that was killed is closed, then removed
+    dead_path = str(tmp_path / 'capture-20200101T000000-999999999-0.jsonl.gz')
+    with open(dead_path + capture.OPEN_SUFFIX, 'wb'):
+        pass
+    os.utime(dead_path + capture.OPEN_SUFFIX, (0, 0))
+    writer = capture.CaptureWriter(str(tmp_path), max_bytes=1000, max_files=3)
+    for i in range(100):
+        writer.write({'index': i, 'padding': 'x' * 50})
+    assert os.path.exists(other_path)
+    assert not os.path.exists(dead_path + capture.OPEN_SUFFIX)
+    assert not os.path.exists(dead_path)
+    assert len(glob.glob(str(tmp_path / capture.FILE_PATTERN))) == 1
+    writer.close()
+
+
+def test_capture_requests(tmp_path, monkeypatch):
+    monkeypatch.setenv('INSTANCE_PATH', str(tmp_path))
+    app = linear_voluba.create_app({
+        'TESTING': True,
+        'CAPTURE_SAMPLE_RATE': 1.0,
+    })
+    client = app.test_client()
+    response = client.post('/api/least-squares?compact=true', json={
+        'transformation_type': 'rigid',
+        'landmark_pairs': LANDMARK_PAIRS,
+    })
+    assert response.status_code == 200
+    assert client.post('/api/least-squares', json={}).status_code == 422
+    assert client.get('/health').status_code == 200
+    assert client.post('/api/least-squares', data='{',
+                       content_type='application/json').status_code == 400
+
+    records = list(capture.read_capture(glob.glob(
+        str(tmp_path / 'capture' / capture.FILE_PATTERN) + '*')))
+    assert [record['status'] for record in records] == [200, 422]
+    record = records[0]
+    assert record['method'] == 'POST'
+    assert record['path'] == '/api/least-squares'
+    assert record['query'] == 'compact=true'
+    assert record['duration'] > 0
+    assert record['body']['transformation_type'] == 'rigid'
+    assert 'name' not in record['body']['landmark_pairs'][0]
+    assert record['body']['landmark_pairs'][1:] == LANDMARK_PAIRS[1:]
+
+
+def test_capture_disabled(app, client):
+    assert client.post('/api/least-squares', json={}).status_code == 422
+    assert not os.path.exists(os.path.join(app.instance_path, 'capture'))
@@ -0,0 +1,130 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import json
+
+import pytest
+
+from linear_voluba import costmodel
+
+
+def make_results(fixed, slope, per_byte):
+    results = {}
+    for count in [3, 10, 100, 1000, 10000]:
+        results['estimate/affine/N={0}'.format(count)] = {
+            'min': fixed + slope * count}
+        results['per_landmark_mismatch/N={0}'.format(count)] = {
+            'min': slope * count}
+        results['parse/N={0}/bytes={1}'.format(count, 200 * count)] = {
+            'min': per_byte * 200 * count}
+    results['batch/affine/N=10/batch=10'] = {'min': 1.0}
+    return results
+
+
+def test_fit():
+    model = costmodel.CostModel.fit(make_results(1e-4, 1e-7, 2e-7))
+    assert model.solve['affine'] == pytest.approx((1e-4, 1e-7))
+    assert model.mismatch == pytest.approx((0, 1e-7), abs=1e-12)
+    assert model.parse == pytest.approx((0, 2e-7), abs=1e-12)
+    # The types that were not measured keep the built-in coefficients
+    assert model.solve['rigid'] == costmodel.DEFAULT_MODEL.solve['rigid']
+    assert model.parse_cost(10 ** 6) == pytest.approx(0.2)
+    assert model.cost('affine', 1000, 10 ** 6) == pytest.approx(
+        0.2 + 1e-4 + 2e-4)
+    # An unknown type gets the most pessimistic coefficients
+    assert model.solve_cost('unknown', 1000) >= max(
+        model.solve_cost(transformation_type, 1000)
+        for transformation_type in model.solve)
+
+
+def test_fit_linear():
+    # Noisy times that decrease with the size
+    assert costmodel._fit_linear([1, 10, 100], [3.0, 2.0, 1.0])[1] == 0
+    # The largest size is never under-estimated
+    fixed, slope = costmodel._fit_linear([1, 10, 100, 1000],
+                                         [1.0, 1.0, 1.1, 5.0])
+    assert fixed + slope * 1000 >= 5.0 - 1e-9
+    assert fixed >= 0
+
+
+def test_cost_model_config(app, tmp_path):
+    path = tmp_path / 'results.json'
+    path.write_text(json.dumps({
+        'metadata': {},
+        'results': make_results(1e-4, 1e-7, 2e-7),
+    }))
+    app.config['COST_MODEL_BENCHMARK'] = str(path)
+    model = costmodel.get_cost_model(app)
+    assert model.parse == pytest.approx((0, 2e-7), abs=1e-12)
+    assert costmodel.get_cost_model(app) is model
+
+    del app.extensions['voluba_cost_model']
+    app.config['COST_MODEL_BENCHMARK'] = str(tmp_path / 'missing.json')
+    assert costmodel.get_cost_model(app) is costmodel.DEFAULT_MODEL
+
+
+LANDMARK_PAIRS = [
+    {'source_point': [0, 0, 0], 'target_point': [1, 0, 0]},
+    {'source_point': [1, 0, 0], 'target_point': [2, 0, 0]},
+    {'source_point': [0, 1, 0], 'target_point': [1, 1, 0]},
+    {'source_point': [0, 0, 1], 'target_point': [1, 0, 1]},
+]
+
+
+def post(client, headers=None, path='/api/least-squares'):
+    return client.post(path, json={
+        'transformation_type': 'affine',
+        'landmark_pairs': LANDMARK_PAIRS,
+    }, headers=headers)
+
+
+def test_early_rejection(app, client):
+    assert post(client).status_code == 200
+    assert post(client, {'X-Request-Timeout': '10'}).status_code == 200
+
+    # Rejected from the Content-Length, before parsing
+    app.extensions['voluba_cost_model'] = costmodel.CostModel(
+        solve={'affine': (0, 0)}, parse=(0, 1.0))
+    app.config['REQUEST_COST_BUDGET'] = 100
+    response = post(client)
+    assert response.status_code == 413
+    assert 'estimated to take' in response.json['message']
+    response = post(client, path='/api/sessions')
+    assert response.status_code == 413
+    response = post(client, path='/api/icp')
+    assert response.status_code == 413
+
+    # Rejected from the number of landmarks, before solving
+    app.extensions['voluba_cost_model'] = costmodel.CostModel(
+        solve={'affine': (0, 30.0)})
+    assert post(client).status_code == 413
+    response = post(client, {'X-Request-Timeout': '30'})
+    assert response.status_code == 413
+
+    app.config['REQUEST_COST_BUDGET'] = None
+    assert post(client).status_code == 200
+    response = post(client, {'X-Request-Timeout': '30'})
+    assert response.status_code == 504
+    assert 'X-Request-Timeout' in response.json['message']
+    assert post(client, {'X-Request-Timeout': '150'}).status_code == 200
+
+    for value in ['soon', '0', '-1', 'nan']:
+        response = post(client, {'X-Request-Timeout': value})
+        assert response.status_code == 400
+
+    # Other endpoints are not checked
+    app.config['REQUEST_COST_BUDGET'] = 0
+    assert client.get('/health').status_code == 200
@@ -0,0 +1,119 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import os
+
+import pytest
+
+
+@pytest.fixture
+def gunicorn_conf(monkeypatch):
+    # Importing the module has side effects on the environment
+    monkeypatch.delenv('WEB_CONCURRENCY', raising=False)
+    from linear_voluba import gunicorn_conf
+    return gunicorn_conf
+
+
+def test_module_settings(gunicorn_conf):
+    assert gunicorn_conf.workers >= 1
+    assert gunicorn_conf.preload_app
+    assert gunicorn_conf.max_requests_jitter > 0
+
+
+def test_derive_settings_cpu(gunicorn_conf):
+    settings = gunicorn_conf.derive_settings(
+        4, None, {'GUNICORN_WORKER_CLASS': 'gevent'})
+    assert settings['workers'] == 4
+    assert settings['worker_class'] == 'gevent'
+    assert 0 < settings['max_requests_jitter'] < settings['max_requests']
+
+    settings = gunicorn_conf.derive_settings(
+        4, None, {'GUNICORN_WORKER_CLASS': 'sync'})
+    assert settings['workers'] == 9
+
+
+def test_derive_settings_memory(gunicorn_conf):
+    settings = gunicorn_conf.derive_settings(
+        8, 512 * 2 ** 20, {'GUNICORN_WORKER_CLASS': 'gevent',
+                           'VOLUBA_WORKER_MEMORY': str(200 * 2 ** 20)})
+    assert settings['workers'] == 2
+    # Always at least one worker
+    settings = gunicorn_conf.derive_settings(
+        8, 100 * 2 ** 20, {'GUNICORN_WORKER_CLASS': 'gevent'})
+    assert settings['workers'] == 1
+
+
+def test_derive_settings_overrides(gunicorn_conf):
+    settings = gunicorn_conf.derive_settings(2, None, {
+        'GUNICORN_WORKER_CLASS': 'gthread',
+        'WEB_CONCURRENCY': '5',
+        'GUNICORN_TIMEOUT': '10',
+        'GUNICORN_KEEPALIVE': '2',
+        'GUNICORN_MAX_REQUESTS': '100',
+    })
+    assert settings == {
+        'workers': 5,
+        'worker_class': 'gthread',
+        'timeout': 10,
+        'graceful_timeout': 30,
+        'keepalive': 2,
+        'max_requests': 100,
+        'max_requests_jitter': 10,
+    }
+
+
+def test_shutdown_hooks(gunicorn_conf):
+    from linear_voluba import readiness
+    readiness.set_ready()
+    try:
+        gunicorn_conf.worker_int(None)
+        assert not readiness.is_ready()
+        readiness.set_ready()
+        gunicorn_conf.worker_exit(None, None)
+        assert not readiness.is_ready()
+    finally:
+        readiness.set_ready()
+
+
+def test_share_cpus(gunicorn_conf, monkeypatch):
+    import types
+    from linear_voluba import resources
+    calls = []
+    monkeypatch.setattr(resources, 'configure_blas_threads', lambda setting: (
+        calls.append((setting, os.environ['WEB_CONCURRENCY']))))
+    monkeypatch.setenv('WEB_CONCURRENCY', '2')
+    for variable in resources.THREAD_ENVIRONMENT_VARIABLES:
+        monkeypatch.setenv(variable, '1')
+    monkeypatch.setattr(gunicorn_conf, '_derived_thread_variables',
+                        ['OMP_NUM_THREADS'])
+    monkeypatch.setattr(resources, 'threads_per_worker',
+                        lambda workers: 12 // workers)
+    application = types.SimpleNamespace(config={'BLAS_THREADS': 'auto'})
+    server = types.SimpleNamespace(
+        cfg=types.SimpleNamespace(workers=3, preload_app=True),
+        app=types.SimpleNamespace(wsgi=lambda: application))
+    # --workers on the command line of Gunicorn
+    gunicorn_conf._share_cpus(server, server.cfg.workers)
+    assert os.environ['WEB_CONCURRENCY'] == '3'
+    assert os.environ['OMP_NUM_THREADS'] == '4'
+    assert os.environ['OPENBLAS_NUM_THREADS'] == '1'
+    assert calls == [('auto', '3')]
+    # Nothing to do if the number of workers is unchanged
+    gunicorn_conf._share_cpus(server, 3)
+    assert len(calls) == 1
+    gunicorn_conf.nworkers_changed(server, 6, 3)
+    assert os.environ['OMP_NUM_THREADS'] == '2'
+    assert calls[-1] == ('auto', '6')
@@ -0,0 +1,160 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import json
+
+import numpy
+import pytest
+
+from linear_voluba import icp
+from linear_voluba import leastsquares
+
+
+# A small rotation around an oblique axis, and a translation
+TEST_MATRIX = numpy.array([
+    [0.99500417, -0.0841313, 0.0541892, 2.0],
+    [0.08673834, 0.99514003, -0.04648591, -1.5],
+    [-0.05001509, 0.05095598, 0.99744775, 1.0],
+    [0.0, 0.0, 0.0, 1.0],
+])
+
+
+def make_clouds(count=3000, seed=0, noise=0.01):
+    """Clustered points (like cell centroids), and the same points moved by
+    TEST_MATRIX, with partial overlap."""
+    rng = numpy.random.RandomState(seed)
+    centres = rng.uniform([-60, -40, -10], [60, 40, 10], size=(30, 3))
+    points = (centres[rng.randint(len(centres), size=count)]
+              + rng.normal(scale=3, size=(count, 3)))
+    overlap = count // 10
+    source = points[:count - overlap]
+    target = (points[overlap:] @ TEST_MATRIX[:3, :3].T + TEST_MATRIX[:3, 3]
+              + rng.normal(scale=noise, size=(count - overlap, 3)))
+    return source, target
+
+
+@pytest.mark.parametrize('method', ['kdtree', 'voxel-hash'])
+def test_index_query(method):
+    if method == 'kdtree':
+        pytest.importorskip('scipy')
+    rng = numpy.random.RandomState(0)
+    points = rng.uniform(-10, 10, size=(2000, 3))
+    queries = rng.uniform(-11, 11, size=(500, 3))
+    index = icp.make_index(points, method=method, max_distance=1.5)
+    distances, indices = index.query(queries, max_distance=1.5, workers=2)
+    all_distances = numpy.linalg.norm(queries[:, numpy.newaxis] - points,
+                                      axis=2)
+    expected = all_distances.min(axis=1)
+    if method == 'voxel-hash':
+        limit = min(1.5, index.cell_size)
+    else:
+        limit = 1.5
+    matched = expected <= limit
+    assert numpy.array_equal(numpy.isfinite(distances), matched)
+    assert numpy.allclose(distances[matched], expected[matched])
+    assert numpy.array_equal(indices[matched],
+                             all_distances[matched].argmin(axis=1))
+    assert numpy.all(indices[~matched] == len(points))
+
+
+def test_voxel_hash_batches(monkeypatch):
+    monkeypatch.setattr(icp, 'QUERY_BATCH_SIZE', 7)
+    points = numpy.random.RandomState(0).uniform(0, 5, size=(200, 3))
+    index = icp.VoxelHashIndex(points, cell_size=1.0)
+    distances, indices = index.query(points[:50], workers=3)
+    assert numpy.all(distances == 0)
+    assert numpy.array_equal(indices, numpy.arange(50))
+    distances, indices = index.query(numpy.zeros((0, 3)))
+    assert distances.shape == indices.shape == (0,)
+
+
+@pytest.mark.parametrize('method', ['auto', 'voxel-hash'])
+@pytest.mark.parametrize('transformation_type', ['rigid', 'affine'])
+def test_icp(method, transformation_type):
+    source, target = make_clouds()
+    result = icp.icp(source, target, transformation_type, index=method,
+                     levels=(300, None))
+    assert result.converged
+    assert numpy.allclose(result.transformation_matrix, TEST_MATRIX,
+                          atol=1e-2)
+    assert numpy.allclose(result.inverse_matrix @ TEST_MATRIX, numpy.eye(4),
+                          atol=1e-2)
+    assert result.rmse < 0.1
+    assert result.inlier_count == pytest.approx(0.9 * len(source), abs=1)
+
+
+def test_icp_initial_matrix():
+    source, target = make_clouds()
+    # A large translation is recovered from a rough initial matrix
+    target += [50, 0, 0]
+    initial = numpy.eye(4)
+    initial[:3, 3] = TEST_MATRIX[:3, 3] + [49, 0.5, 0]
+    result = icp.icp(source, target, 'rigid', initial_matrix=initial,
+                     max_distance=5)
+    expected = TEST_MATRIX.copy()
+    expected[0, 3] += 50
+    assert numpy.allclose(result.transformation_matrix, expected, atol=1e-2)
+
+
+def test_icp_errors():
+    source, target = make_clouds(count=100)
+    with pytest.raises(leastsquares.UnderdeterminedProblem):
+        icp.icp(source[:2], target, 'rigid')
+    with pytest.raises(leastsquares.UnderdeterminedProblem):
+        icp.icp(source, target + 1000, 'rigid', max_distance=1)
+    with pytest.raises(ValueError):
+        icp.icp(source, target, 'projective')
+    with pytest.raises(ValueError):
+        icp.icp(source, target, 'rigid', max_iterations=0)
+    with pytest.raises(ValueError):
+        icp.make_index(target, method='octree')
+
+
+def test_main(tmp_path, capsys):
+    source, target = make_clouds(count=1000)
+    numpy.save(str(tmp_path / 'source.npy'), source)
+    numpy.save(str(tmp_path / 'target.npy'), target)
+    assert icp.main([str(tmp_path / 'source.npy'),
+                     str(tmp_path / 'target.npy'), 'rigid',
+                     '--workers', '1']) == 0
+    result = json.loads(capsys.readouterr().out)
+    assert numpy.allclose(result['transformation_matrix'], TEST_MATRIX,
+                          atol=1e-2)
+    assert icp.main([str(tmp_path / 'source.npy'),
+                     str(tmp_path / 'target.npy'), 'rigid',
+                     '--max-distance', '1e-9']) == 1
+
+
+def test_icp_endpoint(client, app):
+    source, target = make_clouds(count=500)
+    request = {
+        'transformation_type': 'rigid',
+        'source_points': source.tolist(),
+        'target_points': target.tolist(),
+    }
+    response = client.post('/api/icp', json=request)
+    assert response.status_code == 200
+    assert numpy.allclose(response.json['transformation_matrix'],
+                          TEST_MATRIX, atol=1e-2)
+    assert response.json['converged'] is True
+    request['initial_matrix'] = TEST_MATRIX.tolist()
+    request['max_distance'] = 1e-9
+    assert client.post('/api/icp', json=request).status_code == 400
+    request['trim_fraction'] = 1
+    assert client.post('/api/icp', json=request).status_code == 422
+    app.config['ICP_MAX_POINTS'] = 100
+    del request['trim_fraction']
+    assert client.post('/api/icp', json=request).status_code == 413
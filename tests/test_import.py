@@ -0,0 +1,96 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Check what is loaded at import time, and report the import times.
+
+The tests run ``python -X importtime`` in a subprocess, the slowest imports
+are printed (visible with ``pytest -s``) and recorded as test properties
+(visible in the JUnit XML report).
+"""
+
+import os.path
+import subprocess
+import sys
+
+import pytest
+
+import linear_voluba
+
+
+WEB_PACKAGES = {'flask', 'flask_cors', 'flask_smorest', 'werkzeug',
+                'marshmallow', 'apispec', 'webargs', 'jinja2'}
+
+# Modules that are not available on all platforms (fcntl is POSIX-only)
+NON_PORTABLE_MODULES = {'fcntl'}
+
+
+def import_times(statement):
+    """Run statement in a new interpreter, return the import times in µs.
+
+    The result is a dictionary of module name => (self, cumulative).
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        cwd=os.path.dirname(os.path.dirname(linear_voluba.__file__)),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue  # header line
+        times[fields[2].strip()] = (self_us, cumulative_us)
+    return times
+
+
+def report(record_property, statement, times, top=10):
+    slowest = sorted(times.items(), key=lambda item: item[1][1],
+                     reverse=True)[:top]
+    print('\nSlowest imports for {0!r} (cumulative µs):'.format(statement))
+    for module_name, (_, cumulative_us) in slowest:
+        print('{0:>10}  {1}'.format(cumulative_us, module_name))
+    record_property('import_times_us', {
+        module_name: cumulative_us
+        for module_name, (_, cumulative_us) in slowest
+    })
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='-X importtime requires Python 3.7')
+@pytest.mark.parametrize('statement', [
+    'import linear_voluba',
+    'import linear_voluba.leastsquares',
+])
+def test_solver_import_is_flask_free(record_property, statement):
+    times = import_times(statement)
+    report(record_property, statement, times)
+    loaded_web_packages = {module_name.split('.')[0] for module_name in times}
+    assert not loaded_web_packages & WEB_PACKAGES
+    assert not set(times) & NON_PORTABLE_MODULES
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='-X importtime requires Python 3.7')
+def test_app_import_time(record_property):
+    statement = 'import linear_voluba.wsgi'
+    times = import_times(statement)
+    report(record_property, statement, times)
+    assert 'flask' in times
@@ -297,3 +297,166 @@ def test_overconstrained_affine_in_source_space():
         OVERCONSTRAINED_SOURCE_POINTS,
         OVERCONSTRAINED_TARGET_POINTS,
     )
+
+
+@pytest.mark.parametrize(['transformation_type', 'test_matrix'], [
+    ('rigid', TEST_RIGID_MATRIX),
+    ('rigid+reflection', TEST_RIGID_AND_MIRROR_MATRIX),
+    ('similarity', TEST_SIMILARITY_MATRIX),
+    ('similarity+reflection', TEST_SIMILARITY_AND_MIRROR_MATRIX),
+    ('affine', TEST_AFFINE_MATRIX),
+])
+def test_estimate(transformation_type, test_matrix):
+    transformed_points = apply_transform_to_points(test_matrix, SOURCE_POINTS)
+    estimated_matrix = leastsquares.estimate(
+        transformation_type, SOURCE_POINTS, transformed_points)
+    assert numpy.allclose(test_matrix, estimated_matrix)
+
+
+def test_estimate_invalid_type():
+    with pytest.raises(ValueError):
+        leastsquares.estimate('projective', SOURCE_POINTS, SOURCE_POINTS)
+
+
+def test_warm_up():
+    leastsquares.warm_up()
+
+
+@pytest.mark.parametrize('transformation_type',
+                         leastsquares.TRANSFORMATION_TYPES)
+def test_estimate_from_moments(transformation_type):
+    rng = numpy.random.RandomState(0)
+    src = rng.uniform(-50, 50, size=(20, 3)) + 1000
+    dst = (apply_transform_to_points(TEST_AFFINE_MATRIX, src)
+           + rng.normal(size=src.shape))
+    moments = leastsquares.LandmarkMoments.from_points(src[:5], dst[:5])
+    moments.add(src[5:], dst[5:])
+    moments.add(src[:3] + 7, dst[:3])
+    moments.remove(src[:3] + 7, dst[:3])
+    assert moments.count == 20
+    assert numpy.allclose(
+        leastsquares.estimate_from_moments(transformation_type, moments),
+        leastsquares.estimate(transformation_type, src, dst),
+        rtol=0, atol=1e-9,
+    )
+
+
+@pytest.mark.parametrize('transformation_type',
+                         leastsquares.TRANSFORMATION_TYPES)
+@pytest.mark.parametrize('point_count', [0, 1, 2, 3])
+def test_estimate_from_moments_underdetermined(transformation_type,
+                                               point_count):
+    src = SOURCE_POINTS[:point_count]
+    moments = leastsquares.LandmarkMoments.from_points(src, src)
+    try:
+        leastsquares.estimate(transformation_type, src, src)
+    except leastsquares.UnderdeterminedProblem as exc:
+        with pytest.raises(leastsquares.UnderdeterminedProblem) as excinfo:
+            leastsquares.estimate_from_moments(transformation_type, moments)
+        assert str(excinfo.value) == str(exc)
+    else:
+        leastsquares.estimate_from_moments(transformation_type, moments)
+
+
+@pytest.mark.parametrize('transformation_type',
+                         leastsquares.TRANSFORMATION_TYPES)
+def test_estimate_many(transformation_type):
+    rng = numpy.random.RandomState(0)
+    src = rng.uniform(-50, 50, size=(20, 3))
+    dsts = numpy.stack([
+        apply_transform_to_points(TEST_AFFINE_MATRIX * scale, src)
+        + rng.normal(size=src.shape)
+        for scale in (0.5, 1, 2)
+    ])
+    matrices = leastsquares.estimate_many(transformation_type, src, dsts)
+    assert matrices.shape == (3, 4, 4)
+    for mat, dst in zip(matrices, dsts):
+        assert numpy.allclose(
+            mat, leastsquares.estimate(transformation_type, src, dst),
+            rtol=0, atol=1e-9)
+
+
+def test_estimate_many_underdetermined():
+    dsts = numpy.stack([TRANSFORMED_COPLANAR_POINTS] * 2)
+    for transformation_type in ('affine', 'rigid+reflection'):
+        with pytest.raises(leastsquares.UnderdeterminedProblem):
+            leastsquares.estimate_many(transformation_type,
+                                       COPLANAR_POINTS, dsts)
+    with pytest.raises(ValueError):
+        leastsquares.estimate_many('affine', SOURCE_POINTS, SOURCE_POINTS)
+
+
+def test_hash_key():
+    points = numpy.array([[0.0, 1.0, 2.0]])
+    key = leastsquares.hash_key('rigid', points, points)
+    assert key == leastsquares.hash_key('rigid', points.tolist(), points)
+    assert key == leastsquares.hash_key('rigid', -0.0 * points + points,
+                                        points)
+    assert key != leastsquares.hash_key('affine', points, points)
+    assert key != leastsquares.hash_key('rigid', points.T, points)
+    assert key != leastsquares.hash_key('rigid', points, points + 1e-15)
+
+
+def test_source_factorization_cache():
+    cache = leastsquares.SourceFactorizationCache(max_bytes=10000)
+    src = SOURCE_POINTS.copy()
+    factorization = cache.get(src)
+    dst = apply_transform_to_points(TEST_AFFINE_MATRIX, src)
+    assert numpy.allclose(factorization.affine(dst), TEST_AFFINE_MATRIX)
+    # Modifying the points of the caller does not affect the cache
+    src[0] = 42
+    assert cache.get(SOURCE_POINTS) is factorization
+    assert cache.get(src) is not factorization
+    assert (cache.hits, cache.misses) == (1, 2)
+    # The least recently used entries are evicted to stay within budget
+    for i in range(100):
+        cache.get(SOURCE_POINTS + i)
+    assert cache._bytes <= cache.max_bytes
+    assert cache.get(SOURCE_POINTS) is not factorization
+    # Sources that are too large are not cached
+    large = numpy.zeros((1000, 3))
+    assert cache.get(large) is not cache.get(large)
+    cache.clear()
+    assert len(cache) == 0
+
+
+@pytest.mark.parametrize('dim', [2, 3])
+@pytest.mark.parametrize('transformation_type',
+                         leastsquares.TRANSFORMATION_TYPES)
+def test_estimate_grouped(transformation_type, dim):
+    rng = numpy.random.RandomState(0)
+    counts = rng.randint(dim + 2, 10, size=20)
+    groups = numpy.repeat(numpy.arange(len(counts)), counts)
+    rng.shuffle(groups)
+    src = rng.uniform(-50, 50, size=(len(groups), dim))
+    dst = (src @ rng.normal(size=(dim, dim)) + 100
+           + rng.normal(size=src.shape))
+    matrices = leastsquares.estimate_grouped(transformation_type,
+                                             src, dst, groups)
+    assert matrices.shape == (len(counts), dim + 1, dim + 1)
+    for k, mat in enumerate(matrices):
+        assert numpy.allclose(
+            mat, leastsquares.estimate(transformation_type,
+                                       src[groups == k], dst[groups == k]),
+            rtol=0, atol=1e-9)
+
+
+def test_estimate_grouped_underdetermined():
+    src = numpy.array([[0, 0], [1, 0], [0, 1], [0, 0], [1, 1]], dtype=float)
+    dst = src + 1
+    assert leastsquares.estimate_grouped('rigid', src, dst,
+                                         [0, 0, 0, 1, 1]).shape == (2, 3, 3)
+    with pytest.raises(leastsquares.UnderdeterminedProblem,
+                       match='^problem 1: .*missing 1 point'):
+        leastsquares.estimate_grouped('affine', src, dst, [0, 0, 0, 1, 1])
+    with pytest.raises(leastsquares.UnderdeterminedProblem,
+                       match='^problem 2: '):
+        leastsquares.estimate_grouped('rigid', src, dst, [0, 0, 0, 1, 1],
+                                      group_count=3)
+    with pytest.raises(ValueError):
+        leastsquares.estimate_grouped('rigid', src, dst, [0, 0, 0, 1])
+    with pytest.raises(ValueError):
+        leastsquares.estimate_grouped('rigid', src, dst, [0, 0, 0, 1, 2],
+                                      group_count=2)
+    with pytest.raises(ValueError):
+        leastsquares.estimate_grouped('shear', src, dst, [0, 0, 0, 1, 1])
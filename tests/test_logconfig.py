@@ -0,0 +1,118 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import json
+import logging
+
+import pytest
+
+from linear_voluba import logconfig
+
+
+def make_access_record(**args):
+    record_args = {
+        'h': '10.0.0.1',
+        'm': 'GET',
+        'U': '/health',
+        'a': 'kube-probe/1.18',
+    }
+    record_args.update(args)
+    record = logging.LogRecord('gunicorn.access', logging.INFO, __file__, 0,
+                               'access', None, None)
+    # LogRecord unwraps a single dict argument, as Gunicorn relies upon
+    record.args = record_args
+    return record
+
+
+@pytest.mark.parametrize(['args', 'expected'], [
+    ({}, False),
+    ({'U': '/health/ready'}, False),
+    ({'U': '/api/least-squares'}, True),
+    ({'m': 'POST'}, True),
+    ({'h': '192.168.0.1'}, True),
+    ({'a': 'Mozilla/5.0'}, True),
+])
+def test_health_probe_filter(args, expected):
+    record_filter = logconfig.HealthProbeFilter()
+    assert record_filter.filter(make_access_record(**args)) is expected
+
+
+def test_health_probe_filter_other_records():
+    record = logging.LogRecord('gunicorn.access', logging.INFO, __file__, 0,
+                               'message %s', ('arg',), None)
+    assert logconfig.HealthProbeFilter().filter(record)
+
+
+def test_json_formatter():
+    record = logging.LogRecord('linear_voluba', logging.WARNING, __file__, 0,
+                               'message %s', ('arg',), None)
+    entry = json.loads(logconfig.JSONFormatter().format(record))
+    assert entry['message'] == 'message arg'
+    assert entry['level'] == 'WARNING'
+    assert entry['logger'] == 'linear_voluba'
+
+
+def test_per_module_levels():
+    root_logger = logging.getLogger()
+    saved_handlers, saved_level = root_logger.handlers[:], root_logger.level
+    try:
+        logconfig.configure_logging({
+            'LOG_LEVEL': 'WARNING',
+            'LOG_LEVELS': {'linear_voluba.test': 'DEBUG'},
+        })
+        assert root_logger.level == logging.WARNING
+        assert logging.getLogger('linear_voluba.test').isEnabledFor(
+            logging.DEBUG)
+        assert not logging.getLogger('linear_voluba.other').isEnabledFor(
+            logging.INFO)
+    finally:
+        root_logger.handlers = saved_handlers
+        root_logger.setLevel(saved_level)
+        logging.getLogger('linear_voluba.test').setLevel(logging.NOTSET)
+
+
+LANDMARK_PAIRS = [
+    {'source_point': [0, 0, 0], 'target_point': [10, 10, 10],
+     'name': 'x' * 1000},
+    {'source_point': [1, 0, 0], 'target_point': [8, 10, 10]},
+    {'source_point': [0, 1, 0], 'target_point': [10, 12, 10]},
+    {'source_point': [0, 0, -1], 'target_point': [10, 10, 12]},
+]
+
+
+def post_with_config(caplog, **config):
+    from linear_voluba import create_app
+    config['TESTING'] = True
+    app = create_app(config)
+    caplog.set_level(logging.DEBUG)
+    with app.test_client() as client:
+        response = client.post('/api/least-squares', json={
+            'transformation_type': 'affine',
+            'landmark_pairs': LANDMARK_PAIRS,
+        })
+    assert response.status_code == 200
+
+
+def test_debug_payload_truncated(caplog):
+    post_with_config(caplog, DEBUG_PAYLOAD_MAX_BYTES=100)
+    assert 'Received request' in caplog.text
+    assert 'bytes truncated' in caplog.text
+    assert 'x' * 200 not in caplog.text
+
+
+def test_debug_payload_sampling(caplog):
+    post_with_config(caplog, DEBUG_PAYLOAD_SAMPLE_RATE=0.0)
+    assert 'Received request' not in caplog.text
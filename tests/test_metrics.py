@@ -0,0 +1,90 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import pytest
+
+from linear_voluba.metrics import landmark_count_bucket
+
+
+pytest.importorskip('prometheus_client')
+
+
+LANDMARK_PAIRS = [
+    {'source_point': [0, 0, 0], 'target_point': [10, 10, 10]},
+    {'source_point': [1, 0, 0], 'target_point': [8, 10, 10]},
+    {'source_point': [0, 1, 0], 'target_point': [10, 12, 10]},
+    {'source_point': [0, 0, -1], 'target_point': [10, 10, 12]},
+]
+
+
+@pytest.fixture
+def metrics_client():
+    from linear_voluba import create_app
+    app = create_app({'TESTING': True, 'ENABLE_METRICS': True})
+    return app.test_client()
+
+
+def test_metrics_disabled_by_default(client):
+    response = client.get('/metrics')
+    assert response.status_code == 404
+
+
+def test_landmark_count_bucket():
+    assert landmark_count_bucket(0) == '<10'
+    assert landmark_count_bucket(9) == '<10'
+    assert landmark_count_bucket(10) == '<100'
+    assert landmark_count_bucket(9999) == '<10000'
+    assert landmark_count_bucket(10000) == '>=10000'
+
+
+def test_stage_histograms(metrics_client):
+    response = metrics_client.post('/api/least-squares', json={
+        'transformation_type': 'affine',
+        'landmark_pairs': LANDMARK_PAIRS,
+    })
+    assert response.status_code == 200
+    response = metrics_client.get('/metrics')
+    assert response.status_code == 200
+    text = response.get_data(as_text=True)
+    for stage in ['validate', 'solve', 'invert', 'mismatch', 'serialize']:
+        assert ('voluba_stage_duration_seconds_count{{'
+                'endpoint="/api/least-squares",landmarks="<10",'
+                'stage="{0}",transformation_type="affine"}} 1.0'
+                .format(stage)) in text
+    assert ('voluba_requests_total{endpoint="/api/least-squares",'
+            'method="POST",status="200"} 1.0') in text
+
+
+def test_error_counts(metrics_client):
+    response = metrics_client.post('/api/least-squares', json={
+        'transformation_type': 'rigid',
+        'landmark_pairs': LANDMARK_PAIRS[:2],
+    })
+    assert response.status_code == 400
+    response = metrics_client.post('/api/least-squares', json={
+        'transformation_type': 'invalid',
+        'landmark_pairs': LANDMARK_PAIRS,
+    })
+    assert response.status_code == 422
+    text = metrics_client.get('/metrics').get_data(as_text=True)
+    assert ('voluba_request_errors_total{endpoint="/api/least-squares",'
+            'status="400",transformation_type="rigid"} 1.0') in text
+    assert ('voluba_request_errors_total{endpoint="/api/least-squares",'
+            'status="422",transformation_type=""} 1.0') in text
+    # Failed requests do not pollute the latency histograms
+    assert 'stage="validate"' not in text
+    assert 'voluba_request_duration_seconds_count{' not in text
+    assert 'voluba_stage_duration_seconds_count{' not in text
@@ -0,0 +1,120 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import json
+import os
+import pstats
+
+from linear_voluba import profiling
+
+
+LANDMARK_PAIRS = [
+    {'source_point': [0, 0, 0], 'target_point': [10, 10, 10]},
+    {'source_point': [1, 0, 0], 'target_point': [8, 10, 10]},
+    {'source_point': [0, 1, 0], 'target_point': [10, 12, 10]},
+    {'source_point': [0, 0, -1], 'target_point': [10, 10, 12]},
+]
+
+
+def make_client(tmp_path, **config):
+    from linear_voluba import create_app
+    config['TESTING'] = True
+    app = create_app(config)
+    app.instance_path = str(tmp_path)
+    return app.test_client()
+
+
+def post(client, **kwargs):
+    return client.post('/api/least-squares', json={
+        'transformation_type': 'affine',
+        'landmark_pairs': LANDMARK_PAIRS,
+    }, **kwargs)
+
+
+def profile_files(tmp_path):
+    profile_dir = tmp_path / 'profiles'
+    if not profile_dir.exists():
+        return []
+    return sorted(os.listdir(str(profile_dir)))
+
+
+def test_token():
+    token = profiling.make_token('secret')
+    assert profiling.verify_token('secret', token)
+    assert not profiling.verify_token('other secret', token)
+    assert not profiling.verify_token('secret', 'garbage')
+    assert not profiling.verify_token(
+        'secret', profiling.make_token('secret', lifetime=-10))
+
+
+def test_profiling_disabled(tmp_path):
+    client = make_client(tmp_path)
+    response = post(client, headers={'X-Voluba-Profile': '1'})
+    assert response.status_code == 200
+    assert profile_files(tmp_path) == []
+
+
+def test_profiling_signed_header(tmp_path):
+    client = make_client(tmp_path, PROFILING_SECRET='secret')
+    post(client, headers={'X-Voluba-Profile': 'invalid'})
+    assert profile_files(tmp_path) == []
+
+    response = post(client, headers={
+        'X-Voluba-Profile': profiling.make_token('secret'),
+    })
+    assert response.status_code == 200
+    files = profile_files(tmp_path)
+    assert len(files) == 2
+    json_file, prof_file = files
+    with open(str(tmp_path / 'profiles' / json_file)) as f:
+        shape = json.load(f)
+    assert shape['landmark_count'] == 4
+    assert shape['transformation_type'] == 'affine'
+    assert shape['trigger'] == 'token'
+    assert 'landmark_pairs' not in shape
+    stats = pstats.Stats(str(tmp_path / 'profiles' / prof_file))
+    assert any(func[2] == 'affine' for func in stats.stats)
+
+
+def test_profiling_allow_list(tmp_path):
+    client = make_client(tmp_path, PROFILING_ALLOWED_ADDRESSES=['127.0.0.1'])
+    post(client)
+    assert profile_files(tmp_path) == []
+    post(client, headers={'X-Voluba-Profile': '1'})
+    assert len(profile_files(tmp_path)) == 2
+
+
+def test_profiling_sampled(tmp_path):
+    client = make_client(tmp_path, PROFILING_SAMPLE_RATE=1.0)
+    post(client)
+    post(client)
+    assert len(profile_files(tmp_path)) == 4
+
+
+def test_profiling_max_files(tmp_path):
+    client = make_client(tmp_path, PROFILING_SAMPLE_RATE=1.0,
+                         PROFILING_MAX_FILES=2)
+    for i in range(3):
+        post(client)
+        files = profile_files(tmp_path)
+        if i == 0:
+            first = files
+    files = profile_files(tmp_path)
+    assert len(files) == 4
+    assert not set(first) & set(files)
+    assert sorted(os.path.splitext(name)[0] for name in files) == sorted(
+        2 * [os.path.splitext(name)[0] for name in files
+             if name.endswith('.prof')])
@@ -0,0 +1,286 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import json
+import os
+import time
+
+import numpy
+import pytest
+
+import linear_voluba
+from linear_voluba import resample
+
+
+TEST_MATRIX = numpy.array([
+    [0.9, 0.1, 0.0, 2.0],
+    [-0.1, 1.1, 0.05, -3.0],
+    [0.0, 0.2, 0.95, 1.0],
+    [0.0, 0.0, 0.0, 1.0],
+])
+
+
+@pytest.fixture
+def source_volume(tmp_path):
+    data = numpy.random.RandomState(0).rand(30, 20, 25).astype(numpy.float32)
+    path = str(tmp_path / 'source.npy')
+    numpy.save(path, data)
+    return data, resample.open_volume(path)
+
+
+def test_nifti_header_round_trip(tmp_path):
+    path = str(tmp_path / 'volume.nii')
+    affine = numpy.array([[0, -2, 0, 10], [1, 0, 0, -5], [0, 0, 3, 1],
+                          [0, 0, 0, 1]], dtype=float)
+    volume = resample.write_nifti_header(path, (4, 5, 6), numpy.int16,
+                                         affine)
+    data = volume.open('r+')
+    data[...] = numpy.arange(120).reshape(4, 5, 6)
+    data.flush()
+    del data
+    assert os.path.getsize(path) == 352 + 120 * 2
+
+    volume = resample.open_volume(path)
+    assert volume.shape == (4, 5, 6)
+    assert volume.dtype == numpy.int16
+    assert volume.scaling is None
+    assert numpy.array_equal(volume.affine, affine)
+    assert numpy.array_equal(volume.open(),
+                             numpy.arange(120).reshape(4, 5, 6))
+
+
+def test_open_volume_errors(tmp_path):
+    with pytest.raises(ValueError, match='decompress'):
+        resample.open_volume(str(tmp_path / 'volume.nii.gz'))
+    with pytest.raises(ValueError, match='shape and data type'):
+        resample.open_volume(str(tmp_path / 'volume.raw'))
+    path = tmp_path / 'invalid.nii'
+    path.write_bytes(b'\0' * 400)
+    with pytest.raises(ValueError, match='not a NIfTI-1 file'):
+        resample.open_volume(str(path))
+
+
+def test_make_bricks():
+    bricks = resample.make_bricks((5, 3, 2), brick_size=2)
+    assert len(bricks) == 3 * 2 * 1
+    assert bricks[0] == ((0, 0, 0), (2, 2, 2))
+    assert bricks[-1] == ((4, 2, 0), (5, 3, 2))
+
+
+@pytest.mark.parametrize('interpolation', resample.INTERPOLATIONS)
+@pytest.mark.parametrize('output_name', ['output.npy', 'output.nii'])
+def test_resample_identity(tmp_path, source_volume, interpolation,
+                           output_name):
+    data, source = source_volume
+    output = resample.resample(source, str(tmp_path / output_name),
+                               numpy.eye(4), data.shape, numpy.eye(4),
+                               interpolation=interpolation, workers=1,
+                               brick_size=8)
+    assert output.dtype == numpy.float32
+    assert numpy.array_equal(
+        resample.open_volume(str(tmp_path / output_name)).open(), data)
+
+
+def test_resample_translation(tmp_path, source_volume):
+    data, source = source_volume
+    matrix = numpy.eye(4)
+    matrix[0, 3] = 0.5
+    path = str(tmp_path / 'output.npy')
+    resample.resample(source, path, matrix, data.shape, numpy.eye(4),
+                      workers=1, fill_value=-1)
+    result = numpy.load(path)
+    assert numpy.allclose(result[1:], (data[:-1] + data[1:]) / 2)
+    assert numpy.all(result[0] == -1)
+
+
+def test_resample_against_scipy(tmp_path, source_volume):
+    ndimage = pytest.importorskip('scipy.ndimage')
+    data, source = source_volume
+    path = str(tmp_path / 'output.npy')
+    resample.resample(source, path, TEST_MATRIX, (25, 25, 25), numpy.eye(4),
+                      workers=1, brick_size=8)
+    expected = ndimage.affine_transform(
+        data.astype(float),
+        resample.voxel_mapping(TEST_MATRIX, numpy.eye(4), numpy.eye(4)),
+        order=1, output_shape=(25, 25, 25), cval=numpy.nan)
+    inside = numpy.isfinite(expected)
+    assert numpy.allclose(numpy.load(path)[inside], expected[inside],
+                          atol=1e-6)
+
+
+def test_resample_parallel_and_split_bricks(tmp_path, source_volume):
+    data, source = source_volume
+    reference = str(tmp_path / 'reference.npy')
+    resample.resample(source, reference, TEST_MATRIX, (25, 25, 25),
+                      numpy.eye(4), workers=1)
+    parallel = str(tmp_path / 'parallel.npy')
+    resample.resample(source, parallel, TEST_MATRIX, (25, 25, 25),
+                      numpy.eye(4), workers=2, brick_size=10)
+    assert numpy.array_equal(numpy.load(parallel), numpy.load(reference))
+
+    split = str(tmp_path / 'split.npy')
+    output = resample.create_volume(split, (25, 25, 25), numpy.float32,
+                                    numpy.eye(4))
+    mapping = resample.voxel_mapping(TEST_MATRIX, numpy.eye(4),
+                                     numpy.eye(4))
+    resample.resample_brick(source, output, mapping, (0, 0, 0), (25, 25, 25),
+                            max_block_voxels=100)
+    assert numpy.array_equal(numpy.load(split), numpy.load(reference))
+
+
+def test_resample_raw_and_integers(tmp_path):
+    data = numpy.arange(4 * 5 * 6, dtype=numpy.uint16).reshape(4, 5, 6)
+    path = str(tmp_path / 'source.raw')
+    with open(path, 'wb') as f:
+        f.write(b'header')
+        f.write(data.tobytes(order='F'))
+    source = resample.open_volume(path, raw_shape=(4, 5, 6),
+                                  raw_dtype='uint16', raw_offset=6,
+                                  raw_order='F')
+    output_path = str(tmp_path / 'output.npy')
+    output = resample.resample(source, output_path, numpy.eye(4),
+                               data.shape, numpy.eye(4),
+                               interpolation='nearest', workers=1)
+    assert output.dtype == numpy.uint16
+    assert numpy.array_equal(numpy.load(output_path), data)
+    assert resample.default_dtype(source, 'linear') == numpy.float32
+
+
+def test_resolve_data_path(tmp_path):
+    root = str(tmp_path)
+    assert resample.resolve_data_path(root, 'a/b.nii') == \
+        os.path.join(os.path.realpath(root), 'a', 'b.nii')
+    with pytest.raises(ValueError):
+        resample.resolve_data_path(root, '../b.nii')
+    with pytest.raises(ValueError):
+        resample.resolve_data_path(root, '/etc/passwd')
+
+
+def test_command_line(tmp_path, source_volume):
+    data, source = source_volume
+    matrix_path = tmp_path / 'response.json'
+    matrix_path.write_text(json.dumps({
+        'transformation_matrix': TEST_MATRIX.tolist(),
+    }))
+    output = str(tmp_path / 'output.nii')
+    assert resample.main([source.path, output, '--matrix', str(matrix_path),
+                          '--shape', '10', '11', '12', '--workers', '1']) == 0
+    assert resample.open_volume(output).shape == (10, 11, 12)
+    second_output = str(tmp_path / 'second.npy')
+    assert resample.main([source.path, second_output,
+                          '--matrix', str(matrix_path),
+                          '--reference', output,
+                          '--interpolation', 'nearest']) == 0
+    assert numpy.load(second_output).shape == (10, 11, 12)
+
+
+def test_resample_output_is_atomic(tmp_path, source_volume, monkeypatch):
+    data, source = source_volume
+    output_path = str(tmp_path / 'output.nii')
+    with open(output_path, 'wb') as f:
+        f.write(b'existing')
+    with pytest.raises(FileExistsError):
+        resample.resample(source, output_path, numpy.eye(4), data.shape,
+                          source.affine, workers=1, overwrite=False)
+    # The output is replaced by default
+    resample.resample(source, output_path, numpy.eye(4), data.shape,
+                      source.affine, workers=1)
+    assert numpy.array_equal(resample.open_volume(output_path).open(), data)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('interrupted')
+    monkeypatch.setattr(resample, 'resample_brick', fail)
+    with pytest.raises(RuntimeError):
+        resample.resample(source, str(tmp_path / 'failed.nii'), numpy.eye(4),
+                          data.shape, source.affine, workers=1)
+    # No partial file is left behind
+    assert sorted(os.listdir(str(tmp_path))) == ['output.nii', 'source.npy']
+
+
+def wait_for_job(client, location, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get(location)
+        assert response.status_code == 200
+        if response.json['status'] != 'running':
+            return response
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_resample_endpoint(tmp_path, source_volume):
+    data, source = source_volume
+    request = {
+        'source_image': 'source.npy',
+        'target_image': 'source.npy',
+        'output_image': 'output.nii',
+        'transformation_matrix': numpy.eye(4).tolist(),
+    }
+    client = linear_voluba.create_app({'TESTING': True}).test_client()
+    response = client.post('/api/resample', json=request)
+    assert response.status_code == 404
+
+    client = linear_voluba.create_app({
+        'TESTING': True,
+        'RESAMPLE_DATA_DIRECTORY': str(tmp_path),
+        'RESAMPLE_JOB_DIRECTORY': str(tmp_path / 'jobs'),
+    }).test_client()
+    response = client.post('/api/resample', json=request)
+    assert response.status_code == 202
+    assert response.json['status'] == 'running'
+    assert response.json['output_image'] == 'output.nii'
+    location = response.headers['Location']
+    assert location.endswith('/api/resample/' + response.json['job_id'])
+    response = wait_for_job(client, location)
+    assert response.json['status'] == 'done'
+    assert response.json['shape'] == list(data.shape)
+    assert response.json['dtype'] == 'float32'
+    assert numpy.array_equal(
+        resample.open_volume(str(tmp_path / 'output.nii')).open(), data)
+
+    # The output must not exist
+    response = client.post('/api/resample', json=request)
+    assert response.status_code == 422
+    response = client.post('/api/resample', json=dict(
+        request, output_image='../output.nii'))
+    assert response.status_code == 422
+    response = client.post('/api/resample', json=dict(
+        request, source_image='missing.nii', output_image='other.nii'))
+    assert response.status_code == 422
+    assert client.get('/api/resample/' + 32 * '0').status_code == 404
+    assert client.get('/api/resample/invalid').status_code == 404
+
+
+def test_resample_endpoint_limits(tmp_path, source_volume):
+    request = {
+        'source_image': 'source.npy',
+        'target_image': 'source.npy',
+        'output_image': 'output.nii',
+        'transformation_matrix': numpy.eye(4).tolist(),
+    }
+    app = linear_voluba.create_app({
+        'TESTING': True,
+        'RESAMPLE_DATA_DIRECTORY': str(tmp_path),
+        'RESAMPLE_JOB_DIRECTORY': str(tmp_path / 'jobs'),
+        'RESAMPLE_MAX_VOXELS': 1000,
+    })
+    response = app.test_client().post('/api/resample', json=request)
+    assert response.status_code == 413
+    app.config['RESAMPLE_MAX_VOXELS'] = 10 ** 9
+    app.config['RESAMPLE_MAX_RUNNING_JOBS'] = 0
+    response = app.test_client().post('/api/resample', json=request)
+    assert response.status_code == 503
+    assert not os.path.exists(str(tmp_path / 'output.nii'))
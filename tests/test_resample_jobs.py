@@ -0,0 +1,115 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import os
+import threading
+import time
+
+import numpy
+import pytest
+
+from linear_voluba import resample_jobs
+from linear_voluba import singleflight
+
+
+def make_request(tmp_path, output_image='output.npy'):
+    data = numpy.arange(24, dtype=numpy.float32).reshape(2, 3, 4)
+    source_path = str(tmp_path / 'source.npy')
+    numpy.save(source_path, data)
+    return {
+        'source_path': source_path,
+        'target_path': source_path,
+        'output_path': str(tmp_path / output_image),
+        'output_image': output_image,
+        'transformation_matrix': numpy.eye(4).tolist(),
+        'interpolation': 'linear',
+        'workers': 1,
+    }
+
+
+def test_run_job(tmp_path):
+    store = resample_jobs.JobStore(str(tmp_path / 'jobs'), ttl=60)
+    job = {'job_id': 32 * 'a', 'status': resample_jobs.RUNNING,
+           'request': make_request(tmp_path)}
+    path = store._path(job['job_id'])
+    resample_jobs._write_record(path, job)
+    resample_jobs.run_job(path)
+    job = store.get(job['job_id'])
+    assert job['status'] == resample_jobs.DONE
+    assert job['shape'] == [2, 3, 4]
+    assert numpy.array_equal(numpy.load(str(tmp_path / 'output.npy')),
+                             numpy.load(str(tmp_path / 'source.npy')))
+
+    # The output created by another job is never replaced
+    resample_jobs.run_job(path)
+    job = store.get(job['job_id'])
+    assert job['status'] == resample_jobs.FAILED
+    assert job['message'] == 'output.npy already exists'
+
+
+def test_interrupted_job(tmp_path):
+    now = [1000.0]
+    store = resample_jobs.JobStore(str(tmp_path / 'jobs'), ttl=60,
+                                   clock=lambda: now[0])
+    job_id = 32 * 'b'
+    with open(store._path(job_id, '.lock'), 'wb') as lock_file:
+        assert singleflight.try_lock(lock_file)
+        resample_jobs._write_record(store._path(job_id), {
+            'job_id': job_id, 'status': resample_jobs.RUNNING,
+            'request': make_request(tmp_path)})
+        assert store.get(job_id)['status'] == resample_jobs.RUNNING
+        assert store.running_count() == 1
+    # The process of the job has exited without writing its result
+    job = store.get(job_id)
+    assert job['status'] == resample_jobs.FAILED
+    assert job['message'] == 'the job was interrupted'
+    assert store.running_count() == 0
+
+    now[0] += 61
+    assert store.get(job_id) is None
+    store.cleanup()
+    assert os.listdir(store.directory) == []
+    assert store.get('../' + job_id) is None
+
+
+def test_max_running_jobs(tmp_path):
+    store = resample_jobs.JobStore(str(tmp_path / 'jobs'), ttl=60)
+    job_id = 32 * 'c'
+    with open(store._path(job_id, '.lock'), 'wb') as lock_file:
+        assert singleflight.try_lock(lock_file)
+        resample_jobs._write_record(store._path(job_id), {
+            'job_id': job_id, 'status': resample_jobs.RUNNING,
+            'request': make_request(tmp_path)})
+        with pytest.raises(resample_jobs.TooManyJobs):
+            store.submit(make_request(tmp_path), max_running=1)
+
+        # Jobs are counted and started under the lock of the directory,
+        # which is shared by the processes
+        results = []
+
+        def submit():
+            try:
+                store.submit(make_request(tmp_path), max_running=1)
+            except resample_jobs.TooManyJobs as exc:
+                results.append(exc)
+        with store._locked():
+            thread = threading.Thread(target=submit)
+            thread.start()
+            time.sleep(0.05)
+            assert results == []
+        thread.join()
+        assert len(results) == 1
+    assert store.running_count() == 0
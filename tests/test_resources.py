@@ -0,0 +1,95 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import os
+
+import pytest
+
+from linear_voluba import resources
+
+
+def write_files(root, files):
+    for relative_path, content in files.items():
+        path = root / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content + '\n')
+    return str(root)
+
+
+@pytest.mark.parametrize(['files', 'expected'], [
+    ({}, None),
+    ({'cpu.max': 'max 100000'}, None),
+    ({'cpu.max': '50000 100000'}, 0.5),
+    ({'cpu.max': '200000 100000'}, 2.0),
+    ({'cpu/cpu.cfs_quota_us': '-1', 'cpu/cpu.cfs_period_us': '100000'},
+     None),
+    ({'cpu/cpu.cfs_quota_us': '150000', 'cpu/cpu.cfs_period_us': '100000'},
+     1.5),
+    ({'cpu,cpuacct/cpu.cfs_quota_us': '300000',
+      'cpu,cpuacct/cpu.cfs_period_us': '100000'}, 3.0),
+])
+def test_cpu_quota(tmp_path, files, expected):
+    cgroup_root = write_files(tmp_path, files)
+    assert resources.cpu_quota(cgroup_root) == expected
+
+
+def test_available_cpus(tmp_path):
+    unlimited = write_files(tmp_path / 'unlimited', {})
+    assert resources.available_cpus(unlimited) >= 1
+    limited = write_files(tmp_path / 'limited', {'cpu.max': '10000 100000'})
+    assert resources.available_cpus(limited) == 1
+
+
+def test_threads_per_worker(tmp_path, monkeypatch):
+    cgroup_root = write_files(tmp_path, {'cpu.max': '400000 100000'})
+    monkeypatch.setattr(resources, 'available_cpus', lambda root: 4)
+    assert resources.threads_per_worker(2, cgroup_root) == 2
+    assert resources.threads_per_worker(8, cgroup_root) == 1
+    monkeypatch.setenv('WEB_CONCURRENCY', '4')
+    assert resources.threads_per_worker(cgroup_root=cgroup_root) == 1
+
+
+def test_limit_blas_threads(monkeypatch):
+    threadpoolctl = pytest.importorskip('threadpoolctl')
+    for variable in resources.THREAD_ENVIRONMENT_VARIABLES:
+        monkeypatch.delenv(variable, raising=False)
+    with threadpoolctl.threadpool_limits():  # restore the limits afterwards
+        resources.limit_blas_threads(1)
+        assert all(info['num_threads'] == 1
+                   for info in threadpoolctl.threadpool_info())
+    assert os.environ['OMP_NUM_THREADS'] == '1'
+
+
+def test_configure_blas_threads(monkeypatch):
+    calls = []
+    monkeypatch.setattr(resources, 'limit_blas_threads', calls.append)
+    monkeypatch.setattr(resources, 'threads_per_worker', lambda: 3)
+    resources.configure_blas_threads(None)
+    resources.configure_blas_threads(2)
+    resources.configure_blas_threads('auto')
+    assert calls == [2, 3]
+
+
+@pytest.mark.parametrize(['files', 'expected'], [
+    ({}, None),
+    ({'memory.max': 'max'}, None),
+    ({'memory.max': '536870912'}, 512 * 2 ** 20),
+    ({'memory/memory.limit_in_bytes': '9223372036854771712'}, None),
+    ({'memory/memory.limit_in_bytes': '1073741824'}, 2 ** 30),
+])
+def test_memory_limit(tmp_path, files, expected):
+    cgroup_root = write_files(tmp_path, files)
+    assert resources.memory_limit(cgroup_root) == expected
@@ -0,0 +1,428 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import json
+import os
+
+import numpy
+import pytest
+
+import linear_voluba
+from linear_voluba import leastsquares
+from linear_voluba import sessions
+
+
+def make_pairs(count, seed=0):
+    rng = numpy.random.RandomState(seed)
+    src = rng.uniform(-50, 50, size=(count, 3))
+    dst = 2 * src + [1, 2, 3] + rng.normal(size=src.shape)
+    return [{'index': i, 'source_point': list(s), 'target_point': list(d)}
+            for i, (s, d) in enumerate(zip(src, dst))]
+
+
+def check_solution(session):
+    src = session.source_points[session.active]
+    dst = session.target_points[session.active]
+    expected = leastsquares.estimate(session.transformation_type, src, dst)
+    assert numpy.allclose(session.transformation_matrix, expected,
+                          rtol=0, atol=1e-9)
+    assert numpy.allclose(session.mismatches,
+                          leastsquares.per_landmark_mismatch(
+                              session.source_points, session.target_points,
+                              expected))
+
+
+def test_session_update():
+    session = sessions.Session('id', 'affine')
+    indices = session.update(make_pairs(3))
+    assert session.transformation_matrix is None
+    assert 'missing 1 point(s)' in session.message
+    assert len(indices) == 0
+
+    indices = session.update(make_pairs(10)[3:])
+    assert session.landmark_count == 10
+    assert list(indices) == list(range(10))
+    check_solution(session)
+
+    indices = session.update([{'index': 4, 'active': False}])
+    assert 4 in indices
+    check_solution(session)
+
+    indices = session.update([{'index': 1, 'target_point': [0, 0, 0]}],
+                             removed=[0, 9], transformation_type='rigid')
+    assert session.landmark_count == 8
+    assert session.transformation_type == 'rigid'
+    assert 0 in indices
+    check_solution(session)
+
+
+def test_session_update_unchanged_mismatches():
+    session = sessions.Session('id', 'affine')
+    session.update(make_pairs(10))
+    # Re-sending the same values changes nothing but the pair itself
+    indices = session.update([dict(make_pairs(10)[3], active=True)],
+                             mismatch_tolerance=1e-6)
+    assert list(indices) == [3]
+
+
+def test_session_incremental_mismatches(monkeypatch):
+    session = sessions.Session('id', 'affine')
+    session.update(make_pairs(1000))
+    computed = []
+    per_landmark_mismatch = leastsquares.per_landmark_mismatch
+
+    def counting_mismatch(src, dst, matrix):
+        computed.append(len(src))
+        return per_landmark_mismatch(src, dst, matrix)
+    monkeypatch.setattr(leastsquares, 'per_landmark_mismatch',
+                        counting_mismatch)
+
+    # A small change of the transformation only recomputes the changed pair
+    pair = dict(make_pairs(1000)[3], target_point=[0, 0, 0])
+    indices = session.update([pair], mismatch_tolerance=1.0)
+    assert list(indices) == [3]
+    assert computed == [1]
+    assert 0 < session.mismatch_error <= 1.0
+    exact = per_landmark_mismatch(session.source_points,
+                                  session.target_points,
+                                  session.transformation_matrix)
+    assert numpy.all(numpy.abs(session.mismatches - exact)
+                     <= session.mismatch_error)
+    assert session.mismatches[3] == exact[3]
+    assert numpy.isclose(session.rmse, numpy.sqrt(numpy.mean(exact ** 2)),
+                         rtol=1e-3)
+
+    # All mismatches are recomputed when the bound exceeds the tolerance
+    indices = session.update([dict(pair, target_point=[1000, 0, 0])],
+                             mismatch_tolerance=1.0)
+    assert computed == [1, 1000]
+    assert session.mismatch_error == 0
+    assert len(indices) > 1
+    check_solution(session)
+
+
+def test_session_serialization():
+    session = sessions.Session('id', 'rigid')
+    session.update(make_pairs(10))
+    session.apply([{'index': 2, 'active': False}], removed=[5])
+    copy = sessions.Session.loads(session.dumps())
+    for name, value in vars(session).items():
+        if name == 'moments':
+            for moment_name, moment in vars(value).items():
+                assert numpy.array_equal(getattr(copy.moments, moment_name),
+                                         moment)
+        elif isinstance(value, numpy.ndarray):
+            assert numpy.array_equal(getattr(copy, name), value)
+            assert getattr(copy, name).dtype == value.dtype
+        else:
+            assert getattr(copy, name) == value
+    assert list(copy.refresh()) == list(session.refresh())
+    check_solution(copy)
+
+
+def test_session_rebuild_moments(monkeypatch):
+    monkeypatch.setattr(sessions, 'REBUILD_MIN_REMOVALS', 0)
+    session = sessions.Session('id', 'similarity')
+    session.update(make_pairs(10))
+    session.update(make_pairs(10)[:9], removed=[9])
+    assert session.removals_since_rebuild == 0
+    check_solution(session)
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'removed': [10]},
+    {'landmark_pairs': [{'index': 11, 'source_point': [0, 0, 0],
+                         'target_point': [0, 0, 0]}]},
+    {'landmark_pairs': [{'index': 10, 'active': False}]},
+])
+def test_session_invalid_update(kwargs):
+    session = sessions.Session('id', 'affine')
+    session.update(make_pairs(10))
+    matrix = session.transformation_matrix
+    with pytest.raises(sessions.InvalidUpdate):
+        session.update(transformation_type='rigid', **kwargs)
+    assert session.landmark_count == 10
+    assert session.transformation_type == 'affine'
+    assert session.transformation_matrix is matrix
+
+
+def test_session_max_landmarks():
+    session = sessions.Session('id', 'affine')
+    with pytest.raises(sessions.TooManyLandmarks):
+        session.update(make_pairs(10), max_landmarks=9)
+    session.update(make_pairs(10), max_landmarks=10)
+
+
+def make_store(directory, clock=None, **kwargs):
+    kwargs.setdefault('ttl', 10)
+    kwargs.setdefault('max_count', 10)
+    kwargs.setdefault('max_total_landmarks', 100)
+    if clock is not None:
+        kwargs['clock'] = clock
+    return sessions.SessionStore(str(directory), cleanup_interval=0,
+                                 **kwargs)
+
+
+def test_store_expiry(tmp_path):
+    now = [1000]
+    store = make_store(tmp_path, clock=lambda: now[0])
+    session = store.create('rigid')
+    store.save(session)
+    now[0] = 1005
+    assert store.get(session.id).id == session.id
+    now[0] = 1014
+    assert store.get(session.id) is not None
+    now[0] = 1025
+    assert store.get(session.id) is None
+    assert len(store) == 0
+    assert not store.delete(session.id)
+    assert store.get('../../etc/passwd') is None
+    assert not store.delete('unknown')
+
+
+def test_store_checkout(tmp_path):
+    store = make_store(tmp_path)
+    session = store.create('affine')
+    session.update(make_pairs(10))
+    store.save(session)
+    with store.checkout(session.id) as checked_out:
+        checked_out.update([{'index': 2, 'active': False}])
+    assert store.get(session.id).version == 2
+    assert store.read_header(session.id) == (2, 10, 0)
+    # Nothing is stored if the block raises an exception
+    with pytest.raises(RuntimeError):
+        with store.checkout(session.id) as checked_out:
+            checked_out.update([{'index': 3, 'active': False}])
+            raise RuntimeError
+    assert store.get(session.id).active[3]
+    with store.checkout('0' * 32) as checked_out:
+        assert checked_out is None
+    assert store.delete(session.id)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_store_limits(tmp_path):
+    now = [1000]
+    store = make_store(tmp_path, clock=lambda: now[0], max_count=3,
+                       max_total_landmarks=25)
+    created = []
+    for _ in range(4):
+        now[0] += 1
+        session = store.create('rigid')
+        store.save(session)
+        created.append(session)
+    now[0] += 1
+    store.get(created[0].id)
+    store.enforce_limits()
+    assert len(store) == 3
+    assert store.get(created[1].id) is None
+    for session, count in [(created[2], 20), (created[3], 10)]:
+        now[0] += 1
+        session.update(make_pairs(count))
+        store.save(session)
+    store.enforce_limits()
+    assert store.get(created[2].id) is None
+    assert store.get(created[3].id) is not None
+    # Expired sessions are removed
+    now[0] += 100
+    store.enforce_limits()
+    assert len(store) == 0
+
+
+def make_app(directory):
+    return linear_voluba.create_app({
+        'TESTING': True,
+        'SESSION_DIRECTORY': str(directory),
+        'SESSION_MAX_LANDMARKS': 20,
+        'SESSION_EVENTS_POLL_INTERVAL': 0.001,
+    })
+
+
+@pytest.fixture
+def session_client(tmp_path):
+    return make_app(tmp_path).test_client()
+
+
+def test_session_api(session_client):
+    pairs = make_pairs(10)
+    response = session_client.post('/api/sessions', json={
+        'transformation_type': 'affine',
+        'landmark_pairs': [{'source_point': p['source_point'],
+                            'target_point': p['target_point'],
+                            'name': 'ignored'} for p in pairs],
+    })
+    assert response.status_code == 201
+    result = response.json
+    assert result['landmark_count'] == 10
+    assert len(result['mismatches']) == 10
+    session_id = result['session_id']
+
+    response = session_client.patch(
+        '/api/sessions/{0}/landmarks'.format(session_id),
+        json={'landmark_pairs': [{'index': 2, 'active': False}]})
+    assert response.status_code == 200
+    result = response.json
+    assert 2 in [m['index'] for m in result['mismatches']]
+    src = numpy.array([p['source_point'] for p in pairs])
+    dst = numpy.array([p['target_point'] for p in pairs])
+    mask = numpy.arange(10) != 2
+    expected = leastsquares.estimate('affine', src[mask], dst[mask])
+    assert numpy.allclose(result['transformation_matrix'], expected)
+
+    response = session_client.patch(
+        '/api/sessions/{0}/landmarks'.format(session_id),
+        json={'landmark_pairs': make_pairs(21)})
+    assert response.status_code == 413
+
+    response = session_client.delete('/api/sessions/{0}'.format(session_id))
+    assert response.status_code == 204
+    response = session_client.patch(
+        '/api/sessions/{0}/landmarks'.format(session_id), json={})
+    assert response.status_code == 404
+
+
+def test_session_api_underdetermined(session_client):
+    response = session_client.post('/api/sessions', json={
+        'transformation_type': 'rigid',
+        'landmark_pairs': [],
+    })
+    assert response.status_code == 201
+    assert response.json['transformation_matrix'] is None
+    assert 'message' in response.json
+    response = session_client.patch(
+        '/api/sessions/{0}/landmarks'.format(response.json['session_id']),
+        json={'landmark_pairs': [{'index': 1, 'active': False}]})
+    assert response.status_code == 422
+
+
+def test_event_stream_coalescing(tmp_path):
+    store = make_store(tmp_path)
+    session = store.create('affine')
+    session.update(make_pairs(10))
+    store.save(session)
+    stream = sessions.event_stream(
+        store, session.id, lambda s, indices: (s.version, indices.tolist()),
+        keepalive=0.01, poll_interval=0.001)
+    event = next(stream)
+    assert event == 'id: 1\nevent: result\ndata: (1, {0})\n\n'.format(
+        list(range(10)))
+    # Several updates before the stream resumes are solved only once
+    for index in [1, 2]:
+        with store.checkout(session.id) as checked_out:
+            checked_out.apply([{'index': index, 'active': False}])
+    event = next(stream)
+    assert event.startswith('id: 3\n')
+    assert '1, 2' in event
+    assert store.get(session.id).solved_version == 3
+    assert next(stream) == ': keep-alive\n\n'
+
+    # Opening a new stream ends the previous one
+    other_stream = sessions.event_stream(
+        store, session.id, lambda s, indices: '', keepalive=0.01,
+        poll_interval=0.001)
+    next(other_stream)
+    with pytest.raises(StopIteration):
+        next(stream)
+    # So does the deletion of the session
+    store.delete(session.id)
+    with pytest.raises(StopIteration):
+        next(other_stream)
+
+
+def test_session_events_api(session_client):
+    response = session_client.post('/api/sessions', json={
+        'transformation_type': 'affine',
+        'landmark_pairs': [{'source_point': p['source_point'],
+                            'target_point': p['target_point']}
+                           for p in make_pairs(10)],
+    })
+    session_id = response.json['session_id']
+    response = session_client.patch(
+        '/api/sessions/{0}/landmarks?defer=true'.format(session_id),
+        json={'landmark_pairs': [{'index': 2, 'active': False}]})
+    assert response.status_code == 202
+    assert response.json['version'] == 2
+
+    response = session_client.get(
+        '/api/sessions/{0}/events'.format(session_id))
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    event = next(iter(response.response)).decode()
+    response.close()
+    assert event.startswith('id: 2\nevent: result\ndata: {')
+    data = json.loads(event.splitlines()[2][len('data: '):])
+    assert data['version'] == 2
+    assert len(data['mismatches']) == 10
+
+    response = session_client.get('/api/sessions/unknown/events')
+    assert response.status_code == 404
+
+
+def test_sessions_shared_between_processes(tmp_path):
+    # Two applications stand for two worker processes
+    first_client = make_app(tmp_path).test_client()
+    second_client = make_app(tmp_path).test_client()
+    response = first_client.post('/api/sessions', json={
+        'transformation_type': 'affine',
+        'landmark_pairs': [{'source_point': p['source_point'],
+                            'target_point': p['target_point']}
+                           for p in make_pairs(10)],
+    })
+    session_id = response.json['session_id']
+    url = '/api/sessions/{0}/landmarks'.format(session_id)
+    response = second_client.patch(url, json={
+        'landmark_pairs': [{'index': 2, 'active': False}]})
+    assert response.status_code == 200
+    assert response.json['version'] == 2
+    assert second_client.delete(
+        '/api/sessions/{0}'.format(session_id)).status_code == 204
+    assert first_client.patch(url, json={}).status_code == 404
+
+
+def test_deferred_update_pushed_by_other_process(tmp_path):
+    first_client = make_app(tmp_path).test_client()
+    second_client = make_app(tmp_path).test_client()
+    response = first_client.post('/api/sessions', json={
+        'transformation_type': 'affine',
+        'landmark_pairs': [{'source_point': p['source_point'],
+                            'target_point': p['target_point']}
+                           for p in make_pairs(10)],
+    })
+    session_id = response.json['session_id']
+    stream = first_client.get('/api/sessions/{0}/events'.format(session_id))
+    events = iter(stream.response)
+    assert next(events).decode().startswith('id: 1\n')
+
+    # A deferred update received by one process is pushed by the stream
+    # opened in the other
+    response = second_client.patch(
+        '/api/sessions/{0}/landmarks?defer=true'.format(session_id),
+        json={'landmark_pairs': [{'index': 3, 'active': False}]})
+    assert response.status_code == 202
+    event = next(events).decode()
+    assert event.startswith('id: 2\nevent: result\n')
+    data = json.loads(event.splitlines()[2][len('data: '):])
+    assert 3 in [m['index'] for m in data['mismatches']]
+    stream.close()
+
+    # Without an open stream, the update is sent by the next stream
+    response = second_client.patch(
+        '/api/sessions/{0}/landmarks?defer=true'.format(session_id),
+        json={'landmark_pairs': [{'index': 4, 'active': False}]})
+    assert response.status_code == 202
+    stream = first_client.get('/api/sessions/{0}/events'.format(session_id))
+    assert next(iter(stream.response)).decode().startswith('id: 3\n')
+    stream.close()
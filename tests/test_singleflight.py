@@ -0,0 +1,191 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import fcntl
+import os
+import pickle
+import threading
+import time
+
+import numpy
+import pytest
+
+import linear_voluba
+from linear_voluba import api
+from linear_voluba import singleflight
+
+
+def run_concurrently(functions):
+    results = [None] * len(functions)
+
+    def run(i):
+        try:
+            results[i] = functions[i]()
+        except Exception as exc:
+            results[i] = exc
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(functions))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def slow_function(calls, result=42, exception=None):
+    def func():
+        calls.append(None)
+        time.sleep(0.2)
+        if exception is not None:
+            raise exception
+        return result
+    return func
+
+
+def test_single_flight():
+    flight = singleflight.SingleFlight()
+    calls = []
+    results = run_concurrently(
+        [lambda: flight.do('key', slow_function(calls))] * 4)
+    assert len(calls) == 1
+    assert sorted(results) == [(42, False)] + [(42, True)] * 3
+    # Nothing is cached
+    assert flight.do('key', lambda: 0) == (0, False)
+
+
+def test_single_flight_exception():
+    flight = singleflight.SingleFlight()
+    calls = []
+    results = run_concurrently(
+        [lambda: flight.do('key', slow_function(
+            calls, exception=ValueError('failed')))] * 3)
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_single_flight_across_processes(tmp_path):
+    # Each instance plays the role of a process (flock locks belong to open
+    # files, so they conflict even within one process)
+    flights = [singleflight.SingleFlight(directory=str(tmp_path),
+                                         shared_exceptions=(ValueError,))
+               for _ in range(3)]
+    calls = []
+    results = run_concurrently(
+        [lambda f=f: f.do('key', slow_function(calls)) for f in flights])
+    assert len(calls) == 1
+    assert sorted(results) == [(42, False)] + [(42, True)] * 2
+    assert not os.path.exists(str(tmp_path / 'key.lock'))
+
+    arrays = (numpy.eye(4), numpy.arange(3.0))
+    results = run_concurrently(
+        [lambda f=f: f.do('arrays', slow_function(calls, arrays))
+         for f in flights])
+    assert len(calls) == 2
+    for result, shared in results:
+        assert isinstance(result, tuple)
+        assert all(numpy.array_equal(a, b) for a, b in zip(result, arrays))
+
+    results = run_concurrently(
+        [lambda f=f: f.do('error', slow_function(
+            calls, exception=ValueError('failed'))) for f in flights])
+    assert len(calls) == 3
+    assert all(isinstance(result, ValueError) for result in results)
+    assert all(str(result) == 'failed' for result in results)
+
+
+def test_single_flight_unshared_result(tmp_path):
+    # Results that cannot be stored without pickling are computed again by
+    # the waiting processes, one at a time
+    flights = [singleflight.SingleFlight(directory=str(tmp_path))
+               for _ in range(2)]
+    calls = []
+    results = run_concurrently(
+        [lambda f=f: f.do('key', slow_function(calls, {'a': 1}))
+         for f in flights])
+    assert len(calls) == 2
+    assert results == [({'a': 1}, False)] * 2
+
+
+def test_single_flight_result_not_unpickled(tmp_path):
+    flight = singleflight.SingleFlight(directory=str(tmp_path))
+    with open(str(tmp_path / 'key.result'), 'wb') as f:
+        pickle.dump(('ok', 42), f)
+    assert flight._read_result(str(tmp_path / 'key.result')) is None
+
+
+def test_single_flight_timeout(tmp_path):
+    flight = singleflight.SingleFlight(directory=str(tmp_path), timeout=0.05)
+    lock_path = str(tmp_path / 'key.lock')
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        assert flight.do('key', lambda: 1) == (1, False)
+        # The lock file of the other process is left in place
+        assert singleflight._is_current(lock_file, lock_path)
+
+
+def test_single_flight_removed_lock_file(tmp_path, monkeypatch):
+    # A lock file that was removed after it was opened is not used: the
+    # leader that removed it has finished
+    flight = singleflight.SingleFlight(directory=str(tmp_path))
+    lock_path = str(tmp_path / 'key.lock')
+    is_current = singleflight._is_current
+    checks = []
+
+    def is_current_once_removed(lock_file, path):
+        if not checks:
+            os.unlink(path)
+        checks.append(path)
+        return is_current(lock_file, path)
+    monkeypatch.setattr(singleflight, '_is_current', is_current_once_removed)
+    assert flight.do('key', lambda: 1) == (1, False)
+    assert len(checks) == 3
+    assert not os.path.exists(lock_path)
+
+
+@pytest.mark.parametrize('directory', [False, True])
+def test_least_squares_single_flight(monkeypatch, tmp_path, directory):
+    app = linear_voluba.create_app({
+        'TESTING': True,
+        'SINGLE_FLIGHT_DIRECTORY': str(tmp_path) if directory else None,
+    })
+    calls = []
+    original_solve = api._solve
+
+    def slow_solve(*args):
+        calls.append(None)
+        time.sleep(0.2)
+        return original_solve(*args)
+    monkeypatch.setattr(api, '_solve', slow_solve)
+
+    def request(name):
+        response = app.test_client().post('/api/least-squares', json={
+            'transformation_type': 'rigid',
+            'landmark_pairs': [
+                {'source_point': [0, 0, 0], 'target_point': [1, 1, 1],
+                 'name': name},
+                {'source_point': [1, 0, 0], 'target_point': [2, 1, 1]},
+                {'source_point': [0, 1, 0], 'target_point': [1, 2, 1]},
+            ],
+        })
+        assert response.status_code == 200
+        return response.json
+    results = run_concurrently([lambda i=i: request(str(i))
+                                for i in range(3)])
+    assert len(calls) == 1
+    for i, result in enumerate(results):
+        assert result['landmark_pairs'][0]['name'] == str(i)
+        assert result['transformation_matrix'] == \
+            results[0]['transformation_matrix']
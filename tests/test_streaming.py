@@ -0,0 +1,129 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import json
+import math
+
+import numpy
+import pytest
+
+from linear_voluba import leastsquares
+from linear_voluba import streaming
+
+
+AFFINE_MATRIX = numpy.array([
+    [1.2, 0.8, 0.9, 2.0],
+    [0.7, 1.1, 1.2, 33.0],
+    [1.1, 0.9, 0.8, 100.0],
+    [0.0, 0.0, 0.0, 1.0],
+])
+
+
+def make_points(count, offset=0.0, seed=0):
+    rng = numpy.random.RandomState(seed)
+    src = rng.uniform(-50, 50, size=(count, 3)) + offset
+    dst = src @ AFFINE_MATRIX[:3, :3].T + AFFINE_MATRIX[:3, 3]
+    dst += rng.normal(size=dst.shape)
+    return src, dst
+
+
+def test_compensated_sum():
+    compensated_sum = streaming.CompensatedSum()
+    for value in [1.0, 1e100, 1.0, -1e100]:
+        compensated_sum.add(value)
+    assert compensated_sum.value == 2.0
+
+
+@pytest.mark.parametrize('transformation_type',
+                         leastsquares.TRANSFORMATION_TYPES)
+def test_streaming_estimate(transformation_type):
+    src, dst = make_points(1000)
+    chunks = streaming.ChunkedCorrespondences(src, dst, chunk_size=64)
+    result = streaming.estimate(transformation_type, chunks)
+    expected = leastsquares.estimate(transformation_type, src, dst)
+    assert numpy.allclose(result.transformation_matrix, expected,
+                          rtol=0, atol=1e-9)
+    mismatches = leastsquares.per_landmark_mismatch(src, dst, expected)
+    assert result.count == 1000
+    assert math.isclose(result.rmse, math.sqrt(numpy.mean(mismatches ** 2)))
+    assert math.isclose(result.max_mismatch, mismatches.max())
+    assert result.histogram.sum() == 1000
+    assert numpy.array_equal(
+        result.histogram,
+        numpy.histogram(mismatches, streaming.DEFAULT_HISTOGRAM_EDGES)[0])
+
+
+def test_streaming_far_from_origin():
+    src, dst = make_points(100000, offset=1e6)
+    result = streaming.estimate(
+        'affine', streaming.ChunkedCorrespondences(src, dst, chunk_size=999))
+    # The direct solver needs centred points at this distance from the origin
+    src_mean, dst_mean = src.mean(axis=0), dst.mean(axis=0)
+    expected = leastsquares.estimate('affine', src - src_mean,
+                                     dst - dst_mean)
+    expected[:3, 3] = dst_mean - expected[:3, :3] @ src_mean
+    assert numpy.allclose(result.transformation_matrix[:3, :3],
+                          expected[:3, :3], rtol=0, atol=1e-12)
+    # The translation amplifies the rounding errors of the linear part, so
+    # the mismatches are compared instead
+    assert numpy.allclose(
+        leastsquares.per_landmark_mismatch(src, dst,
+                                           result.transformation_matrix),
+        leastsquares.per_landmark_mismatch(src, dst, expected),
+        rtol=0, atol=1e-6)
+
+
+def test_streaming_from_generator_function():
+    src, dst = make_points(1000)
+    passes = []
+
+    def read_chunks():
+        passes.append(None)
+        for start in range(0, 1000, 300):
+            yield src[start:start + 300], dst[start:start + 300]
+    result = streaming.estimate('rigid', read_chunks)
+    assert len(passes) == 2
+    assert result.count == 1000
+    assert numpy.allclose(result.transformation_matrix,
+                          leastsquares.estimate('rigid', src, dst))
+
+
+def test_streaming_from_npy(tmp_path, capsys):
+    src, dst = make_points(500)
+    numpy.save(str(tmp_path / 'src.npy'), src)
+    numpy.save(str(tmp_path / 'dst.npy'), dst)
+    chunks = streaming.ChunkedCorrespondences.from_npy(
+        str(tmp_path / 'src.npy'), str(tmp_path / 'dst.npy'), chunk_size=100)
+    assert isinstance(chunks.source_points, numpy.memmap)
+    assert len(list(chunks)) == 5
+
+    assert streaming.main([str(tmp_path / 'src.npy'),
+                           str(tmp_path / 'dst.npy'), 'rigid',
+                           '--chunk-size', '100']) == 0
+    output = json.loads(capsys.readouterr().out)
+    assert numpy.allclose(output['transformation_matrix'],
+                          leastsquares.estimate('rigid', src, dst))
+    assert output['histogram']['edges'][-1] is None
+
+
+def test_streaming_errors():
+    src, dst = make_points(2)
+    with pytest.raises(TypeError):
+        streaming.estimate('affine', iter([(src, dst)]))
+    with pytest.raises(leastsquares.UnderdeterminedProblem):
+        streaming.estimate('affine', [(src, dst)])
+    with pytest.raises(ValueError):
+        streaming.ChunkedCorrespondences(src, dst[:1])
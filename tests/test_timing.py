@@ -0,0 +1,62 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+from linear_voluba import timing
+
+
+LANDMARK_PAIRS = [
+    {'source_point': [0, 0, 0], 'target_point': [10, 10, 10]},
+    {'source_point': [1, 0, 0], 'target_point': [8, 10, 10]},
+    {'source_point': [0, 1, 0], 'target_point': [10, 12, 10]},
+    {'source_point': [0, 0, -1], 'target_point': [10, 10, 12]},
+]
+
+
+def test_server_timing_header_format():
+    timings = timing.RequestTimings()
+    timings.start_ns = 0
+    timings.stages = [('validate', 1500000), ('solve', 250000)]
+    timings.last_ns = 2000000
+    assert (timing.server_timing_header(timings)
+            == 'validate;dur=1.500, solve;dur=0.250, total;dur=2.000')
+
+
+def test_server_timing_disabled_by_default(client):
+    response = client.post('/api/least-squares', json={
+        'transformation_type': 'affine',
+        'landmark_pairs': LANDMARK_PAIRS,
+    })
+    assert 'Server-Timing' not in response.headers
+
+
+def test_server_timing_header():
+    from linear_voluba import create_app
+    app = create_app({'TESTING': True, 'SERVER_TIMING': True})
+    with app.test_client() as client:
+        response = client.post('/api/least-squares', json={
+            'transformation_type': 'affine',
+            'landmark_pairs': LANDMARK_PAIRS,
+        })
+    assert response.status_code == 200
+    stage_names = [entry.split(';')[0] for entry
+                   in response.headers['Server-Timing'].split(', ')]
+    assert stage_names == ['validate', 'solve', 'invert', 'mismatch',
+                           'serialize', 'total']
+    assert response.headers['Timing-Allow-Origin'] == '*'
+
+    with app.test_client() as client:
+        response = client.get('/health')
+    assert response.headers['Server-Timing'].startswith('total;dur=')
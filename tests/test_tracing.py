@@ -0,0 +1,196 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import json
+import logging
+
+import pytest
+
+import linear_voluba
+from linear_voluba import logconfig
+from linear_voluba import tracing
+
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+SPAN_ID = '00f067aa0ba902b7'
+
+
+@pytest.mark.parametrize(['value', 'expected'], [
+    ('00-{0}-{1}-01'.format(TRACE_ID, SPAN_ID),
+     tracing.TraceParent(TRACE_ID, SPAN_ID, True)),
+    ('00-{0}-{1}-00'.format(TRACE_ID, SPAN_ID),
+     tracing.TraceParent(TRACE_ID, SPAN_ID, False)),
+    # Future versions may have more fields
+    ('01-{0}-{1}-03-more'.format(TRACE_ID, SPAN_ID),
+     tracing.TraceParent(TRACE_ID, SPAN_ID, True)),
+    (None, None),
+    ('', None),
+    ('garbage', None),
+    ('00-{0}-{1}-01-more'.format(TRACE_ID, SPAN_ID), None),
+    ('ff-{0}-{1}-01'.format(TRACE_ID, SPAN_ID), None),
+    ('00-{0}-{1}-01'.format(TRACE_ID.upper(), SPAN_ID), None),
+    ('00-{0}-{1}-01'.format('0' * 32, SPAN_ID), None),
+    ('00-{0}-{1}-01'.format(TRACE_ID, '0' * 16), None),
+])
+def test_parse_traceparent(value, expected):
+    assert tracing.parse_traceparent(value) == expected
+
+
+def test_format_traceparent():
+    value = tracing.format_traceparent(TRACE_ID, SPAN_ID)
+    assert value == '00-{0}-{1}-01'.format(TRACE_ID, SPAN_ID)
+    assert tracing.parse_traceparent(value) == tracing.TraceParent(
+        TRACE_ID, SPAN_ID, True)
+    assert tracing.format_traceparent(TRACE_ID, SPAN_ID, False).endswith('-00')
+
+
+def test_sampler():
+    trace_ids = [tracing._random_id(16) for _ in range(1000)]
+    assert not any(tracing.Sampler(0.0).should_sample(trace_id)
+                   for trace_id in trace_ids)
+    assert all(tracing.Sampler(1.0).should_sample(trace_id)
+               for trace_id in trace_ids)
+    sampled = sum(tracing.Sampler(0.5).should_sample(trace_id)
+                  for trace_id in trace_ids)
+    assert 350 < sampled < 650
+    # The decision of the caller is followed
+    parent = tracing.TraceParent(TRACE_ID, SPAN_ID, True)
+    assert tracing.Sampler(0.0).should_sample(TRACE_ID, parent)
+    parent = tracing.TraceParent(TRACE_ID, SPAN_ID, False)
+    assert not tracing.Sampler(1.0).should_sample(TRACE_ID, parent)
+    # At most max_per_second traces are recorded
+    sampler = tracing.Sampler(1.0, max_per_second=5)
+    sampled = sum(sampler.should_sample(trace_id) for trace_id in trace_ids)
+    assert 5 <= sampled < 10
+
+
+def test_file_exporter(tmp_path):
+    path = tmp_path / 'traces.jsonl'
+    exporter = tracing.FileExporter(str(path))
+    exporter.export([{'name': 'a'}, {'name': 'b'}])
+    exporter.export([{'name': 'c'}])
+    assert [json.loads(line)['name']
+            for line in path.read_text().splitlines()] == ['a', 'b', 'c']
+
+
+@pytest.fixture
+def traced_app():
+    return linear_voluba.create_app({
+        'TESTING': True,
+        'TRACING': True,
+        'TRACING_SAMPLE_RATE': 1.0,
+        'TRACING_MAX_TRACES_PER_SECOND': None,
+        'TRACING_EXPORTER': 'memory',
+    })
+
+
+LANDMARK_PAIRS = [
+    {'source_point': [0, 0, 0], 'target_point': [1, 0, 0]},
+    {'source_point': [1, 0, 0], 'target_point': [2, 0, 0]},
+    {'source_point': [0, 1, 0], 'target_point': [1, 1, 0]},
+    {'source_point': [0, 0, 1], 'target_point': [1, 0, 1]},
+]
+
+
+def post(client, headers=None):
+    return client.post('/api/least-squares', json={
+        'transformation_type': 'affine',
+        'landmark_pairs': LANDMARK_PAIRS,
+    }, headers=headers)
+
+
+def test_traced_request(traced_app):
+    client = traced_app.test_client()
+    spans = tracing.get_tracer(traced_app).exporter.spans
+    response = post(client)
+    assert response.status_code == 200
+    root = spans[0]
+    assert root['name'] == 'POST /api/least-squares'
+    assert root['kind'] == 'SPAN_KIND_SERVER'
+    assert root['parentSpanId'] == ''
+    assert root['attributes']['http.status_code'] == 200
+    assert root['attributes']['voluba.transformation_type'] == 'affine'
+    assert [span['name'] for span in spans][1:] == [
+        'receive', 'validate', 'solve', 'invert', 'mismatch', 'serialize']
+    for span in list(spans)[1:]:
+        assert span['traceId'] == root['traceId']
+        assert span['parentSpanId'] == root['spanId']
+        assert root['startTimeUnixNano'] <= span['startTimeUnixNano']
+        assert span['startTimeUnixNano'] <= span['endTimeUnixNano']
+        assert span['endTimeUnixNano'] <= root['endTimeUnixNano']
+    assert tracing.parse_traceparent(
+        response.headers[tracing.TRACERESPONSE_HEADER]
+    ) == tracing.TraceParent(root['traceId'], root['spanId'], True)
+
+    # The trace context of the caller is propagated
+    spans.clear()
+    post(client, {'traceparent': '00-{0}-{1}-01'.format(TRACE_ID, SPAN_ID)})
+    assert spans[0]['traceId'] == TRACE_ID
+    assert spans[0]['parentSpanId'] == SPAN_ID
+
+    # Neither the requests that the caller does not sample, nor those outside
+    # of the API, are traced
+    spans.clear()
+    response = post(
+        client, {'traceparent': '00-{0}-{1}-00'.format(TRACE_ID, SPAN_ID)})
+    assert tracing.TRACERESPONSE_HEADER not in response.headers
+    assert client.get('/health').status_code == 200
+    assert not spans
+
+
+def test_errors(traced_app):
+    client = traced_app.test_client()
+    spans = tracing.get_tracer(traced_app).exporter.spans
+    response = client.post('/api/least-squares', json={})
+    assert response.status_code == 422
+    assert spans[0]['attributes']['http.status_code'] == 422
+    assert spans[0]['status']['code'] == 'STATUS_CODE_UNSET'
+
+    # The export errors do not fail the request
+    class FailingExporter:
+        def export(self, spans):
+            raise OSError('disk full')
+    tracing.get_tracer(traced_app).exporter = FailingExporter()
+    assert post(client).status_code == 200
+
+
+def test_tracing_disabled(app, client):
+    assert tracing.get_tracer(app) is None
+    response = post(client)
+    assert tracing.TRACERESPONSE_HEADER not in response.headers
+
+
+def test_make_exporter(app, tmp_path):
+    exporter = tracing.make_exporter(app)
+    assert isinstance(exporter, tracing.FileExporter)
+    assert exporter.path.endswith('traces.jsonl')
+    app.config['TRACING_FILE'] = str(tmp_path / 'spans.jsonl')
+    assert tracing.make_exporter(app).path == str(tmp_path / 'spans.jsonl')
+    app.config['TRACING_EXPORTER'] = 'unknown'
+    with pytest.raises(ValueError):
+        tracing.make_exporter(app)
+
+
+def test_log_trace_id(traced_app):
+    record = logging.LogRecord('linear_voluba', logging.WARNING, __file__, 0,
+                               'message', None, None)
+    formatter = logconfig.JSONFormatter()
+    assert 'trace_id' not in json.loads(formatter.format(record))
+    with traced_app.test_request_context('/api/least-squares',
+                                         method='POST', headers={
+            'traceparent': '00-{0}-{1}-01'.format(TRACE_ID, SPAN_ID)}):
+        traced_app.preprocess_request()
+        assert json.loads(formatter.format(record))['trace_id'] == TRACE_ID
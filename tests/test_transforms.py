@@ -0,0 +1,109 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import numpy
+import pytest
+
+from linear_voluba import transforms
+
+
+SCALING = numpy.diag([2.0, 2.0, 2.0, 1.0])
+TRANSLATION = numpy.array([
+    [1.0, 0.0, 0.0, 10.0],
+    [0.0, 1.0, 0.0, 0.0],
+    [0.0, 0.0, 1.0, 0.0],
+    [0.0, 0.0, 0.0, 1.0],
+])
+
+
+def test_compose():
+    mat, inv_mat = transforms.compose([SCALING, TRANSLATION])
+    assert numpy.array_equal(mat, TRANSLATION @ SCALING)
+    assert numpy.allclose(inv_mat @ mat, numpy.eye(4))
+
+    mat, inv_mat = transforms.compose([SCALING, TRANSLATION], [False, True])
+    assert numpy.allclose(mat, numpy.linalg.inv(TRANSLATION) @ SCALING)
+
+    mat, inv_mat = transforms.compose([])
+    assert numpy.array_equal(mat, numpy.eye(4))
+
+
+def test_compose_cache():
+    first = transforms.compose([SCALING, TRANSLATION])
+    second = transforms.compose([SCALING.copy(), TRANSLATION.tolist()])
+    assert first[0] is second[0]
+    with pytest.raises(ValueError):
+        first[0][0, 0] = 1
+
+
+def test_compose_errors():
+    with pytest.raises(transforms.SingularMatrix):
+        transforms.compose([numpy.zeros((4, 4))])
+    with pytest.raises(ValueError):
+        transforms.compose([SCALING], [True, False])
+    with pytest.raises(ValueError):
+        transforms.compose([numpy.eye(3)])
+
+
+def test_apply_transform():
+    points = numpy.array([[1.0, 2.0, 3.0], [0.0, 0.0, 0.0]])
+    assert numpy.array_equal(
+        transforms.apply_transform(TRANSLATION @ SCALING, points),
+        [[12.0, 4.0, 6.0], [10.0, 0.0, 0.0]])
+    assert transforms.apply_transform(SCALING, []).shape == (0, 3)
+
+
+def test_compose_endpoint(client):
+    response = client.post('/api/compose', json={
+        'steps': [
+            {'matrix': SCALING.tolist()},
+            {'matrix': TRANSLATION[:3].tolist(), 'invert': True},
+        ],
+        'points': [[1, 2, 3]],
+    })
+    assert response.status_code == 200
+    assert numpy.allclose(response.json['transformation_matrix'],
+                          numpy.linalg.inv(TRANSLATION) @ SCALING)
+    assert numpy.allclose(response.json['points'], [[-8, 4, 6]])
+
+    response = client.post('/api/compose', json={
+        'steps': [{'matrix': SCALING.tolist()}],
+    })
+    assert response.status_code == 200
+    assert 'points' not in response.json
+
+    response = client.post('/api/compose', json={
+        'steps': [{'matrix': numpy.diag([0, 1, 1, 1]).tolist(),
+                   'invert': True}],
+    })
+    assert response.status_code == 400
+    response = client.post('/api/compose', json={'steps': []})
+    assert response.status_code == 422
+
+
+def test_embed_slice_transforms():
+    rotation = numpy.array([[0, -1, 5], [1, 0, 6], [0, 0, 1]], dtype=float)
+    embedded = transforms.embed_slice_transforms(
+        [rotation, numpy.eye(3)], [0.0, 2.0], [1.0, 2.0])
+    assert embedded.shape == (2, 4, 4)
+    assert numpy.array_equal(
+        transforms.apply_transform(embedded[0], [[1, 2, 0]]), [[3, 7, 1]])
+    assert numpy.array_equal(embedded[1], numpy.eye(4))
+    assert numpy.array_equal(
+        transforms.embed_slice_transforms([rotation], [3.0])[0, 2],
+        [0, 0, 1, 0])
+    with pytest.raises(ValueError):
+        transforms.embed_slice_transforms(numpy.eye(4)[numpy.newaxis], [0])
@@ -0,0 +1,271 @@
+# Copyright 2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import io
+
+import numpy
+import pytest
+
+from linear_voluba import leastsquares
+from linear_voluba import uncertainty
+
+
+def make_landmarks(count=8, seed=0):
+    rng = numpy.random.RandomState(seed)
+    src = rng.uniform(-50, 50, size=(count, 3))
+    src[:, 2] *= 0.3
+    return src
+
+
+TEST_POINTS = numpy.array([
+    [0, 0, 0],
+    [100, 0, 0],
+    [0, 0, 120],
+    [30, -80, 10],
+], dtype=float)
+
+
+@pytest.mark.parametrize('transformation_type',
+                         ['rigid', 'similarity', 'affine'])
+def test_predict_tre_monte_carlo(transformation_type):
+    src = make_landmarks()
+    rng = numpy.random.RandomState(1)
+    squared_errors = []
+    for _ in range(2000):
+        # Isotropic noise with an RMS norm of 1 (the FLE)
+        dst = src + rng.normal(scale=1 / numpy.sqrt(3), size=src.shape)
+        mat = leastsquares.estimate(transformation_type, src, dst)
+        transformed = TEST_POINTS @ mat[:3, :3].T + mat[:3, 3]
+        squared_errors.append(numpy.sum((transformed - TEST_POINTS) ** 2,
+                                        axis=1))
+    simulated = numpy.sqrt(numpy.mean(squared_errors, axis=0))
+    model = uncertainty.tre_model(transformation_type, src, fle=1.0)
+    assert numpy.allclose(uncertainty.predict_tre(model, TEST_POINTS),
+                          simulated, rtol=0.05)
+
+
+@pytest.mark.parametrize('transformation_type',
+                         ['rigid', 'similarity', 'affine'])
+def test_estimate_fle(transformation_type):
+    src = make_landmarks()
+    rng = numpy.random.RandomState(2)
+    estimates = [
+        uncertainty.estimate_fle(
+            transformation_type, src,
+            src + rng.normal(scale=1 / numpy.sqrt(3), size=src.shape)) ** 2
+        for _ in range(1000)
+    ]
+    assert numpy.mean(estimates) == pytest.approx(1, rel=0.05)
+    with pytest.raises(leastsquares.UnderdeterminedProblem):
+        uncertainty.estimate_fle(transformation_type, src[:2], src[:2])
+
+
+def test_tre_model_degenerate():
+    src = make_landmarks()
+    coplanar = src.copy()
+    coplanar[:, 2] = 0
+    uncertainty.tre_model('rigid', coplanar, 1.0)
+    with pytest.raises(leastsquares.UnderdeterminedProblem):
+        uncertainty.tre_model('affine', coplanar, 1.0)
+    collinear = coplanar.copy()
+    collinear[:, 1] = 0
+    with pytest.raises(leastsquares.UnderdeterminedProblem):
+        uncertainty.tre_model('similarity', collinear, 1.0)
+    with pytest.raises(leastsquares.UnderdeterminedProblem):
+        uncertainty.tre_model('rigid', numpy.zeros((0, 3)), 1.0)
+    with pytest.raises(ValueError):
+        uncertainty.tre_model('projective', src, 1.0)
+
+
+@pytest.mark.parametrize('chunk_voxels', [1, 7, 2 ** 20])
+def test_tre_map(chunk_voxels):
+    model = uncertainty.tre_model('affine', make_landmarks(), 0.5)
+    shape = (5, 4, 3)
+    grid_affine = numpy.array([
+        [2, 0.5, 0, -10],
+        [0, 3, 0, 20],
+        [0, 0, -1, 5],
+        [0, 0, 0, 1],
+    ])
+    tre = uncertainty.tre_map(model, shape, grid_affine,
+                              chunk_voxels=chunk_voxels)
+    assert tre.shape == shape
+    assert tre.dtype == numpy.float32
+    indices = numpy.indices(shape).reshape(3, -1).T
+    points = indices @ grid_affine[:3, :3].T + grid_affine[:3, 3]
+    assert numpy.allclose(tre.ravel(),
+                          uncertainty.predict_tre(model, points), rtol=1e-6)
+
+
+def test_grid_affine_from_bounding_box():
+    affine = uncertainty.grid_affine_from_bounding_box(
+        [[0, -10, 5], [10, 10, 5]], (11, 5, 1))
+    assert numpy.array_equal(affine, [
+        [1, 0, 0, 0],
+        [0, 5, 0, -10],
+        [0, 0, 0, 5],
+        [0, 0, 0, 1],
+    ])
+
+
+def test_tre_map_endpoint(client, app):
+    src = make_landmarks()
+    request = {
+        'transformation_type': 'rigid',
+        'landmark_pairs': [
+            {'source_point': list(point), 'target_point': list(point + 1)}
+            for point in src
+        ],
+        'fiducial_localization_error': 2.0,
+        'grid': {'shape': [4, 3, 2],
+                 'bounding_box': [[-50, -50, -10], [50, 50, 10]]},
+    }
+    response = client.post('/api/tre-map', json=request)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/octet-stream'
+    assert float(response.headers['X-Fiducial-Localization-Error']) == 2.0
+    tre = numpy.load(io.BytesIO(response.data))
+    assert tre.shape == (4, 3, 2)
+    model = uncertainty.tre_model('rigid', src, 2.0)
+    assert tre[0, 0, 0] == pytest.approx(
+        uncertainty.predict_tre(model, [[-50, -50, -10]]), rel=1e-6)
+
+    # The FLE is estimated from the residuals (zero here)
+    del request['fiducial_localization_error']
+    response = client.post('/api/tre-map', json=request)
+    assert response.status_code == 200
+    assert float(response.headers['X-Fiducial-Localization-Error']) \
+        == pytest.approx(0, abs=1e-9)
+
+    request['grid'] = {'shape': [2, 2, 2],
+                       'affine': numpy.eye(4).tolist()}
+    assert client.post('/api/tre-map', json=request).status_code == 200
+    request['grid']['bounding_box'] = [[0, 0, 0], [1, 1, 1]]
+    assert client.post('/api/tre-map', json=request).status_code == 422
+    del request['grid']['affine']
+    request['landmark_pairs'] = request['landmark_pairs'][:2]
+    assert client.post('/api/tre-map', json=request).status_code == 400
+    app.config['TRE_MAX_GRID_VOXELS'] = 7
+    assert client.post('/api/tre-map', json=request).status_code == 413
+
+
+@pytest.mark.parametrize('transformation_type',
+                         ['rigid', 'similarity', 'affine'])
+def test_score_candidates(transformation_type):
+    src = make_landmarks()
+    candidates = numpy.random.RandomState(3).uniform(-100, 100, (5, 3))
+    lower, upper = candidates.min(axis=0), candidates.max(axis=0)
+    corners = numpy.array([[lower[0], lower[1], lower[2]],
+                           [upper[0], upper[1], upper[2]]])
+    corners = numpy.array(numpy.meshgrid(*corners.T)).reshape(3, -1).T
+
+    def max_tre(points):
+        model = uncertainty.tre_model(transformation_type, points, 0.5)
+        return uncertainty.predict_tre(model, corners).max()
+
+    scores, current = uncertainty.score_candidates(
+        transformation_type, src, candidates, criterion='max-tre', fle=0.5,
+        chunk_size=2)
+    assert current == pytest.approx(max_tre(src))
+    assert numpy.allclose(
+        scores, [max_tre(numpy.r_[src, [c]]) for c in candidates])
+
+    def log_det_information(points):
+        jacobians = uncertainty._jacobians(transformation_type, points)
+        return numpy.linalg.slogdet(
+            numpy.einsum('nip,niq->pq', jacobians, jacobians))[1]
+
+    scores, current = uncertainty.score_candidates(
+        transformation_type, src, candidates, chunk_size=2)
+    assert current == 0
+    assert numpy.allclose(
+        scores, [log_det_information(numpy.r_[src, [c]])
+                 - log_det_information(src) for c in candidates])
+
+
+def test_suggest_landmarks():
+    # Coplanar landmarks: for affine, the best candidates are the furthest
+    # from the plane
+    src = make_landmarks()
+    src[:, 2] = 0
+    candidates = numpy.array([[0, 0, 0], [0, 0, 30], [10, 10, 1],
+                              [0, 0, -50]], dtype=float)
+    best, scores, current = uncertainty.suggest_landmarks(
+        'affine', src, candidates, count=3)
+    assert best.tolist() == [3, 1, 2]
+    assert scores[0] > scores[1] > scores[2]
+    with pytest.raises(leastsquares.UnderdeterminedProblem):
+        uncertainty.suggest_landmarks('affine', src, candidates,
+                                      criterion='max-tre')
+    best, scores, current = uncertainty.suggest_landmarks(
+        'rigid', src, candidates, count=10, criterion='max-tre')
+    assert len(best) == 4
+    assert numpy.all(numpy.diff(scores) >= 0)
+    assert numpy.all(scores <= current)
+    with pytest.raises(ValueError):
+        uncertainty.suggest_landmarks('rigid', src, candidates,
+                                      criterion='a-optimal')
+
+
+def test_suggest_landmarks_endpoint(client, app):
+    src = make_landmarks()
+    request = {
+        'transformation_type': 'affine',
+        'landmark_pairs': [
+            {'source_point': list(point), 'target_point': list(point)}
+            for point in src[:3]
+        ],
+        'candidates': [[0, 0, 0], [10, 0, 0], [0, 0, 100]],
+        'count': 2,
+    }
+    response = client.post('/api/suggest-landmarks', json=request)
+    assert response.status_code == 200
+    assert response.json['criterion'] == 'd-optimal'
+    assert response.json['fiducial_localization_error'] is None
+    assert len(response.json['suggestions']) == 2
+    assert response.json['suggestions'][0]['source_point'] == [0, 0, 100]
+
+    request['criterion'] = 'max-tre'
+    assert client.post('/api/suggest-landmarks',
+                       json=request).status_code == 400
+    request['transformation_type'] = 'rigid'
+    request['fiducial_localization_error'] = 1
+    del request['candidates']
+    request['grid'] = {'shape': [3, 3, 3],
+                       'bounding_box': [[-50, -50, -50], [50, 50, 50]]}
+    response = client.post('/api/suggest-landmarks', json=request)
+    assert response.status_code == 200
+    suggestions = response.json['suggestions']
+    assert suggestions[0]['score'] <= suggestions[1]['score'] \
+        <= response.json['current_score']
+
+    request['candidates'] = [[0, 0, 0]]
+    assert client.post('/api/suggest-landmarks',
+                       json=request).status_code == 422
+    # Empty sets of candidates are rejected
+    response = client.post('/api/suggest-landmarks', json=dict(
+        request, grid={'shape': [3, 0, 3],
+                       'bounding_box': [[0, 0, 0], [1, 1, 1]]}))
+    assert response.status_code == 422
+    del request['grid']
+    assert client.post('/api/suggest-landmarks',
+                       json=dict(request, candidates=[])).status_code == 422
+    request['grid'] = {'shape': [3, 3, 3],
+                       'bounding_box': [[-50, -50, -50], [50, 50, 50]]}
+    del request['candidates']
+    app.config['SUGGEST_MAX_CANDIDATES'] = 26
+    assert client.post('/api/suggest-landmarks',
+                       json=request).status_code == 413